@@ -0,0 +1,401 @@
+import aiohttp
+import asyncio
+from helpers.hedging import HEDGE, PRIMARY, HedgeCancelled, HedgeRace
+from helpers.proxy_helper import ProxyHelper, BadProxyError, BanError, classify_error, raise_for_status, \
+    PERMANENT_FAILURE, SITE_FAILURE
+from helpers.response_buffer import ResponseBuffer
+from helpers.response_cache import ResponseCache
+import logging
+import copy
+import random
+import time
+from functools import partial
+
+
+class AsyncDownloader:
+    def __init__(self, check_url, use_proxy=True, attempts=20, use_user_agents=True, request_per_min=None,
+                 max_in_flight=2000, proxy_helper=None, chunk_size=16 * 1024, executor=None, hedger=None,
+                 deadline=180, backoff=0.5, max_backoff=10, on_dead_letter=None, cache=None, archive=None):
+        self.check_url = check_url
+        self.use_proxy = use_proxy
+        # proxy helper can be shared with threaded downloader to compare engines on same proxy pool,
+        # new helper checks proxies in proxy-check lane of executor if it is set
+        self.proxy_helper = proxy_helper or ProxyHelper(check_url, use_proxy, request_per_min, executor=executor)
+        self.attempts = attempts
+        self.use_user_agents = use_user_agents
+        self.max_in_flight = max_in_flight
+        # response reading chunk size in bytes
+        self.chunk_size = chunk_size
+        self.proxy_auth = {}
+        # slow requests are duplicated through other proxy if set
+        self.hedger = hedger
+        # max seconds of all request attempts, retries after site errors wait random time up to backoff * 2 ** retry
+        self.deadline = deadline
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # called with failed request record when request is given up, must not block event loop
+        self.on_dead_letter = on_dead_letter
+        # GET responses are served from on-disk cache and revalidated if set
+        self.cache = cache
+        # fully read GET pages are archived for offline re-extraction if set
+        self.archive = archive
+        self.session = None
+        self.semaphore = None
+
+    async def open(self):
+        """Create client session, must be called inside running event loop"""
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight, ssl=False)
+            self.session = aiohttp.ClientSession(connector=connector)
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+
+    async def close(self):
+        """Close client session and all its connections"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def get_proxy_url(self, proxy):
+        """
+        Creating proxy url from simple proxy string, aiohttp supports only http proxies
+        :param proxy: proxy string with {ip}:{port} pattern
+        :type proxy: str
+        :return: proxy url
+        :rtype: str
+        """
+        login = self.proxy_auth.get(proxy, {}).get('login', '')
+        password = self.proxy_auth.get(proxy, {}).get('password', '')
+        return f'http://{login}:{password}@{proxy}'
+
+    async def create_request(self, method, url, params={}, cookies=None, data={}, headers={}, timeout=60,
+                             files=None, consumer_factory=None, deadline=None, page_key=None, cached=None):
+        await self.open()
+
+        @self.proxy_helper.async_exception_decorator
+        async def request_to_page(proxy, **kwargs):
+            """
+            Request wrapper
+            :param proxy: proxy string with {ip}:{port} pattern
+            :type proxy: str
+            :param kwargs: request params
+            :return: response text or consumer fed with response
+            :rtype: str, object
+            """
+            proxy_url = self.get_proxy_url(proxy) if proxy else None
+            start_time = time.time()
+            async with self.session.request(proxy=proxy_url, **kwargs) as response:
+                if response.status == 304 and cached is not None:
+                    await self.run_blocking(self.cache.revalidate, cached)
+                    return await self.replay_cached(cached, consumer_factory)
+                if response.status >= 400:
+                    raise_for_status(response.status)
+                # body is not kept if consumer parses response on the fly, except for cache and archive
+                response_buffer = ResponseBuffer(response.charset,
+                                                 keep_body=consumer_factory is None or page_key is not None)
+                consumer = consumer_factory(response_buffer.encoding) if consumer_factory else None
+                consumer_done = False
+                async for content in response.content.iter_chunked(self.chunk_size):
+                    if time.time() - start_time > 30:
+                        # if request time longer than 30 sec must stop request
+                        raise BadProxyError
+                    if response_buffer.feed(content):
+                        # proxy banned
+                        raise BanError
+                    if consumer is not None and not consumer_done and consumer.feed(content):
+                        consumer_done = True
+                        if page_key is None:
+                            # everything needed is found, connection is closed without reading rest of page
+                            response.close()
+                            return consumer
+                if page_key is not None:
+                    # whole page is read even if consumer is done, so cache and archive have full page
+                    await self.save_page(page_key, response_buffer.getvalue(), response_buffer.encoding,
+                                         response.headers)
+                if consumer is not None:
+                    if not consumer_done:
+                        consumer.finish()
+                    return consumer
+                return response_buffer.text()
+
+        headers = copy.deepcopy(headers)
+        if files:
+            # aiohttp sends files only inside multipart form
+            form = aiohttp.FormData()
+            for key, value in (data or {}).items():
+                form.add_field(key, value)
+            for key, value in files.items():
+                form.add_field(key, value)
+            data = form
+        request_kwargs = dict(method=method, url=url, params=params, cookies=cookies, data=data or None,
+                              headers=headers)
+        start_time = time.time()
+        deadline_time = start_time + (deadline or self.deadline)
+        attempts = 0
+        site_failures = 0
+        exception = None
+        use_proxy = self.use_proxy
+        async with self.semaphore:
+            while attempts < self.attempts:
+                remaining = deadline_time - time.time()
+                if remaining <= 0:
+                    break
+                if self.use_user_agents:
+                    random_agent = self.proxy_helper.get_random_user_agent()
+                    headers.update({'user-agent': random_agent})
+
+                attempts += 1
+                # try without proxies last time
+                use_proxy = self.use_proxy and attempts != self.attempts
+                request_kwargs['timeout'] = aiohttp.ClientTimeout(total=min(timeout, remaining))
+                try:
+                    # only idempotent requests are duplicated
+                    if self.hedger is not None and use_proxy and method == 'GET':
+                        return await self.hedged_request(url, request_to_page, request_kwargs, remaining)
+                    return await self.attempt_request(url, request_to_page, request_kwargs, use_proxy,
+                                                      proxy_timeout=remaining)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    exception = e
+                    logging.debug('received {} exception on request on {} try on {} link'.format(e, attempts, url))
+                    failure = classify_error(e, use_proxy)
+                    if failure == PERMANENT_FAILURE:
+                        break
+                    if failure == SITE_FAILURE:
+                        # site is struggling, retry later, proxy errors are retried at once through other proxy
+                        site_failures += 1
+                        await asyncio.sleep(min(self.get_backoff(site_failures),
+                                                max(deadline_time - time.time(), 0)))
+        await self.add_dead_letter(method, url, exception, attempts, start_time, use_proxy)
+
+    def get_backoff(self, retry):
+        """
+        Exponential backoff with full jitter, so retries of many requests don't come at once
+        :param retry: retry number starting from 1
+        :type retry: int
+        :return: seconds to wait
+        :rtype: float
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (retry - 1)))
+
+    async def add_dead_letter(self, method, url, exception, attempts, start_time, proxied=True):
+        """
+        Record request which is given up, see Downloader.add_dead_letter,
+        on_dead_letter is blocking db call, so it is run in default executor
+        """
+        record = {'url': url, 'method': method, 'attempts': attempts, 'elapsed': time.time() - start_time,
+                  'failure': classify_error(exception, proxied) if exception is not None else 'deadline',
+                  'error': repr(exception), 'failed_at': time.time()}
+        logging.info('giving up {} {} after {} attempts in {:.0f} sec: {}'.format(method, url, attempts,
+                                                                              record['elapsed'], record['error']))
+        if self.on_dead_letter is not None:
+            try:
+                await self.run_blocking(self.on_dead_letter, record)
+            except Exception:
+                logging.error('Except on dead letter saving', exc_info=True)
+
+    async def attempt_request(self, url, request_to_page, request_kwargs, use_proxy, on_start=None,
+                              attempt=PRIMARY, primary_proxy=None, proxy_timeout=None):
+        """
+        Single request attempt with host and proxy rate limits
+        :param url: requested url
+        :type url: str
+        :param request_to_page: request wrapper of create_request
+        :type request_to_page: callable
+        :param request_kwargs: request params
+        :type request_kwargs: dict
+        :param use_proxy: request through proxy
+        :type use_proxy: bool
+        :param on_start: called with proxy when request is started after rate limits
+        :type on_start: callable, None
+        :param attempt: PRIMARY or HEDGE attempt of hedged request
+        :type attempt: str
+        :param primary_proxy: proxy of primary attempt, hedge uses other one
+        :type primary_proxy: str, None
+        :param proxy_timeout: max seconds of waiting for free proxy
+        :type proxy_timeout: float, None
+        :return: response text or consumer fed with response
+        :rtype: str, object
+        """
+        raw_proxy = None
+        if attempt == HEDGE:
+            # hedge doesn't wait for proxy, it is useful only right now
+            raw_proxy = self.proxy_helper.take_other_proxy(primary_proxy)
+            if raw_proxy is None:
+                raise HedgeCancelled
+        rate_limiter = self.proxy_helper.rate_limiter
+        try:
+            if attempt == PRIMARY and use_proxy:
+                raw_proxy = await self.proxy_helper.get_proxy_async(proxy_timeout)
+            # proxy rate is waited before host slot is taken, so waiting requests don't hold host concurrency
+            await rate_limiter.wait_proxy_async(raw_proxy)
+            await rate_limiter.acquire_async(url)
+        except BaseException:
+            # attempt can be cancelled by hedge before request holds proxy
+            self.proxy_helper.release_proxy(raw_proxy, None)
+            raise
+        request_start_time = time.time()
+        try:
+            if on_start is not None:
+                on_start(raw_proxy)
+            request_response = await request_to_page(proxy=raw_proxy, **request_kwargs)
+            latency = time.time() - request_start_time
+            rate_limiter.release(url, None, latency)
+            if self.hedger is not None:
+                self.hedger.record(latency)
+            return request_response
+        except (Exception, asyncio.CancelledError) as e:
+            rate_limiter.release(url, e, time.time() - request_start_time, raw_proxy is not None)
+            raise
+
+    async def hedged_request(self, url, request_to_page, request_kwargs, proxy_timeout=None):
+        """
+        Request attempt which is duplicated through other proxy when it is slower than latency percentile,
+        result of first successful attempt is returned and other attempt is cancelled
+        :param url: requested url
+        :type url: str
+        :param request_to_page: request wrapper of create_request
+        :type request_to_page: callable
+        :param request_kwargs: request params
+        :type request_kwargs: dict
+        :param proxy_timeout: max seconds of waiting for free proxy
+        :type proxy_timeout: float, None
+        :return: response text or consumer fed with response
+        :rtype: str, object
+        """
+        self.hedger.on_request()
+        race = HedgeRace()
+        started = asyncio.Event()
+
+        def on_start(proxy):
+            race.primary_proxy = proxy
+            started.set()
+
+        primary = asyncio.ensure_future(self.attempt_request(url, request_to_page, request_kwargs, True, on_start,
+                                                          proxy_timeout=proxy_timeout))
+        pending = {primary}
+        hedge = None
+        try:
+            # hedge delay is counted from request start, waiting for rate limits and proxy is not late
+            started_waiter = asyncio.ensure_future(started.wait())
+            await asyncio.wait([primary, started_waiter], return_when=asyncio.FIRST_COMPLETED)
+            started_waiter.cancel()
+            delay = self.hedger.get_delay()
+            if not primary.done() and delay is not None:
+                await asyncio.wait([primary], timeout=delay)
+                if not primary.done() and self.hedger.try_hedge():
+                    hedge = asyncio.ensure_future(self.attempt_request(url, request_to_page, request_kwargs, True,
+                                                                       attempt=HEDGE,
+                                                                       primary_proxy=race.primary_proxy))
+                    pending.add(hedge)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedger.on_hedge_won()
+                        return task.result()
+            # both attempts failed
+            raise primary.exception()
+        finally:
+            # loser is cancelled, its proxy and rate limits are released by its handlers
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    async def run_blocking(func, *args):
+        """
+        Run blocking disk or db call in default executor, so it doesn't stop event loop,
+        e.g. cache sqlite index or archive batch compression and writing
+        :param func: blocking function
+        :type func: callable
+        :return: func result
+        """
+        return await asyncio.get_event_loop().run_in_executor(None, partial(func, *args))
+
+    async def save_page(self, page_key, body, encoding, headers):
+        """
+        Save fully read page into cache and archive, their errors don't fail downloaded request
+        :param page_key: page url with query params
+        :type page_key: str
+        :param body: raw page body
+        :type body: bytes
+        :param encoding: body charset
+        :type encoding: str
+        :param headers: response headers
+        :type headers: collections.abc.Mapping
+        """
+        try:
+            if self.cache is not None:
+                await self.run_blocking(self.cache.store, page_key, body, encoding, headers)
+            if self.archive is not None:
+                await self.run_blocking(self.archive.add, page_key, body, encoding)
+        except Exception:
+            logging.warning('Except on saving {} page'.format(page_key), exc_info=True)
+
+    async def replay_cached(self, cached, consumer_factory=None):
+        """
+        :param cached: fresh or revalidated cached page
+        :type cached: helpers.response_cache.CachedResponse
+        :param consumer_factory: see get
+        :type consumer_factory: callable, None
+        :return: page text or consumer fed with page
+        :rtype: str, object
+        """
+        if self.archive is not None:
+            # pages cached before archive was enabled are archived too, unchanged pages are skipped by archive
+            await self.run_blocking(self.archive.add, cached.key, cached.body, cached.encoding)
+        return cached.replay(consumer_factory)
+
+    async def get(self, url, params={}, cookies=None, headers={}, timeout=60, consumer_factory=None):
+        """
+        Get method wrapper
+        :param: request params
+        :param consumer_factory: called with response charset, returns object with feed(chunk) method which is
+            fed with response chunks and returns True when rest of response is not needed, and finish() method
+        :type consumer_factory: callable, None
+        :return: response text, consumer if consumer_factory is set or None if we have no response
+        :rtype: str, object, None
+        """
+        page_key = cached = None
+        if self.cache is not None or self.archive is not None:
+            page_key = ResponseCache.get_key(url, params)
+        if self.cache is not None:
+            cached = await self.run_blocking(self.cache.lookup, page_key)
+            if cached is not None:
+                if cached.is_fresh():
+                    return await self.replay_cached(cached, consumer_factory)
+                # stale page is requested with its validators, site answers 304 without body if it is not changed
+                headers = dict(headers, **cached.get_validators())
+        return await self.create_request(method='GET',
+                                         url=url,
+                                         params=params,
+                                         cookies=cookies,
+                                         headers=headers,
+                                         timeout=timeout,
+                                         consumer_factory=consumer_factory,
+                                         page_key=page_key,
+                                         cached=cached)
+
+    async def post(self, url, params={}, cookies=None, data={}, headers={}, timeout=60, files=None):
+        """
+        Post method wrapper
+        :param: request params
+        :return: response text or None if we have no response
+        :rtype: str, None
+        """
+        return await self.create_request(method='POST',
+                                         url=url,
+                                         params=params,
+                                         cookies=cookies,
+                                         data=data,
+                                         headers=headers,
+                                         timeout=timeout,
+                                         files=files)
@@ -0,0 +1,39 @@
+import csv
+import gzip
+import logging
+import time
+
+
+def open_csv_file(file_name):
+    """
+    Open csv file for writing, gzip compressed if file name ends with .gz
+    :type file_name: str
+    :return: text file object
+    """
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'wt', newline='', encoding='utf-8')
+    return open(file_name, 'w', newline='', encoding='utf-8')
+
+
+def export_csv(file_name, columns, rows):
+    """
+    Write rows into csv file one by one, so memory usage doesn't depend on rows count
+    :param file_name: csv file path, .gz suffix enables compression
+    :type file_name: str
+    :param columns: list of (csv column, row field) tuples
+    :type columns: list
+    :param rows: dicts iterator, missing fields are written as empty values
+    :type rows: iterable
+    :return: written rows count
+    :rtype: int
+    """
+    start_time = time.time()
+    count = 0
+    with open_csv_file(file_name) as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow([column for column, _ in columns])
+        for row in rows:
+            writer.writerow([row.get(field) for _, field in columns])
+            count += 1
+    logging.info('{} rows exported into {} ({:.1f} sec)'.format(count, file_name, time.time() - start_time))
+    return count
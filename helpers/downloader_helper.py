@@ -1,31 +1,78 @@
 import requests
-from helpers.proxy_helper import ProxyHelper, BadProxyError
+from helpers.hedging import HEDGE, PRIMARY, HedgeCancelled, HedgeRace
+from helpers.proxy_helper import ProxyHelper, BadProxyError, BanError, classify_error, raise_for_status, \
+    PERMANENT_FAILURE, SITE_FAILURE
+from helpers.response_buffer import ResponseBuffer
+from helpers.response_cache import ResponseCache
+from helpers.session_pool import SessionPool
 import logging
 import copy
+import random
+import socket
 import time
+from contextlib import contextmanager
+from functools import partial
 
 
 class Downloader:
-    def __init__(self, check_url, use_proxy=True, attempts=20, use_user_agents=True, use_session=False, request_per_min=20):
+    # warning about hedge race losers which can't be interrupted is logged once
+    abort_warned = False
+
+    def __init__(self, check_url, use_proxy=True, attempts=20, use_user_agents=True, use_session=False, request_per_min=None,
+                 chunk_size=16 * 1024, executor=None, hedger=None, deadline=180, backoff=0.5, max_backoff=10,
+                 on_dead_letter=None, cache=None, archive=None):
         self.check_url = check_url
         self.use_proxy = use_proxy
         self.use_session = use_session
+        # proxies are checked in proxy-check lane of executor if it is set
+        self.proxy_helper = ProxyHelper(check_url, use_proxy, request_per_min, executor=executor)
+        self.session_pool = None
         self.update_request_maker()
-        self.proxy_helper = ProxyHelper(check_url, use_proxy, request_per_min)
         self.attempts = attempts
         self.use_user_agents = use_user_agents
         self.user_agents_list = ProxyHelper.load_user_agents()
         self.proxy_auth = {}
-        self.session_update_time = time.time()
+        # response reading chunk size in bytes
+        self.chunk_size = chunk_size
+        # slow requests are duplicated through other proxy if set
+        self.hedger = hedger
+        # max seconds of all request attempts, so one dead url doesn't hold worker for attempts * timeout
+        self.deadline = deadline
+        # retries after site errors wait random time up to backoff * 2 ** retry seconds
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # called with failed request record when request is given up
+        self.on_dead_letter = on_dead_letter
+        # GET responses are served from on-disk cache and revalidated if set
+        self.cache = cache
+        # fully read GET pages are archived for offline re-extraction if set
+        self.archive = archive
 
     def update_request_maker(self):
+        """Create pool of keep-alive sessions per proxy if sessions are used"""
+        if self.session_pool is not None:
+            self.session_pool.close()
+            self.session_pool = None
         if self.use_session:
-            self.request_maker = requests.Session()
-            # raise max pool size for use bigger thread pool size
-            a = requests.adapters.HTTPAdapter(pool_maxsize=9999)
-            self.request_maker.mount('https://', a)
-        else:
-            self.request_maker = requests
+            self.session_pool = SessionPool(max_sessions=self.proxy_helper.max_proxies,
+                                            pool_maxsize=self.proxy_helper.proxies.max_on_work)
+            # connections through deleted proxy are useless
+            self.proxy_helper.on_proxy_delete.append(self.session_pool.discard)
+
+    @contextmanager
+    def checkout_request_maker(self, proxy):
+        """
+        Request maker for one request, response must be read inside of with block
+        :param proxy: proxy string with {ip}:{port} pattern, None for request without proxy
+        :type proxy: str, None
+        :return: proxy session or requests module if sessions are not used
+        :rtype: requests.Session, module
+        """
+        if self.session_pool is None:
+            yield requests
+            return
+        with self.session_pool.checkout(proxy) as session:
+            yield session
 
     def get_proxies(self, proxy):
         """
@@ -43,73 +90,352 @@ class Downloader:
                    'http': proxy_string.format('http')}
         return proxies
 
-    def create_request(self, method, url, params={}, cookies=None, data={}, headers={}, timeout=60, files=None):
+    def create_request(self, method, url, params={}, cookies=None, data={}, headers={}, timeout=60, files=None,
+                       consumer_factory=None, deadline=None, page_key=None, cached=None):
         # Decorator must use instant function because we must change instant proxy dataframe only
         @self.proxy_helper.exception_decorator
-        def request_to_page(proxy, **kwargs):
+        def request_to_page(proxy, race=None, attempt=PRIMARY, **kwargs):
             """
             Request wrapper
             :param proxy: proxy string with {ip}:{port} pattern
             :type proxy: str
+            :param race: race of hedged request attempts
+            :type race: HedgeRace, None
+            :param attempt: PRIMARY or HEDGE attempt of race
+            :type attempt: str
             :param kwargs: request params
-            :return: response text
-            :rtype: str
+            :return: response text or consumer fed with response
+            :rtype: str, object
             """
+            if race is not None:
+                # hedge could wait for proxy and rate limits while primary attempt finished
+                race.check(attempt)
             proxies = self.get_proxies(proxy) if proxy else {}
-            response_text = ''
             start_time = time.time()
-            response = self.request_maker.request(proxies=proxies, stream=True, **kwargs)
-            for content in response.iter_content(1024, decode_unicode=True):
-                if time.time() - start_time > 30:
-                    # if request time longer than 30 sec must stop request
-                    raise BadProxyError
+            # session is not closed by pool until response is read
+            with self.checkout_request_maker(proxy) as request_maker:
+                response = request_maker.request(proxies=proxies, stream=True, **kwargs)
+                if race is None:
+                    return self.read_response(response, start_time, consumer_factory, page_key, cached)
+                # winner of race aborts reading of loser
+                race.register(attempt, partial(self.abort_response, response))
                 try:
-                    # if content is json object, concat it raw, else decode in utf-8
-                    response_text += content
-                except TypeError:
-                    response_text += content.decode('utf-8')
-                if "You don't have permission to access" in response_text:
-                    # proxy banned
-                    raise BadProxyError
-            return response_text
+                    result = self.read_response(response, start_time, consumer_factory, page_key, cached)
+                except Exception:
+                    # aborted response error is not proxy error
+                    race.check(attempt)
+                    raise
+            if not race.win(attempt):
+                raise HedgeCancelled
+            return result
         headers = copy.deepcopy(headers)
-        attempts = self.attempts
-        while attempts > 0:
+        request_kwargs = dict(method=method, url=url, params=params, cookies=cookies, data=data, headers=headers,
+                              timeout=timeout, files=files)
+        start_time = time.time()
+        deadline_time = start_time + (deadline or self.deadline)
+        attempts = 0
+        site_failures = 0
+        exception = None
+        use_proxy = self.use_proxy
+        while attempts < self.attempts:
+            remaining = deadline_time - time.time()
+            if remaining <= 0:
+                break
             if self.use_user_agents:
                 random_agent = self.proxy_helper.get_random_user_agent()
                 headers.update({'user-agent': random_agent})
 
-            attempts -= 1
+            attempts += 1
             # try without proxies last time
-            raw_proxy = self.proxy_helper.get_proxy() if self.use_proxy and attempts != 1 else None
+            use_proxy = self.use_proxy and attempts != self.attempts
+            request_kwargs['timeout'] = min(timeout, remaining)
             try:
-                request_response = request_to_page(proxy=raw_proxy,
-                                                   method=method,
-                                                   url=url,
-                                                   params=params,
-                                                   cookies=cookies,
-                                                   data=data,
-                                                   headers=headers,
-                                                   timeout=timeout,
-                                                   files=files)
-
-                return request_response
+                # only idempotent requests are duplicated
+                if self.hedger is not None and use_proxy and method == 'GET':
+                    return self.hedged_request(url, request_to_page, request_kwargs, remaining)
+                return self.attempt_request(url, request_to_page, request_kwargs, use_proxy, remaining)
             except Exception as e:
-                logging.debug('received {} exception on request on {} try on {} link'.format(e, self.attempts - attempts, url))
+                exception = e
+                logging.debug('received {} exception on request on {} try on {} link'.format(e, attempts, url))
+                failure = classify_error(e, use_proxy)
+                if failure == PERMANENT_FAILURE:
+                    break
+                if failure == SITE_FAILURE:
+                    # site is struggling, retry later, proxy errors are retried at once through other proxy
+                    site_failures += 1
+                    time.sleep(min(self.get_backoff(site_failures), max(deadline_time - time.time(), 0)))
+        self.add_dead_letter(method, url, exception, attempts, start_time, use_proxy)
+
+    def get_backoff(self, retry):
+        """
+        Exponential backoff with full jitter, so retries of many workers don't come at once
+        :param retry: retry number starting from 1
+        :type retry: int
+        :return: seconds to wait
+        :rtype: float
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (retry - 1)))
+
+    def add_dead_letter(self, method, url, exception, attempts, start_time, proxied=True):
+        """
+        Record request which is given up
+        :param method: request method
+        :type method: str
+        :param url: requested url
+        :type url: str
+        :param exception: last attempt exception, None if no attempt was made
+        :type exception: Exception, None
+        :param attempts: made attempts count
+        :type attempts: int
+        :param start_time: request start time
+        :type start_time: float
+        :param proxied: last attempt was made through proxy
+        :type proxied: bool
+        """
+        record = {'url': url, 'method': method, 'attempts': attempts, 'elapsed': time.time() - start_time,
+                  'failure': classify_error(exception, proxied) if exception is not None else 'deadline',
+                  'error': repr(exception), 'failed_at': time.time()}
+        logging.info('giving up {} {} after {} attempts in {:.0f} sec: {}'.format(method, url, attempts,
+                                                                              record['elapsed'], record['error']))
+        if self.on_dead_letter is not None:
+            try:
+                self.on_dead_letter(record)
+            except Exception:
+                logging.error('Except on dead letter saving', exc_info=True)
+
+    def attempt_request(self, url, request_to_page, request_kwargs, use_proxy, proxy_timeout=None, race=None,
+                        attempt=PRIMARY):
+        """
+        Single request attempt with host and proxy rate limits
+        :param url: requested url
+        :type url: str
+        :param request_to_page: request wrapper of create_request
+        :type request_to_page: callable
+        :param request_kwargs: request params
+        :type request_kwargs: dict
+        :param use_proxy: request through proxy
+        :type use_proxy: bool
+        :param proxy_timeout: max seconds of waiting for free proxy
+        :type proxy_timeout: float, None
+        :param race: race of hedged request attempts
+        :type race: HedgeRace, None
+        :param attempt: PRIMARY or HEDGE attempt of race
+        :type attempt: str
+        :return: response text or consumer fed with response
+        :rtype: str, object
+        """
+        raw_proxy = None
+        if attempt == HEDGE:
+            # hedge doesn't wait for proxy, it is useful only right now
+            raw_proxy = self.proxy_helper.take_other_proxy(race.primary_proxy)
+            if raw_proxy is None:
+                raise HedgeCancelled
+        rate_limiter = self.proxy_helper.rate_limiter
+        try:
+            if attempt == PRIMARY and use_proxy:
+                raw_proxy = self.proxy_helper.get_proxy(proxy_timeout)
+            # proxy rate is waited before host slot is taken, so waiting requests don't hold host concurrency
+            rate_limiter.wait_proxy(raw_proxy)
+            rate_limiter.acquire(url)
+        except BaseException:
+            self.proxy_helper.release_proxy(raw_proxy, None)
+            raise
+        request_start_time = time.time()
+        try:
+            if race is not None and attempt == PRIMARY:
+                race.primary_proxy = raw_proxy
+                delay = self.hedger.get_delay()
+                if delay is not None:
+                    self.hedger.watch(race, delay, self.attempt_request, url, request_to_page, request_kwargs,
+                                      True, None, race, HEDGE)
+            request_response = request_to_page(proxy=raw_proxy, race=race, attempt=attempt, **request_kwargs)
+            latency = time.time() - request_start_time
+            rate_limiter.release(url, None, latency)
+            if self.hedger is not None:
+                self.hedger.record(latency)
+            return request_response
+        except Exception as e:
+            rate_limiter.release(url, e, time.time() - request_start_time, raw_proxy is not None)
+            raise
 
-    def get(self, url, params={}, cookies=None, headers={}, timeout=60):
+    def hedged_request(self, url, request_to_page, request_kwargs, proxy_timeout=None):
+        """
+        Request attempt which is duplicated through other proxy when it is slower than latency percentile,
+        result of first successful attempt is returned
+        :param url: requested url
+        :type url: str
+        :param request_to_page: request wrapper of create_request
+        :type request_to_page: callable
+        :param request_kwargs: request params
+        :type request_kwargs: dict
+        :param proxy_timeout: max seconds of waiting for free proxy
+        :type proxy_timeout: float, None
+        :return: response text or consumer fed with response
+        :rtype: str, object
+        """
+        self.hedger.on_request()
+        race = HedgeRace()
+        try:
+            request_response = self.attempt_request(url, request_to_page, request_kwargs, True, proxy_timeout, race,
+                                                    PRIMARY)
+        except Exception as e:
+            hedge_future = race.close()
+            if hedge_future is None:
+                raise
+            # primary attempt lost race or failed, hedge result is used
+            try:
+                request_response = hedge_future.result()
+            except Exception:
+                raise e
+            self.hedger.on_hedge_won()
+            return request_response
+        race.close()
+        return request_response
+
+    def read_response(self, response, start_time, consumer_factory=None, page_key=None, cached=None):
+        """
+        Read streamed response
+        :type response: requests.Response
+        :param start_time: request start time
+        :type start_time: float
+        :param consumer_factory: see get
+        :type consumer_factory: callable, None
+        :param page_key: response is saved into cache and archive with this key if set
+        :type page_key: str, None
+        :param cached: stale cached page which request revalidates
+        :type cached: helpers.response_cache.CachedResponse, None
+        :return: response text or consumer fed with response
+        :rtype: str, object
+        """
+        if response.status_code == 304 and cached is not None:
+            response.close()
+            self.cache.revalidate(cached)
+            return self.replay_cached(cached, consumer_factory)
+        if response.status_code >= 400:
+            response.close()
+            raise_for_status(response.status_code)
+        # body is not kept if consumer parses response on the fly, except for cache and archive
+        response_buffer = ResponseBuffer(response.encoding, keep_body=consumer_factory is None or page_key is not None)
+        consumer = consumer_factory(response_buffer.encoding) if consumer_factory else None
+        consumer_done = False
+        for content in response.iter_content(self.chunk_size):
+            if time.time() - start_time > 30:
+                # if request time longer than 30 sec must stop request
+                response.close()
+                raise BadProxyError
+            if response_buffer.feed(content):
+                # proxy banned
+                response.close()
+                raise BanError
+            if consumer is not None and not consumer_done and consumer.feed(content):
+                consumer_done = True
+                if page_key is None:
+                    # everything needed is found, rest of page is not downloaded
+                    response.close()
+                    return consumer
+        if page_key is not None:
+            # whole page is read even if consumer is done, so cache and archive have full page
+            self.save_page(page_key, response_buffer.getvalue(), response_buffer.encoding, response.headers)
+        if consumer is not None:
+            if not consumer_done:
+                consumer.finish()
+            return consumer
+        return response_buffer.text()
+
+    @staticmethod
+    def get_response_socket(response):
+        """
+        :type response: requests.Response
+        :return: socket of streamed response connection, None if urllib3 doesn't expose it or response is released
+        :rtype: socket.socket, None
+        """
+        # urllib3 HTTPResponse.connection is public since urllib3 1.24
+        connection = getattr(response.raw, 'connection', None)
+        return getattr(connection, 'sock', None)
+
+    @classmethod
+    def abort_response(cls, response):
+        """
+        Close response from other thread, socket is shut down because closing doesn't interrupt blocked reading
+        :type response: requests.Response
+        """
+        sock = cls.get_response_socket(response)
+        if sock is None:
+            if not cls.abort_warned:
+                cls.abort_warned = True
+                logging.warning('Response socket is not available, hedge race loser is not interrupted and '
+                                'is read until its timeout')
+        else:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # socket is already closed by finished reading
+                logging.debug('Can`t shut down response socket', exc_info=True)
+        response.close()
+
+    def save_page(self, page_key, body, encoding, headers):
+        """
+        Save fully read page into cache and archive, their errors don't fail downloaded request
+        :param page_key: page url with query params
+        :type page_key: str
+        :param body: raw page body
+        :type body: bytes
+        :param encoding: body charset
+        :type encoding: str
+        :param headers: response headers
+        :type headers: collections.abc.Mapping
+        """
+        try:
+            if self.cache is not None:
+                self.cache.store(page_key, body, encoding, headers)
+            if self.archive is not None:
+                self.archive.add(page_key, body, encoding)
+        except Exception:
+            logging.warning('Except on saving {} page'.format(page_key), exc_info=True)
+
+    def replay_cached(self, cached, consumer_factory=None):
+        """
+        :param cached: fresh or revalidated cached page
+        :type cached: helpers.response_cache.CachedResponse
+        :param consumer_factory: see get
+        :type consumer_factory: callable, None
+        :return: page text or consumer fed with page
+        :rtype: str, object
+        """
+        if self.archive is not None:
+            # pages cached before archive was enabled are archived too, unchanged pages are skipped by archive
+            self.archive.add(cached.key, cached.body, cached.encoding)
+        return cached.replay(consumer_factory)
+
+    def get(self, url, params={}, cookies=None, headers={}, timeout=60, consumer_factory=None):
         """
         Get method wrapper
         :param: request params
-        :return: response text or None if we have no response
-        :rtype: str, None
+        :param consumer_factory: called with response charset, returns object with feed(chunk) method which is
+            fed with response chunks and returns True when rest of response is not needed, and finish() method
+        :type consumer_factory: callable, None
+        :return: response text, consumer if consumer_factory is set or None if we have no response
+        :rtype: str, object, None
         """
+        page_key = cached = None
+        if self.cache is not None or self.archive is not None:
+            page_key = ResponseCache.get_key(url, params)
+        if self.cache is not None:
+            cached = self.cache.lookup(page_key)
+            if cached is not None:
+                if cached.is_fresh():
+                    return self.replay_cached(cached, consumer_factory)
+                # stale page is requested with its validators, site answers 304 without body if it is not changed
+                headers = dict(headers, **cached.get_validators())
         return self.create_request(method='GET',
                                    url=url,
                                    params=params,
                                    cookies=cookies,
                                    headers=headers,
-                                   timeout=timeout)
+                                   timeout=timeout,
+                                   consumer_factory=consumer_factory,
+                                   page_key=page_key,
+                                   cached=cached)
 
     def post(self, url, params={}, cookies=None, data={}, headers={}, timeout=60, files=None):
         """
@@ -0,0 +1,308 @@
+import logging
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, as_completed, wait
+from threading import BoundedSemaphore, Condition, Thread
+
+
+class Lane:
+    """
+    Named task queue of LaneExecutor with concurrency quota, reserved slots and stats.
+    Submit blocks when max_pending tasks of lane are queued or running, so producers can't flood memory.
+    """
+    def __init__(self, executor, name, quota, reserved=0, max_pending=None):
+        """
+        :param executor: owner executor
+        :type executor: LaneExecutor
+        :param name: lane name
+        :type name: str
+        :param quota: max running tasks of lane
+        :type quota: int
+        :param reserved: slots which other lanes can't take, lane always can run so many tasks
+        :type reserved: int
+        :param max_pending: max queued and running tasks, quota * 4 by default
+        :type max_pending: int, None
+        """
+        self.executor = executor
+        self.name = name
+        self.quota = quota
+        self.reserved = reserved
+        self.max_pending = max_pending or quota * 4
+        self.semaphore = BoundedSemaphore(self.max_pending)
+        self.queue = deque()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        # seconds spent by tasks in queue and by finished tasks in work
+        self.wait_time = 0.0
+        self.busy_time = 0.0
+        # sum of running tasks start times, so work time of long running tasks is counted before they finish
+        self.running_start_sum = 0.0
+
+    def get_busy_time(self, now):
+        """
+        Work time of finished and running tasks, must be called under executor lock
+        :rtype: float
+        """
+        return self.busy_time + self.running * now - self.running_start_sum
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedule task in lane, blocks if too many lane tasks are pending
+        :return: task future
+        :rtype: concurrent.futures.Future
+        """
+        return self.executor.submit(self.name, func, *args, **kwargs)
+
+    def try_submit(self, func, *args, **kwargs):
+        """
+        Schedule task in lane if it has less than max_pending tasks, never blocks
+        :return: task future or None if lane is full
+        :rtype: concurrent.futures.Future, None
+        """
+        return self.executor.enqueue(self, func, args, kwargs, block=False)
+
+    def map(self, func, iterable):
+        """
+        Run func on every item concurrently
+        :return: results in items order
+        :rtype: list
+        """
+        futures = [self.submit(func, item) for item in iterable]
+        return [future.result() for future in futures]
+
+    def imap_unordered(self, func, iterable):
+        """
+        Run func on every item concurrently, results are yielded as soon as they are ready
+        :rtype: generator
+        """
+        futures = set()
+        for item in iterable:
+            futures.add(self.submit(func, item))
+            if len(futures) >= self.max_pending:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(futures):
+            yield future.result()
+
+
+class LaneExecutor:
+    """
+    Thread pool shared by all crawling components with global cap of running tasks and named priority lanes.
+    Free worker takes task from first lane in adding order which is under its quota, so earlier lanes have priority.
+    Lane can take slot only if it is not needed for not used reservations of other lanes, so lanes which tasks
+    are waited by other lanes (e.g. review pages waited by crawl workers) can't be starved into deadlock.
+    """
+    def __init__(self, max_workers=250, name='executor', stats_interval=30):
+        """
+        :param max_workers: max running tasks of all lanes, worker threads are started on demand up to it
+        :type max_workers: int
+        :param name: threads name prefix
+        :type name: str
+        :param stats_interval: seconds between stats logging
+        :type stats_interval: float
+        """
+        self.max_workers = max_workers
+        self.name = name
+        self.stats_interval = stats_interval
+        self.lanes = OrderedDict()
+        self.condition = Condition()
+        self.threads = []
+        self.idle_workers = 0
+        self.running = 0
+        self.is_shutdown = False
+        self.stats_time = time.time()
+        self.stats_busy_time = {}
+
+    def add_lane(self, name, quota, reserved=0, max_pending=None):
+        """
+        Append lane with lower priority than already added ones, see Lane for params
+        :return: executor for chaining
+        :rtype: LaneExecutor
+        """
+        if name in self.lanes:
+            raise ValueError('lane {} already exists'.format(name))
+        if quota > self.max_workers:
+            raise ValueError('{} lane quota {} is bigger than {} workers'.format(name, quota, self.max_workers))
+        if reserved > quota:
+            raise ValueError('{} lane reserves {} slots but its quota is {}'.format(name, reserved, quota))
+        if sum(lane.reserved for lane in self.lanes.values()) + reserved > self.max_workers:
+            raise ValueError('lanes reserve more slots than {} workers'.format(self.max_workers))
+        self.lanes[name] = Lane(self, name, quota, reserved, max_pending)
+        return self
+
+    def lane(self, name):
+        """
+        :type name: str
+        :rtype: Lane
+        """
+        return self.lanes[name]
+
+    def submit(self, lane_name, func, *args, **kwargs):
+        """
+        Schedule task in lane, blocks if too many lane tasks are pending
+        :param lane_name: name of added lane
+        :type lane_name: str
+        :return: task future
+        :rtype: concurrent.futures.Future
+        """
+        return self.enqueue(self.lanes[lane_name], func, args, kwargs)
+
+    def enqueue(self, lane, func, args, kwargs, block=True):
+        """
+        Put task into lane queue and wake or start worker for it
+        :type lane: Lane
+        :param block: wait for free place in lane if it has max_pending tasks, otherwise return None
+        :type block: bool
+        :return: task future or None if lane is full and block is not set
+        :rtype: concurrent.futures.Future, None
+        """
+        if not lane.semaphore.acquire(blocking=block):
+            return None
+        future = Future()
+        with self.condition:
+            if self.is_shutdown:
+                lane.semaphore.release()
+                raise RuntimeError('cannot schedule new tasks after shutdown')
+            lane.queue.append((future, func, args, kwargs, time.time()))
+            if self.idle_workers == 0 and len(self.threads) < self.max_workers:
+                thread = Thread(target=self.work, name='{}-{}'.format(self.name, len(self.threads)), daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            else:
+                self.wake_worker()
+        return future
+
+    def can_start(self, lane):
+        """
+        Check that lane task can take slot, must be called under lock
+        :type lane: Lane
+        :rtype: bool
+        """
+        if lane.running >= lane.quota:
+            return False
+        if lane.running < lane.reserved:
+            return True
+        # slots reserved by other lanes and not used by them can't be taken
+        other_reservations = sum(max(other.reserved - other.running, 0) for other in self.lanes.values()
+                                 if other is not lane)
+        return self.running + other_reservations < self.max_workers
+
+    def take_task(self):
+        """
+        Pop first task which can be started in lanes priority order, must be called under lock
+        :return: lane, task and its start time tuple or None
+        :rtype: tuple, None
+        """
+        for lane in self.lanes.values():
+            if lane.queue and self.can_start(lane):
+                task = lane.queue.popleft()
+                now = time.time()
+                lane.running += 1
+                lane.running_start_sum += now
+                lane.wait_time += now - task[-1]
+                self.running += 1
+                return lane, task, now
+        return None
+
+    def wake_worker(self):
+        """
+        Wake one idle worker, must be called under lock.
+        Idle counter is decreased here, not by woken worker, so next submit doesn't count on already woken one
+        """
+        if self.idle_workers:
+            self.idle_workers -= 1
+            self.condition.notify()
+
+    def has_queued_tasks(self):
+        return any(lane.queue for lane in self.lanes.values())
+
+    def work(self):
+        """Worker loop"""
+        while True:
+            with self.condition:
+                taken = self.take_task()
+                while taken is None:
+                    if self.is_shutdown and not self.has_queued_tasks():
+                        return
+                    self.idle_workers += 1
+                    self.condition.wait()
+                    taken = self.take_task()
+                if self.has_queued_tasks():
+                    # more tasks can be startable, e.g. after submit of several tasks
+                    self.wake_worker()
+            lane, (future, func, args, kwargs, _), start_time = taken
+            self.run_task(lane, future, func, args, kwargs, start_time)
+
+    def run_task(self, lane, future, func, args, kwargs, start_time):
+        """Run task, free its slot and wake worker for next task"""
+        failed = False
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = func(*args, **kwargs)
+                except BaseException as e:
+                    failed = True
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+        finally:
+            end_time = time.time()
+            with self.condition:
+                lane.running -= 1
+                lane.running_start_sum -= start_time
+                lane.busy_time += end_time - start_time
+                self.running -= 1
+                lane.completed += 1
+                lane.failed += failed
+                self.wake_worker()
+            lane.semaphore.release()
+        if end_time - self.stats_time > self.stats_interval:
+            self.log_stats()
+
+    def stats(self):
+        """
+        :return: lane name -> queued, running, quota, completed and failed tasks counts
+        :rtype: dict
+        """
+        with self.condition:
+            return {name: {'queued': len(lane.queue), 'running': lane.running, 'quota': lane.quota,
+                           'completed': lane.completed, 'failed': lane.failed}
+                    for name, lane in self.lanes.items()}
+
+    def log_stats(self):
+        """Log queue depth, running tasks and quota utilisation of every lane since previous call"""
+        with self.condition:
+            now = time.time()
+            elapsed = now - self.stats_time
+            if elapsed <= 0:
+                return
+            self.stats_time = now
+            lanes_stats = []
+            for name, lane in self.lanes.items():
+                lane_busy_time = lane.get_busy_time(now)
+                busy_time = lane_busy_time - self.stats_busy_time.get(name, 0.0)
+                self.stats_busy_time[name] = lane_busy_time
+                started = lane.completed + lane.running
+                average_wait = lane.wait_time / started if started else 0
+                lanes_stats.append('{}: {} queued, {}/{} running, {:.0%} utilisation, {} done, {} failed, '
+                                   '{:.2f} sec avg wait'.format(name, len(lane.queue), lane.running, lane.quota,
+                                                                busy_time / (lane.quota * elapsed), lane.completed,
+                                                                lane.failed, average_wait))
+            logging.info('{} {}/{} workers busy, {}'.format(self.name, self.running, self.max_workers,
+                                                            ', '.join(lanes_stats)))
+
+    def shutdown(self, wait=True):
+        """
+        Stop workers after all queued tasks are finished
+        :param wait: wait until workers are stopped
+        :type wait: bool
+        """
+        with self.condition:
+            self.is_shutdown = True
+            self.idle_workers = 0
+            self.condition.notify_all()
+        if wait:
+            for thread in list(self.threads):
+                thread.join()
@@ -0,0 +1,306 @@
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
+
+# attempts of hedged request
+PRIMARY = 'primary'
+HEDGE = 'hedge'
+
+
+class HedgeCancelled(Exception):
+    """Attempt lost race to other attempt of same request"""
+
+
+class LatencyTracker:
+    """Percentile of latencies of recent successful requests"""
+    def __init__(self, percentile=0.95, window=1000, min_samples=100, refresh_every=50):
+        """
+        :param percentile: tracked percentile, between 0 and 1
+        :type percentile: float
+        :param window: count of recent latencies which percentile is computed on
+        :type window: int
+        :param min_samples: percentile is unknown until so many latencies are recorded
+        :type min_samples: int
+        :param refresh_every: percentile is recomputed after so many new latencies, sorting window is not cheap
+        :type refresh_every: int
+        """
+        self.percentile = percentile
+        self.latencies = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.refresh_every = refresh_every
+        self.recorded = 0
+        self.value = None
+        self.lock = Lock()
+
+    def record(self, latency):
+        """
+        :param latency: request time in seconds
+        :type latency: float
+        """
+        with self.lock:
+            self.latencies.append(latency)
+            self.recorded += 1
+            if self.recorded % self.refresh_every == 0 and len(self.latencies) >= self.min_samples:
+                latencies = sorted(self.latencies)
+                self.value = latencies[min(int(len(latencies) * self.percentile), len(latencies) - 1)]
+
+
+class HedgeBudget:
+    """Every request earns ratio of token and every hedge spends whole token, so hedges are at most ratio of requests"""
+    def __init__(self, ratio=0.05, burst=10):
+        """
+        :param ratio: max hedges per request
+        :type ratio: float
+        :param burst: max tokens stored, hedges which can be made at once
+        :type burst: float
+        """
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self.lock = Lock()
+
+    def earn(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self):
+        """
+        :return: True if hedge is allowed
+        :rtype: bool
+        """
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def refund(self):
+        """Return token of hedge which is not started"""
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+
+class HedgeRace:
+    """
+    Primary attempt of request and its hedge, first successful attempt wins.
+    Open responses are registered in race, so winner aborts response of loser and unblocks its reading
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.winner = None
+        self.closed = False
+        self.primary_proxy = None
+        self.hedge_future = None
+        self.aborts = {}
+
+    def register(self, attempt, abort):
+        """
+        Register open response of attempt
+        :param attempt: PRIMARY or HEDGE
+        :type attempt: str
+        :param abort: closes response and interrupts its reading
+        :type abort: callable
+        :raises HedgeCancelled: if other attempt already won
+        """
+        with self.lock:
+            if self.winner is None:
+                self.aborts[attempt] = abort
+                return
+        abort()
+        raise HedgeCancelled
+
+    def check(self, attempt):
+        """
+        :raises HedgeCancelled: if other attempt already won
+        """
+        if self.winner is not None and self.winner != attempt:
+            raise HedgeCancelled
+
+    def win(self, attempt):
+        """
+        Finish attempt successfully and abort response of other attempt
+        :return: True if attempt is first successful one
+        :rtype: bool
+        """
+        with self.lock:
+            if self.winner is not None:
+                return False
+            self.winner = attempt
+            losers = [abort for name, abort in self.aborts.items() if name != attempt]
+            self.aborts.clear()
+        for abort in losers:
+            try:
+                abort()
+            except Exception:
+                logging.debug('Except on closing hedge race loser', exc_info=True)
+        return True
+
+    def start_hedge(self, submit):
+        """
+        Start hedge if primary attempt is still running
+        :param submit: starts hedge and returns its future
+        :type submit: callable
+        :return: True if hedge is started
+        :rtype: bool
+        """
+        with self.lock:
+            # submit is made under lock, so primary attempt can't close race between check and submit
+            if self.closed or self.winner is not None:
+                return False
+            self.hedge_future = submit()
+            return self.hedge_future is not None
+
+    def close(self):
+        """
+        Mark primary attempt finished, hedge can't be started after it
+        :return: started hedge future or None
+        :rtype: concurrent.futures.Future, None
+        """
+        with self.lock:
+            self.closed = True
+            return self.hedge_future
+
+
+class Hedger:
+    """
+    Hedged requests policy: request which runs longer than percentile latency of recent requests gets duplicate
+    through other proxy, hedges count is limited by budget. Threaded downloader registers running requests
+    in monitor thread which starts hedges in executor lane when requests are late.
+    """
+    def __init__(self, lane=None, percentile=0.95, min_delay=1.0, max_delay=30.0, budget_ratio=0.05,
+                 budget_burst=10, stats_interval=30):
+        """
+        :param lane: executor lane for hedges of threaded downloader, not needed for async one
+        :type lane: helpers.executor.Lane, None
+        :param percentile: latency percentile after which request is hedged
+        :type percentile: float
+        :param min_delay: min seconds before hedge, fast site must not cause hedge storm
+        :type min_delay: float
+        :param max_delay: max seconds before hedge
+        :type max_delay: float
+        :param budget_ratio: max hedges per request
+        :type budget_ratio: float
+        :param budget_burst: hedges which can be made at once
+        :type budget_burst: float
+        :param stats_interval: seconds between stats logging
+        :type stats_interval: float
+        """
+        self.lane = lane
+        self.tracker = LatencyTracker(percentile)
+        self.budget = HedgeBudget(budget_ratio, budget_burst)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.stats_interval = stats_interval
+        self.stats_time = time.time()
+        self.counters = {'requests': 0, 'hedged': 0, 'hedge_won': 0, 'no_budget': 0, 'no_slot': 0}
+        # counters are changed by downloading threads and monitor thread
+        self.counters_lock = Lock()
+        self.condition = Condition()
+        # (hedge time, sequence, race, hedge func, hedge args) heap of watched requests
+        self.watched = []
+        self.sequence = itertools.count()
+        self.monitor_thread = None
+
+    def get_delay(self):
+        """
+        :return: seconds after request start when it is hedged, None until latency percentile is known
+        :rtype: float, None
+        """
+        value = self.tracker.value
+        if value is None:
+            return None
+        return min(max(value, self.min_delay), self.max_delay)
+
+    def on_request(self):
+        """Count request and add its share into hedge budget"""
+        self.count('requests')
+        self.budget.earn()
+        if time.time() - self.stats_time > self.stats_interval:
+            self.log_stats()
+
+    def record(self, latency):
+        """
+        :param latency: successful request time in seconds
+        :type latency: float
+        """
+        self.tracker.record(latency)
+
+    def try_hedge(self):
+        """
+        :return: True if budget allows one more hedge
+        :rtype: bool
+        """
+        if self.budget.try_spend():
+            self.count('hedged')
+            return True
+        self.count('no_budget')
+        return False
+
+    def cancel_hedge(self):
+        """Refund budget token of hedge which is allowed by try_hedge but is not started"""
+        self.budget.refund()
+        self.count('hedged', -1)
+
+    def on_hedge_won(self):
+        self.count('hedge_won')
+
+    def count(self, counter, value=1):
+        """
+        :param counter: counters key
+        :type counter: str
+        :param value: added value
+        :type value: int
+        """
+        with self.counters_lock:
+            self.counters[counter] += value
+
+    def watch(self, race, delay, func, *args):
+        """
+        Start hedge of threaded request in lane after delay if request is still running
+        :param race: race of request attempts
+        :type race: HedgeRace
+        :param delay: seconds before hedge
+        :type delay: float
+        :param func: hedge attempt, called with args in lane
+        :type func: callable
+        """
+        with self.condition:
+            if self.monitor_thread is None:
+                self.monitor_thread = Thread(target=self.monitor, name='hedge-monitor', daemon=True)
+                self.monitor_thread.start()
+            heapq.heappush(self.watched, (time.time() + delay, next(self.sequence), race, func, args))
+            if self.watched[0][2] is race:
+                self.condition.notify()
+
+    def monitor(self):
+        """Monitor loop, starts hedges of late requests"""
+        while True:
+            with self.condition:
+                while not self.watched or self.watched[0][0] > time.time():
+                    self.condition.wait(self.watched[0][0] - time.time() if self.watched else None)
+                _, _, race, func, args = heapq.heappop(self.watched)
+            if race.closed or race.winner is not None:
+                continue
+            if not self.try_hedge():
+                continue
+            # lane without free slot gives no hedge, queued hedge would be late anyway
+            if not race.start_hedge(lambda: self.lane.try_submit(func, *args)):
+                # token is refunded, request finished meanwhile or lane had no slot
+                self.cancel_hedge()
+                if not race.closed and race.winner is None:
+                    self.count('no_slot')
+
+    def log_stats(self):
+        """Log hedged requests share and hedges which won"""
+        now = time.time()
+        self.stats_time = now
+        with self.counters_lock:
+            counters = dict(self.counters)
+        logging.info('hedging: {} requests, {} hedged, {} hedges won, {} hedges without budget, {} without slot, '
+                     'hedge delay {}'.format(counters['requests'], counters['hedged'], counters['hedge_won'],
+                                             counters['no_budget'], counters['no_slot'],
+                                             '{:.2f} sec'.format(self.get_delay()) if self.tracker.value else
+                                             'unknown'))
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import struct
+import time
+import zlib
+from threading import Lock
+
+# batch header, compressed batch length
+BATCH_HEADER = struct.Struct('>I')
+
+
+class PageArchive:
+    """
+    Append-only archive of raw downloaded pages for offline re-extraction.
+    Pages are buffered into batches, every batch is zlib compressed json list appended to current segment file,
+    segment is rolled after segment_size bytes. Sqlite index maps url to page type and its latest batch position,
+    page is archived again only if its body is changed.
+    """
+    def __init__(self, path, page_types=(), batch_size=100, segment_size=256 * 1024 ** 2, compress_level=6):
+        """
+        :param path: archive directory, created if it doesn't exist
+        :type path: str
+        :param page_types: (page type, compiled url regex) pairs, first type which regex matches url is used
+        :type page_types: list, tuple
+        :param batch_size: pages in one compressed batch
+        :type batch_size: int
+        :param segment_size: max segment file size in bytes
+        :type segment_size: int
+        :param compress_level: zlib compression level
+        :type compress_level: int
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.page_types = list(page_types)
+        self.batch_size = batch_size
+        self.segment_size = segment_size
+        self.compress_level = compress_level
+        self.lock = Lock()
+        self.batch = []
+        self.archived = 0
+        self.connection = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS pages (
+                                       url TEXT PRIMARY KEY,
+                                       page_type TEXT,
+                                       body_hash TEXT NOT NULL,
+                                       segment INTEGER NOT NULL,
+                                       offset INTEGER NOT NULL,
+                                       length INTEGER NOT NULL,
+                                       fetched_at REAL NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS pages_batch ON pages (page_type, segment, offset)')
+        self.connection.commit()
+        # url -> body hash of archived pages, unchanged pages are skipped
+        self.hashes = dict(self.connection.execute('SELECT url, body_hash FROM pages'))
+        last_segment = self.connection.execute('SELECT MAX(segment) FROM pages').fetchone()[0]
+        self.segment = last_segment or 1
+
+    @staticmethod
+    def get_segment_path(path, segment):
+        return os.path.join(path, 'segment-{:06d}.bin'.format(segment))
+
+    def get_page_type(self, url):
+        """
+        :type url: str
+        :return: page type of url or None
+        :rtype: str, None
+        """
+        for page_type, regex in self.page_types:
+            if regex.search(url):
+                return page_type
+        return None
+
+    def add(self, url, body, encoding):
+        """
+        Archive downloaded page, batch is written when it is full
+        :param url: page url with query params
+        :type url: str
+        :param body: raw page body
+        :type body: bytes
+        :param encoding: body charset
+        :type encoding: str
+        """
+        body_hash = hashlib.sha1(body).hexdigest()
+        with self.lock:
+            if self.hashes.get(url) == body_hash:
+                return
+            self.hashes[url] = body_hash
+            self.batch.append((url, self.get_page_type(url), body_hash, time.time(),
+                               body.decode(encoding, errors='replace')))
+            if len(self.batch) >= self.batch_size:
+                self.flush_batch()
+
+    def flush_batch(self):
+        """Append buffered pages to segment and index them, must be called under lock"""
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        records = [{'url': url, 'page_type': page_type, 'fetched_at': fetched_at, 'body': body}
+                   for url, page_type, _, fetched_at, body in batch]
+        compressed = zlib.compress(json.dumps(records).encode('utf-8'), self.compress_level)
+        segment_path = self.get_segment_path(self.path, self.segment)
+        if os.path.exists(segment_path) and os.path.getsize(segment_path) + len(compressed) > self.segment_size:
+            self.segment += 1
+            segment_path = self.get_segment_path(self.path, self.segment)
+        with open(segment_path, 'ab') as segment_file:
+            offset = segment_file.tell()
+            segment_file.write(BATCH_HEADER.pack(len(compressed)))
+            segment_file.write(compressed)
+        # pages are indexed after batch is written, so index never points to missing data
+        self.connection.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    [(url, page_type, body_hash, self.segment, offset, len(compressed), fetched_at)
+                                     for url, page_type, body_hash, fetched_at, _ in batch])
+        self.connection.commit()
+        self.archived += len(batch)
+        logging.debug('{} pages archived into {} segment'.format(len(batch), self.segment))
+
+    def flush(self):
+        with self.lock:
+            self.flush_batch()
+
+    def get_batches(self, page_type):
+        """
+        Positions of batches with latest versions of pages of type
+        :param page_type: page type from page_types
+        :type page_type: str
+        :return: (segment, offset, length, urls) tuples in segments order, urls are pages of batch to extract
+        :rtype: list
+        """
+        with self.lock:
+            rows = self.connection.execute('''SELECT segment, offset, length, url FROM pages WHERE page_type=?
+                                              ORDER BY segment, offset''', (page_type,)).fetchall()
+        batches = []
+        for segment, offset, length, url in rows:
+            if batches and batches[-1][:2] == (segment, offset):
+                batches[-1][3].append(url)
+            else:
+                batches.append((segment, offset, length, [url]))
+        return batches
+
+    @staticmethod
+    def read_batch(path, segment, offset, length):
+        """
+        Read batch without index, so it can be called in worker process
+        :param path: archive directory
+        :type path: str
+        :return: page records with url, page_type, fetched_at and body keys
+        :rtype: list
+        """
+        with open(PageArchive.get_segment_path(path, segment), 'rb') as segment_file:
+            segment_file.seek(offset + BATCH_HEADER.size)
+            return json.loads(zlib.decompress(segment_file.read(length)).decode('utf-8'))
+
+    def close(self):
+        with self.lock:
+            self.flush_batch()
+            logging.info('{} pages archived, {} pages in archive'.format(self.archived, len(self.hashes)))
+            self.connection.close()
@@ -0,0 +1,92 @@
+import logging
+import os
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class ParquetExporter:
+    """
+    Writes rows into partitioned parquet dataset: <directory>/<partition>/part-<time>.parquet.
+    Every export run creates new file, so downstream reads only files added since its previous load.
+    """
+    def __init__(self, directory, schema, dictionary_columns=(), batch_size=10000, compression='snappy'):
+        """
+        :param directory: dataset root directory
+        :type directory: str
+        :param schema: list of (column, pyarrow type) tuples
+        :type schema: list
+        :param dictionary_columns: repetitive string columns stored with dictionary encoding
+        :type dictionary_columns: list, tuple
+        :param batch_size: rows in one row group, memory usage is bounded by it
+        :type batch_size: int
+        :param compression: parquet compression codec
+        :type compression: str
+        """
+        self.directory = directory
+        self.schema = pa.schema(schema)
+        self.dictionary_columns = list(dictionary_columns)
+        self.batch_size = batch_size
+        self.compression = compression
+
+    def make_table(self, rows):
+        """
+        :param rows: list of dicts, missing fields are stored as nulls
+        :type rows: list
+        :rtype: pyarrow.Table
+        """
+        columns = {name: [row.get(name) for row in rows] for name in self.schema.names}
+        return pa.Table.from_pydict(columns, schema=self.schema)
+
+    def export(self, rows, partition):
+        """
+        Write rows into new file of partition
+        :param rows: dicts iterator
+        :type rows: iterable
+        :param partition: partition directory name, e.g. export_date=2020-01-01
+        :type partition: str
+        :return: written rows count
+        :rtype: int
+        """
+        start_time = time.time()
+        partition_directory = os.path.join(self.directory, partition)
+        base_name = 'part-{}.parquet'.format(int(start_time * 1000))
+        file_name = os.path.join(partition_directory, base_name)
+        # readers never see partially written file, dataset readers skip files starting with underscore
+        tmp_file_name = os.path.join(partition_directory, '_{}.tmp'.format(base_name))
+        writer = None
+        count = 0
+        batch = []
+        try:
+            for row in rows:
+                batch.append(row)
+                if len(batch) < self.batch_size:
+                    continue
+                writer = writer or self.open_writer(tmp_file_name)
+                writer.write_table(self.make_table(batch))
+                count += len(batch)
+                batch = []
+            if batch:
+                writer = writer or self.open_writer(tmp_file_name)
+                writer.write_table(self.make_table(batch))
+                count += len(batch)
+        except Exception:
+            if writer is not None:
+                writer.close()
+                os.remove(tmp_file_name)
+            raise
+        if writer is not None:
+            writer.close()
+            os.replace(tmp_file_name, file_name)
+        logging.info('{} rows exported into {} ({:.1f} sec)'.format(count, partition_directory,
+                                                                   time.time() - start_time))
+        return count
+
+    def open_writer(self, file_name):
+        """
+        :type file_name: str
+        :rtype: pyarrow.parquet.ParquetWriter
+        """
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        return pq.ParquetWriter(file_name, self.schema, compression=self.compression,
+                                use_dictionary=self.dictionary_columns or False)
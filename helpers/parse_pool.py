@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from threading import Lock
+
+
+def warm_up(_):
+    """Empty task for starting worker processes"""
+    return os.getpid()
+
+
+class ParsePool:
+    """
+    Process pool for CPU bound html extraction, so parsing is not limited by GIL of downloading threads.
+    I/O threads hand page html to pool and wait for extracted data, functions and their arguments must be picklable
+    (module level functions or static methods).
+    """
+    def __init__(self, processes=None):
+        """
+        :param processes: worker processes count, cpu count by default
+        :type processes: int, None
+        """
+        self.processes = processes or os.cpu_count()
+        self.lock = Lock()
+        self.executor = self.create_executor()
+
+    @staticmethod
+    def get_mp_context():
+        """
+        Workers are started by forkserver (spawn where it is not supported), so pool can be restarted
+        while downloading threads hold locks, forked worker could inherit them locked
+        :rtype: multiprocessing.context.BaseContext
+        """
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return multiprocessing.get_context(start_method)
+
+    def create_executor(self):
+        """
+        Start worker processes
+        :rtype: ProcessPoolExecutor
+        """
+        if sys.version_info >= (3, 7):
+            executor = ProcessPoolExecutor(self.processes, mp_context=self.get_mp_context())
+        else:
+            # python 3.6 executor always forks, so pool must be created before threads are started
+            executor = ProcessPoolExecutor(self.processes)
+        # processes are started on first task
+        list(executor.map(warm_up, range(self.processes)))
+        logging.info('Parse pool with {} processes started'.format(self.processes))
+        return executor
+
+    def run(self, func, *args):
+        """
+        Run func in worker process and wait for its result
+        :param func: picklable function
+        :type func: callable
+        :return: func result, func exception is raised in caller thread
+        """
+        executor = self.executor
+        try:
+            return executor.submit(func, *args).result()
+        except BrokenProcessPool:
+            # worker was killed, e.g. by OOM killer, pool is recreated and task is repeated once
+            self.restart(executor)
+            return self.executor.submit(func, *args).result()
+
+    def imap_unordered(self, func, tasks, max_pending=None):
+        """
+        Run func on every args tuple in worker processes, new task is submitted as soon as any task is finished,
+        so pickled arguments and results of not consumed tasks are not piled up in memory
+        :param func: picklable function
+        :type func: callable
+        :param tasks: func args tuples
+        :type tasks: iterable
+        :param max_pending: max submitted and not yielded tasks, twice processes count by default
+        :type max_pending: int, None
+        :return: func results as soon as they are ready
+        :rtype: generator
+        """
+        max_pending = max_pending or self.processes * 2
+        futures = set()
+        for args in tasks:
+            futures.add(self.executor.submit(func, *args))
+            if len(futures) >= max_pending:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(futures):
+            yield future.result()
+
+    async def run_async(self, func, *args):
+        """
+        Coroutine version of run, event loop is not blocked while page is parsed
+        :param func: picklable function
+        :type func: callable
+        :return: func result
+        """
+        executor = self.executor
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(executor, partial(func, *args))
+        except BrokenProcessPool:
+            self.restart(executor)
+            return await loop.run_in_executor(self.executor, partial(func, *args))
+
+    def restart(self, broken_executor):
+        """
+        Replace broken executor, only first thread which found it broken recreates it
+        :type broken_executor: ProcessPoolExecutor
+        """
+        with self.lock:
+            if self.executor is broken_executor:
+                logging.error('Parse pool is broken, restarting it')
+                broken_executor.shutdown(wait=False)
+                self.executor = self.create_executor()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+class PoolParsingMixin:
+    """Runs static extraction methods in parse_pool attribute if it is set, otherwise in current thread"""
+    parse_pool = None
+
+    def parse(self, func, *args):
+        """
+        Run extraction function in parse pool if it is set, otherwise in current thread
+        :param func: static extraction method
+        :type func: callable
+        :return: func result
+        """
+        if self.parse_pool is not None:
+            return self.parse_pool.run(func, *args)
+        return func(*args)
+
+    async def parse_async(self, func, *args):
+        """
+        Coroutine version of parse
+        :param func: static extraction method
+        :type func: callable
+        :return: func result
+        """
+        if self.parse_pool is not None:
+            return await self.parse_pool.run_async(func, *args)
+        return func(*args)
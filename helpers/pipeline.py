@@ -0,0 +1,175 @@
+import logging
+import queue
+import time
+import traceback
+from concurrent.futures import wait
+from threading import Lock, Thread
+
+# marks end of stage input
+STOP = object()
+
+
+class Stage:
+    def __init__(self, name, func, workers, queue_size=None, batch_size=None, batch_timeout=1.0, lane=None):
+        """
+        Pipeline stage, every worker takes items from stage input queue and puts func result into next stage queue
+        :param name: stage name for logging
+        :type name: str
+        :param func: item handler, returns item for next stage or None to drop it
+        :type func: callable
+        :param workers: stage concurrency
+        :type workers: int
+        :param queue_size: input queue size, producers are blocked when queue is full, workers * 2 by default
+        :type queue_size: int, None
+        :param batch_size: if set, func receives list of items with up to batch_size length
+        :type batch_size: int, None
+        :param batch_timeout: max time in seconds to wait for full batch
+        :type batch_timeout: float
+        :param lane: executor lane which runs stage workers, every worker holds lane slot until stage is finished,
+            so lane must be able to run all workers at once. Workers are own threads if not set
+        :type lane: str, None
+        """
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size or workers * 2)
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.lane = lane
+        self.processed = 0
+        self.errors = 0
+        self.finished_workers = 0
+        self.lock = Lock()
+
+
+class Pipeline:
+    """
+    Staged producer/consumer pipeline connected by bounded queues.
+    Items flow through stages one by one, so slow item never blocks other workers
+    and full queue of next stage slows down previous one (backpressure).
+    """
+    def __init__(self, executor=None):
+        """
+        :param executor: executor for workers of stages with lane
+        :type executor: helpers.executor.LaneExecutor, None
+        """
+        self.executor = executor
+        self.stages = []
+
+    def add_stage(self, name, func, workers, queue_size=None, batch_size=None, batch_timeout=1.0, lane=None):
+        """
+        Append stage to pipeline, see Stage for params
+        :return: pipeline for chaining
+        :rtype: Pipeline
+        """
+        if lane is not None and self.executor is None:
+            raise ValueError(f'{name} stage lane is set, but pipeline has no executor')
+        self.stages.append(Stage(name, func, workers, queue_size, batch_size, batch_timeout, lane))
+        return self
+
+    def run(self, items):
+        """
+        Feed items into first stage and wait until all stages are finished
+        :param items: first stage items
+        :type items: iterable
+        :return: processed items count for every stage
+        :rtype: dict
+        """
+        threads = []
+        futures = []
+        for n, stage in enumerate(self.stages):
+            next_stage = self.stages[n + 1] if n + 1 < len(self.stages) else None
+            for worker_number in range(stage.workers):
+                if stage.lane is not None:
+                    futures.append(self.executor.submit(stage.lane, self.work, stage, next_stage))
+                    continue
+                thread = Thread(target=self.work, args=(stage, next_stage), name=f'{stage.name}-{worker_number}',
+                                daemon=True)
+                thread.start()
+                threads.append(thread)
+        first_stage = self.stages[0]
+        start_time = time.time()
+        for n, item in enumerate(items):
+            # blocks when first stage is saturated
+            first_stage.queue.put(item)
+            if (n + 1) % 1000 == 0:
+                self.log_stats(n + 1, start_time)
+        for _ in range(first_stage.workers):
+            first_stage.queue.put(STOP)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=60)
+                if thread.is_alive():
+                    self.log_stats(None, start_time)
+        for future in futures:
+            while not wait([future], timeout=60).done:
+                self.log_stats(None, start_time)
+        self.log_stats(None, start_time)
+        return {stage.name: stage.processed for stage in self.stages}
+
+    def log_stats(self, fed_count, start_time):
+        """Log progress of every stage"""
+        stats = ', '.join('{}: {} done, {} errors, {} queued'.format(stage.name, stage.processed, stage.errors,
+                                                                     stage.queue.qsize()) for stage in self.stages)
+        fed = f'{fed_count} items fed, ' if fed_count is not None else ''
+        logging.info('pipeline {}{} ({:.0f} sec)'.format(fed, stats, time.time() - start_time))
+
+    def work(self, stage, next_stage):
+        """Stage worker loop"""
+        while True:
+            items, stop = self.take(stage)
+            if items:
+                self.process(stage, next_stage, items)
+            if stop:
+                break
+        with stage.lock:
+            stage.finished_workers += 1
+            last_worker = stage.finished_workers == stage.workers
+        if last_worker and next_stage is not None:
+            # previous stage is finished, so next stage workers can stop after draining queue
+            for _ in range(next_stage.workers):
+                next_stage.queue.put(STOP)
+
+    @staticmethod
+    def take(stage):
+        """
+        Take single item or batch of items from stage queue
+        :return: items list and stop flag
+        :rtype: tuple
+        """
+        item = stage.queue.get()
+        if item is STOP:
+            return [], True
+        items = [item]
+        if stage.batch_size:
+            deadline = time.time() + stage.batch_timeout
+            while len(items) < stage.batch_size:
+                try:
+                    item = stage.queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item is STOP:
+                    return items, True
+                items.append(item)
+        return items, False
+
+    @staticmethod
+    def process(stage, next_stage, items):
+        """Run stage func and pass results to next stage"""
+        try:
+            if stage.batch_size:
+                results = [stage.func(items)]
+            else:
+                results = [stage.func(item) for item in items]
+        except Exception:
+            logging.error(traceback.format_exc())
+            logging.error(f'Receive exception on {stage.name} stage')
+            with stage.lock:
+                stage.errors += len(items)
+            return
+        with stage.lock:
+            stage.processed += len(items)
+        if next_stage is not None:
+            for result in results:
+                if result is not None:
+                    next_stage.queue.put(result)
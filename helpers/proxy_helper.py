@@ -1,11 +1,16 @@
 import requests
+import aiohttp
+import asyncio
 import logging
 import time
 from helpers.helpers import chunkify, parse_config
-from multiprocessing.pool import ThreadPool
-from threading import RLock
-from requests.exceptions import ProxyError, ConnectTimeout
-import pandas as pd
+from helpers.executor import LaneExecutor
+from helpers.hedging import HedgeCancelled
+from helpers.proxy_pool import ProxyPool, ProxyPoolTimeout
+from helpers.proxy_store import ProxyScoreStore
+from helpers.rate_limiter import RateLimiter
+from threading import Event, RLock, Thread
+from requests.exceptions import ProxyError, Timeout
 import os
 import csv
 import gc
@@ -17,16 +22,105 @@ class BadProxyError(Exception):
         pass
 
 
+class BanError(BadProxyError):
+    """Site refused request through proxy, signal to slow down requests to site"""
+
+
+class SiteError(Exception):
+    """Site answered with server error, request can succeed later"""
+    def __init__(self, status):
+        super().__init__('site answered with {} status'.format(status))
+        self.status = status
+
+
+class PermanentError(Exception):
+    """Request can't succeed, e.g. page is not found, so it is not retried"""
+    def __init__(self, status):
+        super().__init__('site answered with {} status'.format(status))
+        self.status = status
+
+
+# errors which are caused by proxy, not by target site
+PROXY_ERRORS = (ProxyError, BadProxyError, aiohttp.ClientProxyConnectionError, aiohttp.ClientHttpProxyError)
+# connect and read timeouts, slow or stalled proxy gives them, without proxy they are caused by site
+TIMEOUT_ERRORS = (Timeout, aiohttp.ServerTimeoutError, asyncio.TimeoutError)
+
+# request failure kinds
+PROXY_FAILURE = 'proxy'
+SITE_FAILURE = 'site'
+PERMANENT_FAILURE = 'permanent'
+CANCELLED_FAILURE = 'cancelled'
+
+
+def raise_for_status(status):
+    """
+    Raise error of failed response status
+    :param status: response status code
+    :type status: int
+    """
+    if status in (403, 429):
+        # site refused request through proxy
+        raise BanError
+    if status == 407:
+        raise BadProxyError
+    if status >= 500 or status == 408:
+        raise SiteError(status)
+    if status >= 400:
+        raise PermanentError(status)
+
+
+def classify_error(exception, proxied=True):
+    """
+    :param exception: request exception
+    :type exception: BaseException
+    :param proxied: failed attempt was made through proxy
+    :type proxied: bool
+    :return: PROXY_FAILURE, request must be retried through other proxy at once, SITE_FAILURE, request must be
+        retried after backoff, PERMANENT_FAILURE, request must not be retried, or CANCELLED_FAILURE
+    :rtype: str
+    """
+    if isinstance(exception, (asyncio.CancelledError, HedgeCancelled)):
+        return CANCELLED_FAILURE
+    if isinstance(exception, PermanentError):
+        return PERMANENT_FAILURE
+    if isinstance(exception, PROXY_ERRORS + (ProxyPoolTimeout,)):
+        return PROXY_FAILURE
+    if isinstance(exception, TIMEOUT_ERRORS) and proxied:
+        return PROXY_FAILURE
+    return SITE_FAILURE
+
+
 class ProxyHelper:
-    def __init__(self, check_url, use_proxy=True, request_per_min=20):
+    def __init__(self, check_url, use_proxy=True, request_per_min=None, proxy_cache_max_age=3600, min_proxies=50,
+                 max_proxies=300, executor=None):
         self.user_agents_list = self.load_user_agents()
         self.request_per_min = request_per_min
+        # adaptive per host limits and opt-in per proxy request_per_min buckets, shared by all downloaders of helper
+        self.rate_limiter = RateLimiter(request_per_min)
+        # callbacks called with deleted proxy
+        self.on_proxy_delete = [self.rate_limiter.remove_proxy]
         self.check_url = check_url
         self.config = parse_config('server')
-        self.proxy_pool = ThreadPool(100)
-        if use_proxy:
-            self.get_valid_proxies()
+        # proxies are checked in proxy-check lane of shared executor, so checks and crawl have common threads cap
+        if executor is None:
+            executor = LaneExecutor(100, name='proxy-check').add_lane('proxy-check', 100)
+        self.check_lane = executor.lane('proxy-check')
+        self.proxies = ProxyPool()
+        # lock only guards replenisher start, proxy scheduling is synchronized inside ProxyPool
         self.lock = RLock()
+        self.proxy_store = ProxyScoreStore()
+        # proxies validated less than max age seconds ago are used without checking
+        self.proxy_cache_max_age = proxy_cache_max_age
+        # pool is replenished in background when it has less than min_proxies and up to max_proxies
+        self.min_proxies = min_proxies
+        self.max_proxies = max_proxies
+        self.replenish_event = Event()
+        # seconds between writes of buffered proxy errors into proxy store by replenisher
+        self.failures_flush_interval = 10
+        self.replenisher_thread = None
+        if use_proxy:
+            self.load_cached_proxies()
+            self.start_replenisher()
 
     def mark_proxy_as_failed(self, proxy):
         """
@@ -35,22 +129,23 @@ class ProxyHelper:
         :type proxy: str
         """
         logging.info(f'marking proxy {proxy}')
-        self.proxies.at[proxy, 'previous_error_time'] = time.time()
-        self.proxies.at[proxy, 'error_count'] += 1
-        if int(self.proxies.at[proxy, 'error_count']) >= 5:
+        self.proxy_store.record_failure(proxy)
+        if self.proxies.mark_failed(proxy):
             self.delete_proxy(proxy)
 
     def delete_proxy(self, proxy):
         """
-        Deleting proxy from proxies dataframe
+        Deleting proxy from proxies pool
         :param proxy: proxy string with {ip}:{port} pattern
         :type proxy: str
         """
         logging.info('removing proxy {}'.format(proxy))
-        self.proxies = self.proxies.drop(index=proxy)
-        if len(self.proxies) == 0:
-            logging.info('proxy list is empty, getting new proxies')
-            self.proxies = self.get_valid_proxies()
+        self.proxies.remove(proxy)
+        for callback in self.on_proxy_delete:
+            callback(proxy)
+        if len(self.proxies) < self.min_proxies and not self.replenish_event.is_set():
+            logging.info('proxy pool is below {} proxies, waking up replenisher'.format(self.min_proxies))
+            self.replenish_event.set()
 
     def exception_decorator(self, func):
         """
@@ -60,78 +155,186 @@ class ProxyHelper:
             try:
                 request_start_time = time.time()
                 result = func(proxy, *args, **kwargs)
-                request_time = time.time() - request_start_time
-                with self.lock:
-                    # proxy can be deleted from dataframe by another thread, so we need to check if it in still
-                    if proxy and proxy in self.proxies.index:
-                        self.proxies.at[proxy, 'previous_request_time'] = request_time
-                with self.lock:
-                    if proxy and proxy in self.proxies.index:
-                        # decrease on_work variable for limiting proxy usage for 5 threads only
-                        self.proxies.at[proxy, 'on_work'] -= 1
+                self.release_proxy(proxy, time.time() - request_start_time)
                 return result
             except Exception as e:
-                with self.lock:
-                    if proxy and proxy in self.proxies.index:
-                        self.proxies.at[proxy, 'on_work'] -= 1
-                        if isinstance(e, (ProxyError, ConnectTimeout, BadProxyError)):
-                            # marking proxy only if it error by proxy errors
-                            self.mark_proxy_as_failed(proxy)
+                self.release_failed_proxy(proxy, e)
                 raise
         return wrapper
 
-    def get_proxy(self):
+    def async_exception_decorator(self, func):
+        """
+        Decorator for error tracking of coroutine functions
+        """
+        async def wrapper(*args, proxy, **kwargs):
+            try:
+                request_start_time = time.time()
+                result = await func(proxy, *args, **kwargs)
+                self.release_proxy(proxy, time.time() - request_start_time)
+                return result
+            except (Exception, asyncio.CancelledError) as e:
+                # cancelled attempt of hedged request must return proxy too, CancelledError is not Exception since 3.8
+                self.release_failed_proxy(proxy, e)
+                raise
+        return wrapper
+
+    def release_proxy(self, proxy, request_time):
+        """
+        Return proxy to pool after successful request
+        :param proxy: proxy string with {ip}:{port} pattern
+        :type proxy: str, None
+        :param request_time: request duration in seconds
+        :type request_time: float
+        """
+        if proxy:
+            # decrease on_work variable for limiting proxy usage for 5 threads only
+            self.proxies.release(proxy, request_time)
+
+    def release_failed_proxy(self, proxy, exception):
+        """
+        Return proxy to pool after failed request
+        :param proxy: proxy string with {ip}:{port} pattern
+        :type proxy: str, None
+        :param exception: exception raised by request
+        :type exception: Exception
+        """
+        if proxy:
+            if isinstance(exception, PROXY_ERRORS + TIMEOUT_ERRORS):
+                # marking proxy only if it error by proxy errors, before release so it goes straight to cooldown
+                self.mark_proxy_as_failed(proxy)
+            self.proxies.release(proxy)
+
+    def take_proxy(self):
+        """
+        Getting best free proxy without waiting
+        :return: valid to use proxy or None if all proxies are busy
+        :rtype: str, None
+        """
+        # getting fastest proxy which used less than 5 threads and get error more than 1 min ago
+        return self.proxies.acquire(block=False)
+
+    def take_other_proxy(self, excluded_proxy):
+        """
+        Getting best free proxy other than excluded one without waiting, e.g. for hedge of request through it
+        :param excluded_proxy: proxy string with {ip}:{port} pattern
+        :type excluded_proxy: str, None
+        :return: proxy or None if there is no other free proxy
+        :rtype: str, None
+        """
+        # proxy serves several requests at once, so excluded one can be taken few times before other one,
+        # loop is finite because excluded proxy is saturated after max_on_work takes
+        taken = []
+        proxy = self.take_proxy()
+        while proxy is not None and proxy == excluded_proxy:
+            taken.append(proxy)
+            proxy = self.take_proxy()
+        for excluded in taken:
+            self.proxies.release(excluded)
+        return proxy
+
+    def get_proxy(self, timeout=None):
+        """
+        Getting best free proxy, if all proxies are busy waits until one of them is released or cooled down
+        :param timeout: max waiting time in seconds, None means wait forever
+        :type timeout: float, None
+        :return valid to use proxy
+        :rtype: str
+        :raises ProxyPoolTimeout: if no proxy became free during timeout
+        """
+        return self.proxies.acquire(timeout=timeout)
+
+    async def get_proxy_async(self, timeout=None):
         """
-        Getting best free proxy
+        Getting best free proxy without blocking event loop
+        :param timeout: max waiting time in seconds, None means wait forever
+        :type timeout: float, None
         :return valid to use proxy
         :rtype: str
+        :raises ProxyPoolTimeout: if no proxy became free during timeout
+        """
+        return await self.proxies.acquire_async(timeout=timeout)
+
+    def load_cached_proxies(self):
+        """Add recently validated proxies from local store to pool, so requests can start immediately"""
+        cached_proxies = self.proxy_store.load_fresh(self.proxy_cache_max_age)
+        for address, request_time in cached_proxies:
+            self.proxies.add(address, request_time)
+        logging.info('loaded {} recently validated proxies from cache'.format(len(cached_proxies)))
+
+    def start_replenisher(self):
+        """
+        Validate new and stale proxies in background thread.
+        Requests use cached proxies meanwhile, or wait in get_proxy until first proxy is validated
         """
-        attempt = 0
+        with self.lock:
+            if self.replenisher_thread is not None and self.replenisher_thread.is_alive():
+                return
+            self.replenisher_thread = Thread(target=self.replenish_proxies, name='proxy-replenisher', daemon=True)
+            self.replenisher_thread.start()
+
+    def replenish_proxies(self):
+        """
+        Replenisher loop, keeps pool between min_proxies and max_proxies.
+        Wakes up when pool drops below min_proxies or when cached proxies become stale,
+        buffered proxy errors are written every failures_flush_interval seconds
+        """
+        next_replenish_time = 0
         while True:
+            if self.replenish_event.is_set() or time.time() >= next_replenish_time:
+                self.replenish_event.clear()
+                try:
+                    if len(self.proxies) < self.max_proxies:
+                        self.get_valid_proxies()
+                except Exception:
+                    logging.error('Except on proxies replenishing', exc_info=True)
+                # retry soon if proxy service gave nothing, workers are waiting for proxies
+                timeout = 30 if len(self.proxies) < self.min_proxies else self.proxy_cache_max_age
+                next_replenish_time = time.time() + timeout
             try:
-                with self.lock:
-                    self.sort_proxies()
-                    # getting proxies only which used less than 5 threads and get error more than 1 min ago
-                    mask = ((time.time() - self.proxies['previous_error_time']) > 60) & (self.proxies['on_work'] < 5)
-                    chosen_proxy = list(self.proxies.loc[mask].iterrows())[0][0]
-                    self.proxies.at[chosen_proxy, 'on_work'] += 1
-                    break
-            except IndexError:
-                # if we have no valid proxy. need to wait when it gets free
-                logging.debug(f"Can\'t get proxy on {attempt} retry")
-                time.sleep(0.5)
-                attempt += 1
-        return chosen_proxy
-
-    def sort_proxies(self):
-        """Sort proxies by best response time"""
-        self.proxies = self.proxies.sort_values('on_work').sort_values('previous_request_time')
+                self.proxy_store.flush_failures()
+            except Exception:
+                logging.error('Except on proxy errors writing', exc_info=True)
+            self.replenish_event.wait(min(max(next_replenish_time - time.time(), 0), self.failures_flush_interval))
+
+    def get_validation_candidates(self):
+        """
+        Proxies which must be checked: recently validated ones which left the pool, stale cached ones
+        and new ones from proxy service
+        :return: proxies list
+        :rtype: list
+        """
+        # fresh proxies are out of pool after failures or pool restart, they are checked first as most likely valid
+        fresh_proxies = [address for address, _ in self.proxy_store.load_fresh(self.proxy_cache_max_age)]
+        candidates = fresh_proxies + self.proxy_store.load_stale(self.proxy_cache_max_age) + self.get_proxies_list()
+        # dict keeps order and removes duplicates
+        candidates = list(dict.fromkeys(proxy for proxy in candidates if proxy and proxy not in self.proxies))
+        return candidates[:1000]
 
     def get_valid_proxies(self):
         """
         Proxy validation check
         """
-        # loads all proxies from chosen proxy service
-        proxies_list = self.get_proxies_list()[:1000]
-        chunks = list(chunkify(proxies_list, 500))
-        valid_proxies = {}
+        proxies_list = self.get_validation_candidates()
+        # small batches to stop soon after high water mark is reached
+        chunks = list(chunkify(proxies_list, 100))
+        valid_proxies_count = 0
         for n, chunk in enumerate(chunks):
+            if len(self.proxies) >= self.max_proxies:
+                logging.info('proxy pool is full, stop checking')
+                break
             logging.info('checking {}/{} proxy batch for {}'.format(n + 1, len(chunks), self.check_url))
-            # Check proxy batch
-            checked_proxies = list(self.proxy_pool.map(self.check_proxy, chunk))
+            checked_proxies = []
+            # every valid proxy is available for requests right after its check
+            for proxy in self.check_lane.imap_unordered(self.check_proxy, chunk):
+                checked_proxies.append(proxy)
+                if proxy['is_valid']:
+                    self.proxies.add(proxy['address'], proxy['request_time'])
+                    valid_proxies_count += 1
+            self.proxy_store.record_checks(checked_proxies)
+            del checked_proxies
             gc.collect()
-            # add primary proxy parameters
-            valid_batch_proxies = {proxy['address']: {'previous_request_time': proxy['request_time'],
-                                                      'error_count': 0,
-                                                      'on_work': 0,
-                                                      'previous_error_time': 0} for proxy in checked_proxies if
-                                   proxy['is_valid']}
-            valid_proxies.update(valid_batch_proxies)
-        del checked_proxies
-        # convert proxy dict into dataframe
-        self.proxies = pd.DataFrame.from_dict(valid_proxies, orient='index')
-        logging.info('proxy checking finished, found {} valid proxies'.format(len(self.proxies)))
-        self.sort_proxies()
+        logging.info('proxy checking finished, found {} valid proxies, {} in pool'.format(valid_proxies_count,
+                                                                                          len(self.proxies)))
 
     @staticmethod
     def load_user_agents():
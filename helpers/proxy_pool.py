@@ -0,0 +1,405 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from threading import Event, Lock
+
+
+# proxy circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class ProxyPoolTimeout(Exception):
+    """No proxy became free during acquire timeout"""
+
+
+class ThreadWaiter:
+    """Waiting thread handle, woken up by pool under its lock"""
+    def __init__(self):
+        self.event = Event()
+
+    def wake(self):
+        self.event.set()
+
+    def clear(self):
+        self.event.clear()
+
+    def wait(self, timeout):
+        self.event.wait(timeout)
+
+
+class AsyncWaiter:
+    """Waiting coroutine handle, can be woken up from any thread"""
+    def __init__(self):
+        self.loop = asyncio.get_event_loop()
+        self.event = asyncio.Event()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    def clear(self):
+        self.event.clear()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class ProxyState:
+    """Mutable proxy statistics, same fields as the former proxies dataframe columns"""
+    __slots__ = ('address', 'previous_request_time', 'error_count', 'on_work', 'previous_error_time', 'entry_id',
+                 'circuit', 'open_until', 'consecutive_failures', 'open_count')
+
+    def __init__(self, address, previous_request_time):
+        self.address = address
+        self.previous_request_time = previous_request_time
+        self.error_count = 0
+        self.on_work = 0
+        self.previous_error_time = 0
+        # id of the only valid heap entry of this proxy, None when proxy is saturated (in-use bucket)
+        self.entry_id = None
+        # circuit breaker: closed proxy is used, open one rests until open_until, half-open one gets single probe
+        self.circuit = CLOSED
+        self.open_until = 0
+        self.consecutive_failures = 0
+        # openings since last success, cooldown doubles with every one
+        self.open_count = 0
+
+
+class ProxyPool:
+    """
+    Proxy scheduler with O(log n) acquire/release/fail.
+    Free proxies live in a heap keyed on (latency, on_work), proxies with open circuit live in cooldown heap keyed on
+    cooldown end, proxies used by max_on_work threads are kept out of heaps until release.
+    Every proxy has circuit breaker: failure_threshold failures in a row open it for error_cooldown seconds,
+    then proxy is half-open and gets single probe request. Successful probe closes circuit, failed one opens it
+    again for twice longer, proxy which circuit is opened more than max_opens times in a row must be deleted.
+    Heap entries are invalidated lazily: every state change pushes new entry and stale ones are skipped on pop.
+    Acquirers which find no free proxy wait in FIFO queue and are woken up on release or cooldown end.
+    """
+    def __init__(self, max_on_work=5, error_cooldown=60, failure_threshold=2, max_opens=4, max_cooldown=600):
+        """
+        :param max_on_work: max concurrent requests through proxy
+        :type max_on_work: int
+        :param error_cooldown: seconds of first circuit opening
+        :type error_cooldown: float
+        :param failure_threshold: failures in a row which open circuit
+        :type failure_threshold: int
+        :param max_opens: circuit openings in a row after which proxy must be deleted
+        :type max_opens: int
+        :param max_cooldown: max seconds of circuit opening
+        :type max_cooldown: float
+        """
+        self.max_on_work = max_on_work
+        self.error_cooldown = error_cooldown
+        self.failure_threshold = failure_threshold
+        self.max_opens = max_opens
+        self.max_cooldown = max_cooldown
+        # lock is held only for heap operations, never for network or sorting
+        self._lock = Lock()
+        self._states = {}
+        self._available = []
+        self._cooldown = []
+        self._entry_ids = itertools.count()
+        self._waiters = deque()
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, address):
+        return address in self._states
+
+    def __iter__(self):
+        return iter(list(self._states))
+
+    def get(self, address):
+        """
+        :param address: proxy string with {ip}:{port} pattern
+        :type address: str
+        :return: proxy state or None if proxy not in pool
+        :rtype: ProxyState, None
+        """
+        return self._states.get(address)
+
+    def add(self, address, previous_request_time):
+        """
+        Add proxy to pool or update latency of existing one
+        :param address: proxy string with {ip}:{port} pattern
+        :type address: str
+        :param previous_request_time: proxy check time
+        :type previous_request_time: float
+        """
+        with self._lock:
+            state = self._states.get(address)
+            if state is None:
+                state = ProxyState(address, previous_request_time)
+                self._states[address] = state
+            else:
+                state.previous_request_time = previous_request_time
+            if state.circuit != OPEN:
+                self._push_available(state)
+            self._wake_head()
+
+    def remove(self, address):
+        """
+        Remove proxy from pool, its heap entries become stale
+        :return: True if proxy was in pool
+        :rtype: bool
+        """
+        with self._lock:
+            return self._states.pop(address, None) is not None
+
+    def acquire(self, block=True, timeout=None):
+        """
+        Take best free proxy and increase its on_work counter, waiting for release if all proxies are busy
+        :param block: wait for free proxy, if False return None immediately
+        :type block: bool
+        :param timeout: max waiting time in seconds, None means wait forever
+        :type timeout: float, None
+        :return: proxy or None if block is False and all proxies are busy or cooling
+        :rtype: str, None
+        """
+        with self._lock:
+            # new acquirers must not overtake already waiting ones
+            if not self._waiters:
+                proxy = self._take(time.time())
+                if proxy is not None:
+                    return proxy
+            if not block:
+                return None
+            waiter = ThreadWaiter()
+            self._waiters.append(waiter)
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            while True:
+                proxy, wait_time = self._try_waiting_acquire(waiter, deadline)
+                if proxy is not None:
+                    return proxy
+                waiter.wait(wait_time)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    async def acquire_async(self, timeout=None):
+        """
+        Coroutine version of acquire, waits without blocking event loop
+        :param timeout: max waiting time in seconds, None means wait forever
+        :type timeout: float, None
+        :return: proxy
+        :rtype: str
+        """
+        with self._lock:
+            if not self._waiters:
+                proxy = self._take(time.time())
+                if proxy is not None:
+                    return proxy
+            waiter = AsyncWaiter()
+            self._waiters.append(waiter)
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            while True:
+                proxy, wait_time = self._try_waiting_acquire(waiter, deadline)
+                if proxy is not None:
+                    return proxy
+                await waiter.wait(wait_time)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    def release(self, address, previous_request_time=None):
+        """
+        Decrease proxy on_work counter, successful request updates proxy latency and closes its circuit
+        :param address: proxy string with {ip}:{port} pattern
+        :type address: str
+        :param previous_request_time: last request time, None if request failed
+        :type previous_request_time: float, None
+        """
+        with self._lock:
+            state = self._states.get(address)
+            if state is None:
+                # proxy can be deleted from pool by another thread
+                return
+            state.on_work = max(state.on_work - 1, 0)
+            if previous_request_time is not None:
+                state.previous_request_time = previous_request_time
+                state.consecutive_failures = 0
+                if state.circuit != OPEN:
+                    # successful probe of half-open proxy closes its circuit
+                    state.circuit = CLOSED
+                    state.open_count = 0
+            if state.circuit != OPEN:
+                self._push_available(state)
+                self._wake_head()
+
+    def mark_failed(self, address):
+        """
+        Count proxy failure, open its circuit after failure_threshold failures in a row or failed probe
+        :param address: proxy string with {ip}:{port} pattern
+        :type address: str
+        :return: True if proxy circuit is opened too many times in a row and proxy must be deleted
+        :rtype: bool
+        """
+        with self._lock:
+            state = self._states.get(address)
+            if state is None:
+                return False
+            now = time.time()
+            state.previous_error_time = now
+            state.error_count += 1
+            state.consecutive_failures += 1
+            # failures of requests started before opening don't extend open circuit
+            if state.circuit == OPEN or (state.circuit == CLOSED and
+                                         state.consecutive_failures < self.failure_threshold):
+                return False
+            state.open_count += 1
+            if state.open_count > self.max_opens:
+                return True
+            state.circuit = OPEN
+            state.open_until = now + min(self.error_cooldown * 2 ** (state.open_count - 1), self.max_cooldown)
+            entry_id = next(self._entry_ids)
+            state.entry_id = entry_id
+            heapq.heappush(self._cooldown, (state.open_until, entry_id, address))
+            return False
+
+    def get_circuit_counts(self):
+        """
+        :return: proxies count in every circuit state
+        :rtype: dict
+        """
+        with self._lock:
+            counts = {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}
+            for state in self._states.values():
+                counts[state.circuit] += 1
+            return counts
+
+    def _try_waiting_acquire(self, waiter, deadline):
+        """
+        Single waiting step, only head of waiters queue can take proxy
+        :return: taken proxy or None and time to wait before next step
+        :rtype: tuple
+        """
+        with self._lock:
+            now = time.time()
+            wait_time = None
+            if self._waiters[0] is waiter:
+                proxy = self._take(now)
+                if proxy is not None:
+                    self._waiters.popleft()
+                    # more proxies can be free, next waiter will check it
+                    self._wake_head()
+                    return proxy, None
+                if self._cooldown:
+                    # head waiter must check pool again when nearest cooldown ends
+                    wait_time = max(self._cooldown[0][0] - now, 0.001)
+            if deadline is not None:
+                if deadline <= now:
+                    raise ProxyPoolTimeout
+                wait_time = deadline - now if wait_time is None else min(wait_time, deadline - now)
+            waiter.clear()
+            return None, wait_time
+
+    def _abandon(self, waiter):
+        """Remove waiter from queue after timeout or cancellation"""
+        with self._lock:
+            if waiter in self._waiters:
+                was_head = self._waiters[0] is waiter
+                self._waiters.remove(waiter)
+                if was_head:
+                    self._wake_head()
+
+    def _wake_head(self):
+        if self._waiters:
+            self._waiters[0].wake()
+
+    def _push_available(self, state):
+        # half-open proxy is saturated by single probe request
+        if state.on_work >= (1 if state.circuit == HALF_OPEN else self.max_on_work):
+            state.entry_id = None
+            return
+        entry_id = next(self._entry_ids)
+        state.entry_id = entry_id
+        heapq.heappush(self._available, (state.previous_request_time, state.on_work, entry_id, state.address))
+        if len(self._available) > 2 * len(self._states) + 64:
+            self._compact()
+
+    def _is_valid_entry(self, entry_id, address):
+        state = self._states.get(address)
+        return state is not None and state.entry_id == entry_id
+
+    def _promote_cooled(self, now):
+        """Move proxies with finished cooldown into available heap as half-open"""
+        while self._cooldown and self._cooldown[0][0] <= now:
+            _, entry_id, address = heapq.heappop(self._cooldown)
+            if self._is_valid_entry(entry_id, address):
+                state = self._states[address]
+                state.circuit = HALF_OPEN
+                self._push_available(state)
+
+    def _take(self, now):
+        self._promote_cooled(now)
+        while self._available:
+            _, _, entry_id, address = heapq.heappop(self._available)
+            if not self._is_valid_entry(entry_id, address):
+                continue
+            state = self._states[address]
+            state.on_work += 1
+            self._push_available(state)
+            return address
+        return None
+
+    def _compact(self):
+        """Drop stale heap entries"""
+        self._available = [entry for entry in self._available if self._is_valid_entry(entry[2], entry[3])]
+        heapq.heapify(self._available)
+        self._cooldown = [entry for entry in self._cooldown if self._is_valid_entry(entry[1], entry[2])]
+        heapq.heapify(self._cooldown)
+
+
+def benchmark(proxies_count, threads_count=50, duration=2.0):
+    """
+    Measure acquire/release pairs per second
+    :param proxies_count: pool size
+    :type proxies_count: int
+    :param threads_count: concurrent threads
+    :type threads_count: int
+    :param duration: benchmark duration in seconds
+    :type duration: float
+    :return: acquisitions per second
+    :rtype: float
+    """
+    from threading import Thread
+    import random
+    pool = ProxyPool()
+    for n in range(proxies_count):
+        pool.add(f'10.0.{n // 256}.{n % 256}:8080', random.random())
+    counters = [0] * threads_count
+    stop_time = time.time() + duration
+
+    def worker(n):
+        while time.time() < stop_time:
+            proxy = pool.acquire(block=False)
+            if proxy is None:
+                continue
+            pool.release(proxy, random.random())
+            counters[n] += 1
+
+    threads = [Thread(target=worker, args=(n,)) for n in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counters) / duration
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    for count in (1000, 10000):
+        for threads in (1, 50):
+            logging.info('{} proxies, {} threads: {:.0f} acquisitions/sec'.format(count, threads,
+                                                                                  benchmark(count, threads)))
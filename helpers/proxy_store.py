@@ -0,0 +1,109 @@
+import atexit
+import os
+import sqlite3
+import time
+from threading import Lock
+
+
+class ProxyScoreStore:
+    """
+    Local on-disk proxy scores: latency, last success, error count and check time.
+    Lets ProxyHelper start from recently validated proxies instead of checking all of them again.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: sqlite file path, proxy_scores.sqlite near this module by default
+        :type path: str, None
+        """
+        if path is None:
+            cd = os.path.dirname(os.path.abspath(__file__))
+            path = os.path.join(cd, 'proxy_scores.sqlite')
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS proxies (
+                                       address TEXT PRIMARY KEY,
+                                       latency REAL,
+                                       last_success REAL,
+                                       last_error REAL,
+                                       error_count INTEGER NOT NULL DEFAULT 0,
+                                       checked_at REAL NOT NULL)''')
+        self.connection.commit()
+        # address -> (errors count, last error time) of failed requests, written by flush_failures
+        self.failures = {}
+        atexit.register(self.flush_failures)
+
+    def record_checks(self, checked_proxies):
+        """
+        Save proxy validation results
+        :param checked_proxies: check_proxy results with address, is_valid and request_time keys
+        :type checked_proxies: list
+        """
+        now = time.time()
+        valid = [(proxy['request_time'], now, now, proxy['address']) for proxy in checked_proxies if proxy['is_valid']]
+        invalid = [(now, now, proxy['address']) for proxy in checked_proxies if not proxy['is_valid']]
+        with self.lock:
+            self.connection.executemany('INSERT OR IGNORE INTO proxies (address, checked_at) VALUES (?, 0)',
+                                        [(proxy['address'],) for proxy in checked_proxies])
+            # successful check resets errors
+            self.connection.executemany('''UPDATE proxies SET latency=?, last_success=?, checked_at=?, error_count=0
+                                           WHERE address=?''', valid)
+            self.connection.executemany('''UPDATE proxies SET last_error=?, checked_at=?, error_count=error_count + 1
+                                           WHERE address=?''', invalid)
+            self.connection.commit()
+
+    def record_failure(self, address):
+        """
+        Count proxy error after failed request, errors are buffered in memory and written by flush_failures,
+        so request threads never wait for disk
+        :param address: proxy string with {ip}:{port} pattern
+        :type address: str
+        """
+        with self.lock:
+            errors, _ = self.failures.get(address, (0, None))
+            self.failures[address] = (errors + 1, time.time())
+
+    def flush_failures(self):
+        """Write buffered request errors in one transaction"""
+        with self.lock:
+            self.write_failures()
+
+    def write_failures(self):
+        """Write buffered request errors, must be called under lock"""
+        if not self.failures:
+            return
+        failures, self.failures = self.failures, {}
+        self.connection.executemany('UPDATE proxies SET error_count=error_count + ?, last_error=? WHERE address=?',
+                                    [(errors, last_error, address) for address, (errors, last_error)
+                                     in failures.items()])
+        self.connection.commit()
+
+    def load_fresh(self, max_age, max_errors=5):
+        """
+        Get proxies which were successfully validated recently
+        :param max_age: max seconds since last successful check
+        :type max_age: float
+        :param max_errors: proxies with more errors are skipped
+        :type max_errors: int
+        :return: list of (address, latency) tuples sorted by latency
+        :rtype: list
+        """
+        with self.lock:
+            self.write_failures()
+            return self.connection.execute('''SELECT address, latency FROM proxies
+                                              WHERE last_success > ? AND error_count < ?
+                                              ORDER BY latency''', (time.time() - max_age, max_errors)).fetchall()
+
+    def load_stale(self, max_age, max_errors=5):
+        """
+        Get proxies which were valid before but must be validated again
+        :return: addresses list
+        :rtype: list
+        """
+        with self.lock:
+            self.write_failures()
+            rows = self.connection.execute('''SELECT address FROM proxies
+                                              WHERE last_success IS NOT NULL AND last_success <= ? AND error_count < ?
+                                              ORDER BY last_success DESC''', (time.time() - max_age, max_errors))
+            return [row[0] for row in rows]
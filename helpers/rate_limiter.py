@@ -0,0 +1,352 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from threading import Lock
+from urllib.parse import urlsplit
+from helpers.proxy_pool import AsyncWaiter, ThreadWaiter
+
+# request outcomes used as congestion signals
+OK = 'ok'
+BAN = 'ban'
+SITE_ERROR = 'site_error'
+PROXY_ERROR = 'proxy_error'
+CANCELLED = 'cancelled'
+
+
+class TokenBucket:
+    """Token bucket, callers reserve token and sleep until it becomes available"""
+    def __init__(self, rate, capacity=1.0):
+        """
+        :param rate: tokens per second
+        :type rate: float
+        :param capacity: max tokens stored, allowed burst size
+        :type capacity: float
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.time()
+        self.lock = Lock()
+
+    def reserve(self):
+        """
+        Take token, tokens can go negative so concurrent callers are queued one after another
+        :return: seconds to wait before token can be used
+        :rtype: float
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def set_rate(self, rate):
+        """
+        :param rate: tokens per second
+        :type rate: float
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.rate = rate
+
+
+class AimdLimit:
+    """
+    Additive increase, multiplicative decrease value.
+    Every success adds increase / value, so value grows by about increase per value successes,
+    decreases are applied at most once per decrease_interval because failures of one episode come in bursts.
+    """
+    def __init__(self, initial, minimum, maximum, increase=1.0, decrease_interval=1.0):
+        self.value = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase_step = increase
+        self.decrease_interval = decrease_interval
+        self.decreased_at = 0
+
+    def increase(self):
+        self.value = min(self.maximum, self.value + self.increase_step / self.value)
+
+    def decrease(self, factor):
+        """
+        :param factor: multiplier less than 1
+        :type factor: float
+        """
+        now = time.time()
+        if now - self.decreased_at < self.decrease_interval:
+            return
+        self.decreased_at = now
+        self.value = max(self.minimum, self.value * factor)
+
+
+class HostLimiter:
+    """
+    Requests limit for single target host: AIMD adjusted concurrency and token bucket rate.
+    Bans decrease both limits by half, site errors and slow responses decrease them softer,
+    successes slowly increase them, so throughput settles at highest rate the site tolerates.
+    """
+    def __init__(self, host, concurrency=20, max_concurrency=500, rate=10.0, max_rate=1000.0,
+                 latency_tolerance=3.0):
+        """
+        :param host: target host
+        :type host: str
+        :param concurrency: initial max requests in flight
+        :type concurrency: int
+        :param max_concurrency: concurrency upper bound
+        :type max_concurrency: int
+        :param rate: initial requests per second
+        :type rate: float
+        :param max_rate: rate upper bound
+        :type max_rate: float
+        :param latency_tolerance: response slower than base latency in so many times is congestion signal
+        :type latency_tolerance: float
+        """
+        self.host = host
+        self.concurrency = AimdLimit(concurrency, 1, max_concurrency)
+        # rate grows by about 5 req/sec every second while it limits requests
+        self.rate = AimdLimit(rate, 0.2, max_rate, increase=5.0)
+        self.bucket = TokenBucket(rate, capacity=max(rate, 1.0))
+        self.latency_tolerance = latency_tolerance
+        self.lock = Lock()
+        self.in_flight = 0
+        self.waiters = deque()
+        self.latency = None
+        self.base_latency = None
+        self.counters = {OK: 0, BAN: 0, SITE_ERROR: 0, PROXY_ERROR: 0, CANCELLED: 0}
+
+    def acquire(self):
+        """Wait for free concurrency slot and rate token"""
+        if not self._try_acquire(None):
+            waiter = ThreadWaiter()
+            with self.lock:
+                self.waiters.append(waiter)
+            try:
+                while not self._try_acquire(waiter):
+                    # limit can grow without release, so waiting is bounded
+                    waiter.wait(1.0)
+            except BaseException:
+                self._abandon(waiter)
+                raise
+        time.sleep(self.bucket.reserve())
+
+    async def acquire_async(self):
+        """Coroutine version of acquire"""
+        if not self._try_acquire(None):
+            waiter = AsyncWaiter()
+            with self.lock:
+                self.waiters.append(waiter)
+            try:
+                while not self._try_acquire(waiter):
+                    await waiter.wait(1.0)
+            except BaseException:
+                self._abandon(waiter)
+                raise
+        try:
+            await asyncio.sleep(self.bucket.reserve())
+        except BaseException:
+            self.release(CANCELLED, 0)
+            raise
+
+    def release(self, outcome, latency):
+        """
+        Free concurrency slot and adjust limits by request outcome
+        :param outcome: one of OK, BAN, SITE_ERROR, PROXY_ERROR, CANCELLED
+        :type outcome: str
+        :param latency: request time in seconds
+        :type latency: float
+        """
+        with self.lock:
+            self.in_flight -= 1
+            self.counters[outcome] += 1
+            if outcome == OK:
+                self.update_latency(latency)
+                # limits grow only while they are reached, otherwise they would grow without bound
+                if self.bucket.tokens < 1:
+                    self.rate.increase()
+                if latency > self.latency_tolerance * self.base_latency:
+                    self.concurrency.decrease(0.9)
+                elif self.in_flight + 1 >= int(self.concurrency.value):
+                    self.concurrency.increase()
+            elif outcome == BAN:
+                self.rate.decrease(0.5)
+                self.concurrency.decrease(0.5)
+            elif outcome == SITE_ERROR:
+                self.rate.decrease(0.8)
+                self.concurrency.decrease(0.8)
+            # proxy errors and cancelled requests say nothing about target host
+            self.bucket.set_rate(self.rate.value)
+            self._wake_head()
+
+    def update_latency(self, latency):
+        """Latency EWMA and its slowly rising minimum used as uncongested baseline"""
+        self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+        self.base_latency = self.latency if self.base_latency is None else \
+            min(self.base_latency * 1.001, self.latency)
+
+    def _try_acquire(self, waiter):
+        """
+        Take concurrency slot, only head waiter can take it
+        :param waiter: waiter handle or None for first attempt without waiting
+        :rtype: bool
+        """
+        with self.lock:
+            is_turn = self.waiters[0] is waiter if waiter is not None else not self.waiters
+            if is_turn and self.in_flight < max(int(self.concurrency.value), 1):
+                self.in_flight += 1
+                if waiter is not None:
+                    self.waiters.popleft()
+                    # more slots can be free, next waiter will check it
+                    self._wake_head()
+                return True
+            if waiter is not None:
+                waiter.clear()
+            return False
+
+    def _abandon(self, waiter):
+        with self.lock:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+                self._wake_head()
+
+    def _wake_head(self):
+        if self.waiters:
+            self.waiters[0].wake()
+
+
+class RateLimiter:
+    """
+    Per-host adaptive limits and optional per-proxy token buckets.
+    Every request is wrapped with wait_proxy(proxy) after taking proxy, acquire(url) after it
+    and release(url, exception, latency) when it is finished.
+    """
+    def __init__(self, request_per_min=None, proxy_burst=5, stats_interval=30):
+        """
+        :param request_per_min: max requests per minute through single proxy, None - proxies are not rate limited
+        :type request_per_min: float, None
+        :param proxy_burst: requests which proxy can make at once after idle period
+        :type proxy_burst: int
+        :param stats_interval: seconds between stats logging
+        :type stats_interval: float
+        """
+        self.proxy_rate = request_per_min / 60 if request_per_min else None
+        self.proxy_burst = proxy_burst
+        self.stats_interval = stats_interval
+        self.hosts = {}
+        self.proxy_buckets = {}
+        self.lock = Lock()
+        self.stats_time = time.time()
+        self.stats_counters = {}
+
+    def get_host_limiter(self, url):
+        """
+        :type url: str
+        :rtype: HostLimiter
+        """
+        host = urlsplit(url).netloc
+        limiter = self.hosts.get(host)
+        if limiter is None:
+            with self.lock:
+                limiter = self.hosts.setdefault(host, HostLimiter(host))
+        return limiter
+
+    def get_proxy_bucket(self, proxy):
+        """
+        :param proxy: proxy string with {ip}:{port} pattern
+        :type proxy: str
+        :rtype: TokenBucket
+        """
+        bucket = self.proxy_buckets.get(proxy)
+        if bucket is None:
+            with self.lock:
+                bucket = self.proxy_buckets.setdefault(proxy, TokenBucket(self.proxy_rate, self.proxy_burst))
+        return bucket
+
+    def acquire(self, url):
+        """Wait until request to url host is allowed"""
+        self.get_host_limiter(url).acquire()
+
+    async def acquire_async(self, url):
+        await self.get_host_limiter(url).acquire_async()
+
+    def wait_proxy(self, proxy):
+        """
+        Wait until proxy can make next request
+        :param proxy: proxy string with {ip}:{port} pattern, None for request without proxy
+        :type proxy: str, None
+        """
+        if proxy and self.proxy_rate:
+            time.sleep(self.get_proxy_bucket(proxy).reserve())
+
+    async def wait_proxy_async(self, proxy):
+        if proxy and self.proxy_rate:
+            await asyncio.sleep(self.get_proxy_bucket(proxy).reserve())
+
+    def remove_proxy(self, proxy):
+        """Forget bucket of deleted proxy"""
+        self.proxy_buckets.pop(proxy, None)
+
+    def release(self, url, exception, latency, proxied=True):
+        """
+        :param url: requested url
+        :type url: str
+        :param exception: request exception or None if request is successful
+        :type exception: Exception, None
+        :param latency: request time in seconds
+        :type latency: float
+        :param proxied: request was made through proxy
+        :type proxied: bool
+        """
+        self.get_host_limiter(url).release(self.classify(exception, proxied), latency)
+        if time.time() - self.stats_time > self.stats_interval:
+            self.log_stats()
+
+    @staticmethod
+    def classify(exception, proxied=True):
+        """
+        :type exception: Exception, None
+        :param proxied: request was made through proxy, timeout without proxy is site error
+        :type proxied: bool
+        :return: request outcome
+        :rtype: str
+        """
+        # local import because proxy_helper imports this module
+        from helpers.proxy_helper import BanError, classify_error, CANCELLED_FAILURE, PERMANENT_FAILURE, \
+            PROXY_FAILURE
+        if exception is None:
+            return OK
+        if isinstance(exception, BanError):
+            return BAN
+        failure = classify_error(exception, proxied)
+        if failure == CANCELLED_FAILURE:
+            # attempt which lost hedge race says nothing about host or proxy
+            return CANCELLED
+        if failure == PROXY_FAILURE:
+            return PROXY_ERROR
+        if failure == PERMANENT_FAILURE:
+            # site answered normally, e.g. page is not found
+            return OK
+        return SITE_ERROR
+
+    def log_stats(self):
+        """Log requests rate, bans and current limits of every host since previous call"""
+        with self.lock:
+            now = time.time()
+            elapsed = now - self.stats_time
+            if elapsed <= 0:
+                return
+            self.stats_time = now
+            for host, limiter in self.hosts.items():
+                counters = dict(limiter.counters)
+                previous = self.stats_counters.get(host, dict.fromkeys(counters, 0))
+                self.stats_counters[host] = counters
+                done = {key: counters[key] - previous[key] for key in counters}
+                requests_count = sum(done.values())
+                logging.info('{}: {:.1f} ok req/sec, {} bans, {} site errors, {} proxy errors of {} requests, '
+                             'limits {:.1f} req/sec and {:.0f} in flight ({} now), latency {:.2f} sec'.format(
+                                 host, done[OK] / elapsed, done[BAN], done[SITE_ERROR], done[PROXY_ERROR],
+                                 requests_count, limiter.rate.value, limiter.concurrency.value, limiter.in_flight,
+                                 limiter.latency or 0))
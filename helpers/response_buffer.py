@@ -0,0 +1,75 @@
+import codecs
+
+# text which site shows to banned proxies instead of page
+BAN_MARKER = "You don't have permission to access"
+
+
+class ResponseBuffer:
+    """
+    Accumulates raw response chunks and searches ban marker incrementally.
+    Every chunk is scanned once plus len(marker) - 1 bytes of overlap with previous chunk,
+    body is joined and decoded once when response is finished.
+    """
+    def __init__(self, encoding=None, marker=BAN_MARKER, keep_body=True):
+        """
+        :param encoding: response charset
+        :type encoding: str, None
+        :param marker: ban marker text
+        :type marker: str
+        :param keep_body: if False chunks are only scanned for marker and not stored
+        :type keep_body: bool
+        """
+        self.keep_body = keep_body
+        self.encoding = self.normalize_encoding(encoding)
+        self.marker = marker.encode(self.encoding)
+        self.chunks = []
+        self.size = 0
+        self.tail = b''
+        self.marker_found = False
+
+    @staticmethod
+    def normalize_encoding(encoding):
+        """
+        :param encoding: response charset
+        :type encoding: str, None
+        :return: known python codec name, utf-8 by default
+        :rtype: str
+        """
+        try:
+            return codecs.lookup(encoding).name if encoding else 'utf-8'
+        except LookupError:
+            return 'utf-8'
+
+    def feed(self, chunk):
+        """
+        Add response chunk
+        :param chunk: raw response chunk
+        :type chunk: bytes
+        :return: True if ban marker found in response
+        :rtype: bool
+        """
+        if not chunk:
+            return self.marker_found
+        if self.keep_body:
+            self.chunks.append(chunk)
+        self.size += len(chunk)
+        overlap = len(self.marker) - 1
+        # marker can be split between previous and current chunks
+        if self.marker in chunk or (self.tail and self.marker in self.tail + chunk[:overlap]):
+            self.marker_found = True
+        self.tail = (self.tail + chunk)[-overlap:] if len(chunk) < overlap else chunk[-overlap:]
+        return self.marker_found
+
+    def getvalue(self):
+        """
+        :return: raw response body
+        :rtype: bytes
+        """
+        return b''.join(self.chunks)
+
+    def text(self):
+        """
+        :return: response body decoded with response charset
+        :rtype: str
+        """
+        return self.getvalue().decode(self.encoding, errors='replace')
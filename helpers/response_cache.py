@@ -0,0 +1,343 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from threading import Lock
+from urllib.parse import urlencode
+
+# seconds which cached page of type is used without request
+DEFAULT_TTLS = {'category': 3600, 'product': 24 * 3600, 'review': 6 * 3600}
+
+
+class CachedResponse:
+    """Cached page body with its validators"""
+    __slots__ = ('key', 'body', 'encoding', 'etag', 'last_modified', 'expires_at')
+
+    def __init__(self, key, body, encoding, etag, last_modified, expires_at):
+        self.key = key
+        self.body = body
+        self.encoding = encoding
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+
+    def is_fresh(self):
+        return self.expires_at > time.time()
+
+    def get_validators(self):
+        """
+        :return: conditional request headers, site answers 304 without body if page is not changed
+        :rtype: dict
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def replay(self, consumer_factory=None):
+        """
+        :param consumer_factory: see Downloader.get
+        :type consumer_factory: callable, None
+        :return: page text or consumer fed with page
+        :rtype: str, object
+        """
+        if consumer_factory is None:
+            return self.body.decode(self.encoding, errors='replace')
+        consumer = consumer_factory(self.encoding)
+        if not consumer.feed(self.body):
+            consumer.finish()
+        return consumer
+
+
+class ResponseCache:
+    """
+    On-disk cache of successful GET responses. Bodies are zlib compressed and stored in files named by sha1 of body,
+    so equal pages share one file. Sqlite index maps url to body hash, validators and expiry time, which depends on
+    page type of url. Least recently used pages are evicted when bodies take more than max_size bytes.
+    """
+    def __init__(self, path, page_types=(), ttls=None, default_ttl=3600, max_size=1024 ** 3, compress_level=6,
+                 stats_interval=60):
+        """
+        :param path: cache directory, created if it doesn't exist
+        :type path: str
+        :param page_types: (page type, compiled url regex) pairs, first type which regex matches url is used
+        :type page_types: list, tuple
+        :param ttls: page type -> seconds which cached page is used without request, DEFAULT_TTLS by default
+        :type ttls: dict, None
+        :param default_ttl: ttl of urls without page type
+        :type default_ttl: float
+        :param max_size: max compressed bodies size in bytes
+        :type max_size: int
+        :param compress_level: zlib compression level
+        :type compress_level: int
+        :param stats_interval: seconds between stats logging
+        :type stats_interval: float
+        """
+        self.path = path
+        self.bodies_path = os.path.join(path, 'bodies')
+        os.makedirs(self.bodies_path, exist_ok=True)
+        self.page_types = list(page_types)
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        self.compress_level = compress_level
+        self.stats_interval = stats_interval
+        self.stats_time = time.time()
+        self.counters = {'hits': 0, 'stale': 0, 'misses': 0, 'revalidated': 0, 'stored': 0, 'evicted': 0,
+                         'saved_bytes': 0}
+        self.lock = Lock()
+        # counters are changed by every downloading thread
+        self.counters_lock = Lock()
+        # url -> last hit time, access times are written in batches instead of commit on every hit
+        self.accessed = {}
+        self.connection = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                       url TEXT PRIMARY KEY,
+                                       body_hash TEXT NOT NULL,
+                                       encoding TEXT NOT NULL,
+                                       etag TEXT,
+                                       last_modified TEXT,
+                                       page_type TEXT,
+                                       fetched_at REAL NOT NULL,
+                                       expires_at REAL NOT NULL,
+                                       accessed_at REAL NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_body_hash ON responses (body_hash)')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS bodies (
+                                       hash TEXT PRIMARY KEY,
+                                       size INTEGER NOT NULL)''')
+        self.connection.commit()
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM bodies').fetchone()[0]
+
+    @staticmethod
+    def get_key(url, params=None):
+        """
+        :param url: requested url
+        :type url: str
+        :param params: query params
+        :type params: dict, None
+        :return: url with sorted query params
+        :rtype: str
+        """
+        if not params:
+            return url
+        return '{}{}{}'.format(url, '&' if '?' in url else '?', urlencode(sorted(params.items())))
+
+    def get_page_type(self, url):
+        """
+        :type url: str
+        :return: page type of url or None
+        :rtype: str, None
+        """
+        for page_type, regex in self.page_types:
+            if regex.search(url):
+                return page_type
+        return None
+
+    def get_ttl(self, page_type):
+        return self.ttls.get(page_type, self.default_ttl)
+
+    def get_body_path(self, body_hash):
+        return os.path.join(self.bodies_path, body_hash[:2], body_hash)
+
+    def lookup(self, key):
+        """
+        Get cached page and count cache hit or miss
+        :param key: cache key from get_key
+        :type key: str
+        :return: cached page, fresh or stale one which can be revalidated, None if page is not cached
+        :rtype: CachedResponse, None
+        """
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('''SELECT body_hash, encoding, etag, last_modified, expires_at
+                                             FROM responses WHERE url=?''', (key,)).fetchone()
+            if row is not None:
+                # recently used pages are evicted last
+                self.accessed[key] = now
+        cached = None
+        if row is not None:
+            body_hash, encoding, etag, last_modified, expires_at = row
+            try:
+                with open(self.get_body_path(body_hash), 'rb') as body_file:
+                    cached = CachedResponse(key, zlib.decompress(body_file.read()), encoding, etag, last_modified,
+                                            expires_at)
+            except (OSError, zlib.error):
+                # body can be evicted by other thread or broken by killed process
+                logging.debug('Can`t read cached body of {}'.format(key), exc_info=True)
+        if cached is None:
+            self.count('misses')
+        elif cached.is_fresh():
+            self.count('hits', len(cached.body))
+        else:
+            self.count('stale')
+        return cached
+
+    def revalidate(self, cached):
+        """
+        Extend ttl of cached page after site answered 304 Not Modified
+        :type cached: CachedResponse
+        """
+        now = time.time()
+        cached.expires_at = now + self.get_ttl(self.get_page_type(cached.key))
+        with self.lock:
+            self.accessed.pop(cached.key, None)
+            self.connection.execute('UPDATE responses SET fetched_at=?, expires_at=?, accessed_at=? WHERE url=?',
+                                    (now, cached.expires_at, now, cached.key))
+            self.connection.commit()
+        self.count('revalidated', len(cached.body))
+
+    def store(self, key, body, encoding, headers):
+        """
+        Save successful response
+        :param key: cache key from get_key
+        :type key: str
+        :param body: raw response body
+        :type body: bytes
+        :param encoding: body charset
+        :type encoding: str
+        :param headers: response headers, ETag and Last-Modified are kept for revalidation
+        :type headers: collections.abc.Mapping
+        """
+        body_hash = hashlib.sha1(body).hexdigest()
+        body_path = self.get_body_path(body_hash)
+        temp_path = None
+        if not os.path.exists(body_path):
+            # compressed and written out of lock, body is renamed into place under lock
+            temp_path, size = self.write_temp_body(body_path, body)
+        page_type = self.get_page_type(key)
+        now = time.time()
+        with self.lock:
+            # eviction deletes bodies under lock, so body existence is checked again before it is referenced
+            if not os.path.exists(body_path):
+                if temp_path is None:
+                    temp_path, size = self.write_temp_body(body_path, body)
+                os.replace(temp_path, body_path)
+            else:
+                if temp_path is not None:
+                    os.remove(temp_path)
+                size = os.path.getsize(body_path)
+            self.accessed.pop(key, None)
+            self.flush_accessed()
+            if self.connection.execute('INSERT OR IGNORE INTO bodies (hash, size) VALUES (?, ?)',
+                                       (body_hash, size)).rowcount:
+                self.size += size
+            row = self.connection.execute('SELECT body_hash FROM responses WHERE url=?', (key,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (key, body_hash, encoding, headers.get('ETag'), headers.get('Last-Modified'),
+                                     page_type, now, now + self.get_ttl(page_type), now))
+            if row is not None and row[0] != body_hash:
+                # page is changed, its previous body can be not used anymore
+                self.delete_orphan_bodies([row[0]])
+            self.connection.commit()
+            if self.size > self.max_size:
+                self.evict()
+        self.count('stored')
+
+    def write_temp_body(self, body_path, body):
+        """
+        Write compressed body under unique name, it is renamed to body path, so readers never see partial body
+        :param body_path: path from get_body_path
+        :type body_path: str
+        :param body: raw response body
+        :type body: bytes
+        :return: temp file path and compressed size
+        :rtype: tuple
+        """
+        compressed = zlib.compress(body, self.compress_level)
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        temp_path = '{}.{}.tmp'.format(body_path, threading.get_ident())
+        with open(temp_path, 'wb') as body_file:
+            body_file.write(compressed)
+        return temp_path, len(compressed)
+
+    def flush_accessed(self):
+        """Write access times of pages hit since previous flush, must be called under lock, commit is up to caller"""
+        if not self.accessed:
+            return
+        self.connection.executemany('UPDATE responses SET accessed_at=? WHERE url=?',
+                                    [(accessed_at, key) for key, accessed_at in self.accessed.items()])
+        self.accessed.clear()
+
+    def delete_orphan_bodies(self, hashes):
+        """
+        Delete bodies which no url refers to, must be called under lock
+        :param hashes: checked body hashes
+        :type hashes: list
+        """
+        for body_hash in hashes:
+            if self.connection.execute('SELECT 1 FROM responses WHERE body_hash=? LIMIT 1',
+                                       (body_hash,)).fetchone():
+                continue
+            row = self.connection.execute('SELECT size FROM bodies WHERE hash=?', (body_hash,)).fetchone()
+            self.connection.execute('DELETE FROM bodies WHERE hash=?', (body_hash,))
+            self.size -= row[0] if row else 0
+            try:
+                os.remove(self.get_body_path(body_hash))
+            except OSError:
+                pass
+
+    def evict(self, batch_size=100):
+        """Delete least recently used pages until bodies take less than 90% of max size, must be called under lock"""
+        target_size = self.max_size * 0.9
+        evicted = 0
+        self.flush_accessed()
+        while self.size > target_size:
+            rows = self.connection.execute('SELECT url, body_hash FROM responses ORDER BY accessed_at LIMIT ?',
+                                           (batch_size,)).fetchall()
+            if not rows:
+                break
+            for url, body_hash in rows:
+                if self.size <= target_size:
+                    break
+                self.connection.execute('DELETE FROM responses WHERE url=?', (url,))
+                self.delete_orphan_bodies([body_hash])
+                evicted += 1
+        self.connection.commit()
+        with self.counters_lock:
+            self.counters['evicted'] += evicted
+        logging.debug('{} cached pages evicted, cache size is {} bytes'.format(evicted, self.size))
+
+    def count(self, counter, saved_bytes=0):
+        """
+        :param counter: counters key
+        :type counter: str
+        :param saved_bytes: body bytes which are not downloaded thanks to cache
+        :type saved_bytes: int
+        """
+        with self.counters_lock:
+            self.counters[counter] += 1
+            self.counters['saved_bytes'] += saved_bytes
+            log_stats = time.time() - self.stats_time > self.stats_interval
+            if log_stats:
+                # only one thread logs stats
+                self.stats_time = time.time()
+        if log_stats:
+            self.log_stats()
+
+    def log_stats(self):
+        """Log hit rate, 304 revalidations share counts as hits because they have no body"""
+        with self.counters_lock:
+            self.stats_time = time.time()
+            counters = dict(self.counters)
+        lookups = counters['hits'] + counters['stale'] + counters['misses']
+        hit_rate = (counters['hits'] + counters['revalidated']) / lookups if lookups else 0
+        logging.info('response cache: {:.1%} hit rate, {} lookups, {} fresh hits, {} revalidated, {} misses, '
+                     '{} stored, {} evicted, {:.1f} MB not downloaded, {:.1f} MB on disk'.format(
+                         hit_rate, lookups, counters['hits'], counters['revalidated'], counters['misses'],
+                         counters['stored'], counters['evicted'], counters['saved_bytes'] / 1024 ** 2,
+                         self.size / 1024 ** 2))
+
+    def close(self):
+        self.log_stats()
+        with self.lock:
+            self.flush_accessed()
+            self.connection.commit()
+            self.connection.close()
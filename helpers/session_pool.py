@@ -0,0 +1,178 @@
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+import requests
+
+
+class SessionPool:
+    """
+    Bounded LRU of persistent requests sessions keyed by proxy.
+    Requests through the same proxy reuse its keep-alive connections, so TCP and TLS handshakes are made once
+    per connection instead of once per request. Sessions idle for idle_timeout seconds or older than max_age seconds
+    are retired and recreated on demand. Checked out sessions are counted, so retired session is closed only after
+    its last request releases it.
+    """
+    def __init__(self, max_sessions=300, idle_timeout=60, max_age=600, pool_maxsize=5):
+        """
+        :param max_sessions: max open sessions, least recently used one is closed on overflow
+        :type max_sessions: int
+        :param idle_timeout: seconds after last usage when session is closed
+        :type idle_timeout: float
+        :param max_age: seconds after session creation when it is recycled
+        :type max_age: float
+        :param pool_maxsize: keep-alive connections per host in one session, same as max threads per proxy
+        :type pool_maxsize: int
+        """
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.pool_maxsize = pool_maxsize
+        self.lock = Lock()
+        # proxy -> (session, session_update_time, last usage time), ordered from least recently used
+        self.sessions = OrderedDict()
+        # session -> requests using it
+        self.checkouts = {}
+        # sessions removed from pool while in use, they are closed on last release
+        self.retired = set()
+        self.created = 0
+        self.reused = 0
+        self.closed = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def create_session(self):
+        """
+        :rtype: requests.Session
+        """
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @contextmanager
+    def checkout(self, proxy):
+        """
+        Use session of proxy for one request, response must be read inside of with block
+        :param proxy: proxy string with {ip}:{port} pattern, None for requests without proxy
+        :type proxy: str, None
+        :rtype: requests.Session
+        """
+        session = self.get(proxy)
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def get(self, proxy):
+        """
+        Check out session of proxy, new one is created if proxy has no session or its session is too old.
+        Session must be returned by release
+        :param proxy: proxy string with {ip}:{port} pattern, None for requests without proxy
+        :type proxy: str, None
+        :rtype: requests.Session
+        """
+        now = time.time()
+        expired = []
+        with self.lock:
+            entry = self.sessions.pop(proxy, None)
+            if entry is not None and now - entry[1] > self.max_age:
+                expired.extend(self._retire([entry[0]]))
+                entry = None
+            if entry is None:
+                session, session_update_time = self.create_session(), now
+                self.created += 1
+            else:
+                session, session_update_time, _ = entry
+                self.reused += 1
+            self.sessions[proxy] = (session, session_update_time, now)
+            self.checkouts[session] = self.checkouts.get(session, 0) + 1
+            expired.extend(self._retire(self._evict(now)))
+        self._close(expired)
+        return session
+
+    def release(self, session):
+        """
+        Return checked out session, retired session is closed when its last request is finished
+        :type session: requests.Session
+        """
+        with self.lock:
+            self.checkouts[session] -= 1
+            if self.checkouts[session]:
+                return
+            del self.checkouts[session]
+            if session not in self.retired:
+                return
+            self.retired.remove(session)
+        self._close([session])
+
+    def discard(self, proxy):
+        """
+        Close session of deleted proxy
+        :param proxy: proxy string with {ip}:{port} pattern
+        :type proxy: str
+        """
+        with self.lock:
+            entry = self.sessions.pop(proxy, None)
+            sessions = self._retire([entry[0]]) if entry is not None else []
+        self._close(sessions)
+
+    def close(self):
+        """Close all sessions, sessions in use are closed when they are released"""
+        with self.lock:
+            sessions = self._retire([entry[0] for entry in self.sessions.values()])
+            self.sessions.clear()
+        self._close(sessions)
+
+    def stats(self):
+        """
+        :return: open and retired in use sessions count and created, reused and closed sessions counters
+        :rtype: dict
+        """
+        return {'open': len(self.sessions), 'retired': len(self.retired), 'created': self.created,
+                'reused': self.reused, 'closed': self.closed}
+
+    def _evict(self, now):
+        """
+        Pop least recently used sessions which are idle too long or don't fit max_sessions, must be called under lock
+        :return: popped sessions
+        :rtype: list
+        """
+        evicted = []
+        while self.sessions:
+            proxy, (session, _, last_used) = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions and now - last_used <= self.idle_timeout:
+                break
+            del self.sessions[proxy]
+            evicted.append(session)
+        return evicted
+
+    def _retire(self, sessions):
+        """
+        Sessions removed from pool which are in use are kept until release, must be called under lock
+        :param sessions: sessions removed from pool
+        :type sessions: list
+        :return: sessions which can be closed now
+        :rtype: list
+        """
+        free_sessions = []
+        for session in sessions:
+            if self.checkouts.get(session):
+                self.retired.add(session)
+            else:
+                free_sessions.append(session)
+        return free_sessions
+
+    def _close(self, sessions):
+        """Close sessions outside of lock, closing can wait for sockets"""
+        for session in sessions:
+            try:
+                session.close()
+            except Exception:
+                logging.debug('Except on closing session', exc_info=True)
+        if sessions:
+            with self.lock:
+                self.closed += len(sessions)
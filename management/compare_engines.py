@@ -0,0 +1,152 @@
+import sys
+sys.path.append("..")
+import argparse
+import asyncio
+import logging
+import socket
+import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+from helpers.async_downloader_helper import AsyncDownloader
+from helpers.downloader_helper import Downloader
+from helpers.executor import LaneExecutor
+from scrapers.dresslily import DresslilyParser, DresslilyScraper
+
+logging.basicConfig(format=u'%(filename)s[LINE:%(lineno)d]# %(levelname)-8s [%(asctime)s]  %(message)s',
+                    level=logging.ERROR)
+
+
+def crawl_threads(domain, backend, workers):
+    """
+    Crawl category, product and review pages with threaded engine without proxies and db
+    :param domain: site domain
+    :type domain: str
+    :param backend: extraction backend
+    :type backend: str
+    :param workers: concurrent products
+    :type workers: int
+    :return: products by id with reviews
+    :rtype: dict
+    """
+    executor = LaneExecutor(max_workers=workers * 3, name='worker') \
+        .add_lane('crawl', quota=workers, reserved=workers) \
+        .add_lane('reviews', quota=workers * 2, reserved=workers) \
+        .add_lane('proxy-check', quota=1)
+    downloader = Downloader(check_url=domain, use_proxy=False, use_session=True, executor=executor)
+    scraper = DresslilyScraper(downloader, domain, backend, page_executor=executor.lane('crawl'))
+    parser = DresslilyParser(downloader, domain, backend, executor.lane('reviews'))
+
+    def parse_product(product):
+        product = parser.parse_single_product(product)
+        return parser.parse_product_reviews(product) if product else None
+
+    pool = ThreadPool(workers)
+    try:
+        products = pool.map(parse_product, scraper.scrape_products())
+    finally:
+        pool.close()
+        executor.shutdown()
+    return {product['_id']: product for product in products if product}
+
+
+async def crawl_asyncio(domain, backend, workers):
+    """
+    Crawl category, product and review pages with asyncio engine without proxies and db
+    :param domain: site domain
+    :type domain: str
+    :param backend: extraction backend
+    :type backend: str
+    :param workers: concurrent products
+    :type workers: int
+    :return: products by id with reviews
+    :rtype: dict
+    """
+    semaphore = asyncio.Semaphore(workers)
+    async with AsyncDownloader(check_url=domain, use_proxy=False) as downloader:
+        scraper = DresslilyScraper(downloader, domain, backend)
+        parser = DresslilyParser(downloader, domain, backend)
+
+        async def parse_product(product):
+            async with semaphore:
+                product = await parser.parse_single_product_async(product)
+                return await parser.parse_product_reviews_async(product) if product else None
+
+        products = await asyncio.gather(*map(parse_product, await scraper.scrape_products_async()))
+    return {product['_id']: product for product in products if product}
+
+
+def start_stand_in_server(port, pages, latency):
+    """
+    Run stand_in_server.py in other process, so it doesn't share GIL with compared engine
+    :return: server process, it is listening when function returns
+    :rtype: subprocess.Popen
+    """
+    server = subprocess.Popen([sys.executable, 'stand_in_server.py', '--port', str(port), '--pages', str(pages),
+                               '--latency', str(latency)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('stand-in server is not started on {} port'.format(port))
+
+
+def summarize(products):
+    """
+    :param products: products by id
+    :type products: dict
+    :return: comparable products data, reviews are compared by hash in pages order
+    :rtype: dict
+    """
+    return {product_id: (product['name'], product['discount_price'], product['original_price'], product['rating'],
+                         product['product_info'], [review['hash'] for review in product['reviews']])
+            for product_id, product in products.items()}
+
+
+def main(args):
+    server = None
+    domain = args.domain
+    if domain is None:
+        server = start_stand_in_server(args.port, args.pages, args.latency)
+        domain = 'http://127.0.0.1:{}'.format(args.port)
+    try:
+        results = {}
+        for engine in args.engines:
+            start_time = time.time()
+            if engine == 'asyncio':
+                products = asyncio.get_event_loop().run_until_complete(
+                    crawl_asyncio(domain, args.backend, args.workers))
+            else:
+                products = crawl_threads(domain, args.backend, args.workers)
+            elapsed = time.time() - start_time
+            reviews = sum(len(product['reviews']) for product in products.values())
+            print('{:8} {:6} products {:7} reviews {:7.1f} s {:7.1f} products/s'.format(
+                engine, len(products), reviews, elapsed, len(products) / elapsed))
+            results[engine] = summarize(products)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    summaries = list(results.values())
+    if any(summary != summaries[0] for summary in summaries[1:]):
+        print('engines extracted different data')
+        return 1
+    print('engines extracted same data')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crawl same site with threads and asyncio engines and compare '
+                                                 'throughput and extracted data, without proxies and db')
+    parser.add_argument('--domain', default=None,
+                        help='site domain, local stand_in_server.py is started if it is not set')
+    parser.add_argument('--port', type=int, default=8080, help='port of started stand-in server')
+    parser.add_argument('--pages', type=int, default=5, help='category pages of started stand-in server')
+    parser.add_argument('--latency', type=float, default=0.05, help='response delay of started stand-in server')
+    parser.add_argument('--backend', choices=['bs4', 'lxml', 'stream'], default='lxml')
+    parser.add_argument('--workers', type=int, default=50, help='concurrently crawled products')
+    parser.add_argument('--engines', nargs='+', choices=['threads', 'asyncio'], default=['threads', 'asyncio'])
+    sys.exit(main(parser.parse_args()))
@@ -2,13 +2,27 @@ import sys
 sys.path.append("..")
 import logging
 import sys
-from storage.mongodb_storage import MongoDBStorage
+from storage.mongodb_storage import MongoDBStorage, CRAWL_STATES
+from storage.write_behind import REVIEWS_COUNT, WriteBehindWriter
+from helpers.pipeline import Pipeline
+from helpers.executor import LaneExecutor
 from helpers.helpers import chunkify
-from scrapers.dresslily import DresslilyParser, DresslilyScraper
+from helpers.hedging import Hedger
+from helpers.parse_pool import ParsePool
+from helpers.csv_export import export_csv
+from helpers.parquet_export import ParquetExporter
+from helpers.page_archive import PageArchive
+from helpers.response_cache import ResponseCache
+from scrapers.dresslily import PAGE_TYPES, DresslilyParser, DresslilyScraper, extract_archived_batch
 from helpers.downloader_helper import Downloader
-from multiprocessing.pool import ThreadPool
+from helpers.async_downloader_helper import AsyncDownloader
+import argparse
+import asyncio
 import gc
-import pandas as pd
+from functools import partial
+import os
+import time
+import pyarrow as pa
 
 logging.basicConfig(format=u'%(filename)s[LINE:%(lineno)d]# %(levelname)-8s [%(asctime)s]  %(message)s',
                     level=logging.INFO)
@@ -17,94 +31,597 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 logging.getLogger("connectionpool").setLevel(logging.WARNING)
 
+# (csv column, db field) pairs in csv columns order
+PRODUCT_CSV_COLUMNS = [('productId', '_id'), ('productUrl', 'url'), ('name', 'name'), ('discount', 'discount'),
+                       ('discountedPrice', 'discount_price'), ('originalPrice', 'original_price'),
+                       ('rating', 'rating'), ('productInfo', 'product_info')]
+REVIEW_CSV_COLUMNS = [('productId', 'product_id'), ('rating', 'rating'), ('timestamp', 'timestamp'), ('text', 'text'),
+                      ('size', 'size'), ('color', 'color')]
+# parquet columns have same names as csv ones
+PRODUCT_PARQUET_SCHEMA = [('productId', pa.int64()), ('productUrl', pa.string()), ('name', pa.string()),
+                          ('discount', pa.int64()), ('discountedPrice', pa.float64()),
+                          ('originalPrice', pa.float64()), ('rating', pa.float64()), ('productInfo', pa.string())]
+REVIEW_PARQUET_SCHEMA = [('productId', pa.int64()), ('rating', pa.int64()), ('timestamp', pa.float64()),
+                         ('text', pa.string()), ('size', pa.string()), ('color', pa.string())]
+# size and color have few distinct values
+REVIEW_DICTIONARY_COLUMNS = ['size', 'color']
+
 
 class ManagementHelper:
-    def __init__(self, product_file_name, reviews_file_name):
+    def __init__(self, product_file_name, reviews_file_name, engine='threads', domain='https://www.dresslily.com',
+                 use_proxy=True, backend='bs4', incremental=False, export_format='csv', export_dir='export',
+                 parse_processes=None, hedge=False, cache_dir=None, cache_size=1024, archive_dir=None, replay=False,
+                 request_per_min=None):
+        # 0 means parsing in downloading threads, stream backend parses pages while downloading, so pool
+        # would parse only few category pages
+        self.parse_pool = ParsePool(parse_processes) if parse_processes != 0 and backend != 'stream' else None
         self.mdb = MongoDBStorage()
+        self.mdb.ensure_indexes()
         self.product_file_name = product_file_name
         self.reviews_file_name = reviews_file_name
-        self.domain = 'https://www.dresslily.com'
-        self.downloader = Downloader(check_url=self.domain, use_proxy=True, attempts=20, use_user_agents=True)
-        self.dresslily_scraper = DresslilyScraper(self.downloader, self.domain)
-        self.dresslily_parser = DresslilyParser(self.downloader, self.domain)
+        # parquet export appends only records changed since previous export into export_dir
+        self.export_format = export_format
+        self.export_dir = export_dir
+        # domain can be changed to local stand-in server for engines comparison
+        self.domain = domain
+        self.engine = engine
+        # refresh reviews of all stored products, fetching only new review pages
+        self.incremental = incremental
         self.chunk_size = 300
+        self.writer = None
+        # crawl run checkpoint, category pages done are stored in it
+        self.crawl_run = None
         self.pool_size = 50
+        # products crawled concurrently by asyncio engine, their review pages are requested concurrently too
+        self.async_products = 200
+        self.review_pages_workers = 100
+        # raw pages are archived, so extraction can be replayed without network
+        self.archive = PageArchive(archive_dir, PAGE_TYPES) if archive_dir else None
+        self.backend = backend
+        # reviews stored before replay start are superseded by replayed ones
+        self.replay_time = None
+        # product id -> [review pages count, replayed review page numbers, newest page fetch time]
+        self.replayed_review_pages = {}
+        self.executor = self.cache = self.downloader = self.dresslily_scraper = self.dresslily_parser = None
+        # replay makes no requests, so downloader with its proxies is not created
+        if not replay:
+            self.create_crawlers(use_proxy, hedge, cache_dir, cache_size, request_per_min)
+
+    def create_crawlers(self, use_proxy, hedge, cache_dir, cache_size, request_per_min=None):
+        """
+        Create executor, downloader and scrapers of crawl
+        :param use_proxy: make requests through proxies
+        :type use_proxy: bool
+        :param hedge: duplicate slow requests through other proxy
+        :type hedge: bool
+        :param cache_dir: response cache directory or None
+        :type cache_dir: str, None
+        :param cache_size: max response cache size in MB
+        :type cache_size: int
+        :param request_per_min: max requests per minute through single proxy, None - only host limits are applied
+        :type request_per_min: float, None
+        """
+        # all worker threads have common cap. Crawl lane runs category pages and pipeline stage workers, which hold
+        # their slots during whole pipeline, so all of them are reserved. Crawl workers wait for review pages,
+        # requests wait for their hedges and proxy checks, so these lanes have reserved slots too and can't be starved
+        pipeline_workers = self.pool_size * 2 + 2
+        self.executor = LaneExecutor(max_workers=250, name='worker') \
+            .add_lane('crawl', quota=pipeline_workers, reserved=pipeline_workers) \
+            .add_lane('hedge', quota=20, reserved=5, max_pending=20) \
+            .add_lane('reviews', quota=self.review_pages_workers, reserved=20) \
+            .add_lane('proxy-check', quota=100, reserved=10)
+        # requests slower than 95th latency percentile are duplicated through other proxy, up to 5% of requests
+        hedger = Hedger(self.executor.lane('hedge')) if hedge else None
+        # pages downloaded in recent runs are taken from disk, cache_size is in MB
+        self.cache = ResponseCache(cache_dir, PAGE_TYPES, max_size=cache_size * 1024 ** 2) if cache_dir else None
+        # every request has 3 min deadline, given up requests are saved for inspection and later retry
+        if self.engine == 'asyncio':
+            self.downloader = AsyncDownloader(check_url=self.domain, use_proxy=use_proxy, attempts=20,
+                                              use_user_agents=True, request_per_min=request_per_min,
+                                              executor=self.executor, hedger=hedger, deadline=180,
+                                              on_dead_letter=self.mdb.add_dead_letter,
+                                              cache=self.cache, archive=self.archive)
+        else:
+            # keep-alive sessions per proxy
+            self.downloader = Downloader(check_url=self.domain, use_proxy=use_proxy, attempts=20,
+                                         use_user_agents=True, use_session=True, request_per_min=request_per_min,
+                                         executor=self.executor, hedger=hedger, deadline=180,
+                                         on_dead_letter=self.mdb.add_dead_letter,
+                                         cache=self.cache, archive=self.archive)
+        self.dresslily_scraper = DresslilyScraper(self.downloader, self.domain, self.backend, self.parse_pool,
+                                                  self.executor.lane('crawl'))
+        # review pages of all products are fetched by one lane, so long-tail products are parallelized
+        self.dresslily_parser = DresslilyParser(self.downloader, self.domain, self.backend,
+                                                self.executor.lane('reviews'), self.parse_pool)
 
     def run(self):
         """Manage scraping, parsing and db updating"""
+        self.writer = WriteBehindWriter(self.mdb, batch_size=self.chunk_size)
+        try:
+            if self.engine == 'asyncio':
+                asyncio.get_event_loop().run_until_complete(self.run_async())
+            else:
+                # unfinished run is resumed from its checkpoints
+                self.crawl_run = self.mdb.start_crawl_run()
+                self.parse_products()
+        finally:
+            # guarantee that all parsed data is written even if crawl is failed
+            self.writer.close()
+        gc.collect()
+        self.export_files()
+
+    def close_page_stores(self):
+        """Close response cache and write last batch of page archive"""
+        if self.cache is not None:
+            self.cache.close()
+        if self.archive is not None:
+            self.archive.close()
+
+    def replay(self):
+        """Re-extract products and reviews from archived pages in parse pool without network and upsert them"""
+        logging.info('Start to replay archived pages')
+        start_time = time.time()
+        self.replay_time = start_time
+        self.replayed_review_pages = {}
+        # category pages go first, so products of product and review pages are stored
+        for page_type in ('category', 'product', 'review'):
+            tasks = [(self.archive.path, segment, offset, length, urls, self.backend)
+                     for segment, offset, length, urls in self.archive.get_batches(page_type)]
+            if self.parse_pool is not None:
+                batches = self.parse_pool.imap_unordered(extract_archived_batch, tasks)
+            else:
+                batches = (extract_archived_batch(*task) for task in tasks)
+            pages_count = 0
+            for extracted in batches:
+                self.save_replayed_pages(page_type, extracted)
+                pages_count += len(extracted)
+            logging.info('{} archived {} pages replayed in {:.0f} sec'.format(pages_count, page_type,
+                                                                             time.time() - start_time))
+        self.finish_replayed_reviews()
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+        self.close_page_stores()
+        logging.info('Finish to replay archive')
+        self.export_files()
+
+    def save_replayed_pages(self, page_type, extracted):
+        """
+        Upsert data extracted from archived pages of one type
+        :param page_type: category, product or review
+        :type page_type: str
+        :param extracted: (url, page type, fetch time, extracted data) tuples of extract_archived_batch
+        :type extracted: list
+        """
+        url_regex = dict(PAGE_TYPES)[page_type]
+        pages = [(url_regex.search(url), fetched_at, data) for url, _, fetched_at, data in extracted
+                 if data is not None]
+        if page_type == 'category':
+            self.mdb.add_listed_products([product for _, _, (products, _) in pages for product in products])
+        elif page_type == 'product':
+            self.mdb.update_products({int(match.group(1)): data for match, _, data in pages})
+        else:
+            review_pages = []
+            for match, fetched_at, (reviews, pages_count) in pages:
+                product_id, page = int(match.group(1)), int(match.group(2))
+                review_pages.append((product_id, page, reviews))
+                product_pages = self.replayed_review_pages.setdefault(product_id, [None, set(), 0])
+                product_pages[1].add(page)
+                # reviews saved after newest archived page of product are kept
+                product_pages[2] = max(product_pages[2], fetched_at)
+                if page == 1:
+                    # products with less than 7 reviews have no pagination
+                    product_pages[0] = pages_count or 1
+            self.mdb.replace_review_pages(review_pages, self.replay_time)
+
+    def finish_replayed_reviews(self):
+        """
+        Delete reviews superseded by replayed ones and update reviews counts, reviews of products which review pages
+        are not all archived are kept
+        """
+        complete = [(product_id, fetched_at)
+                    for product_id, (pages_count, pages, fetched_at) in self.replayed_review_pages.items()
+                    if pages_count is not None and pages.issuperset(range(1, pages_count + 1))]
+        deleted = 0
+        for products in chunkify(complete, self.chunk_size):
+            deleted += self.mdb.delete_superseded_reviews(dict(products), self.replay_time)
+        for product_ids in chunkify(list(self.replayed_review_pages), self.chunk_size):
+            self.mdb.update_reviews_counts(product_ids)
+        logging.info('{} superseded reviews deleted, {} of {} products have not all review pages archived'.format(
+            deleted, len(self.replayed_review_pages) - len(complete), len(self.replayed_review_pages)))
+
+    def export_files(self):
+        """Export parsed data in chosen format"""
+        if self.export_format == 'parquet':
+            self.make_parquet_files()
+        else:
+            self.make_products_csv_file()
+            self.make_reviews_csv_file()
+
+    def parse_products(self):
+        """Scrape category, parse inner pages and reviews, db updates are made by write-behind writer"""
         logging.info('Start to scrape products')
-        scraped_products = self.dresslily_scraper.scrape_products()
+        # every category page is saved as soon as it is scraped, pages done before restart are skipped
+        self.dresslily_scraper.scrape_products(self.crawl_run['pages_done'], self.crawl_run['pages_count'],
+                                               self.save_category_page)
         logging.info('Products scraped')
 
-        logging.info('Start upload product to db')
-        self.mdb.add_products(scraped_products)
-
         logging.info('Getting not parsed products from db')
-        not_parsed_product = list(self.mdb.product_collection.find({'reviews': {'$exists': False}},
-                                                                   {'_id': 1, 'url': 1}))
+        not_parsed_product = self.get_not_parsed_products()
 
         logging.info('Start to parse {} products'.format(len(not_parsed_product)))
-        pool = ThreadPool(self.pool_size)
-        chunks = list(chunkify(not_parsed_product, self.chunk_size))
-        for n, chunk in enumerate(chunks):
-            logging.info('Start to parse {}/{} chunk'.format(n+1, len(chunks)))
-            parsed_chunk = list(pool.map(self.dresslily_parser.parse_single_product, chunk))
-
-            logging.info('Chunk parsing is finished, start update product in db')
-            self.mdb.add_products(parsed_chunk)
-            logging.info('Start to parse reviews chunk')
-            parsed_review_chunk = list(pool.map(self.dresslily_parser.parse_product_reviews, chunk))
-            logging.info('Review chunk parsing is finished, start update product in db')
-            self.mdb.add_products(parsed_review_chunk)
-            logging.info('{}/{} chunk processing finished'.format(n + 1, len(chunks)))
+        # product pages, reviews and db writing run concurrently, every product goes through stages independently
+        pipeline = Pipeline(self.executor)
+        pipeline.add_stage('product pages', self.parse_single_product, workers=self.pool_size, lane='crawl')
+        pipeline.add_stage('reviews', self.parse_product_reviews, workers=self.pool_size, lane='crawl')
+        pipeline.add_stage('db writer', self.save_product, workers=2, queue_size=self.chunk_size * 2, lane='crawl')
+        pipeline.run(not_parsed_product)
+        self.executor.log_stats()
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+        self.close_page_stores()
+        self.writer.flush()
+        self.finish_crawl_run()
+        logging.info('Finish to parse dresslily')
+
+    def finish_crawl_run(self):
+        """Finish crawl run only if all category pages are done, otherwise next run resumes it"""
+        pages_count = self.crawl_run['pages_count']
+        if not pages_count:
+            logging.error('Category pages count is unknown, crawl run is left unfinished')
+            return
+        missing_pages = set(range(1, pages_count + 1)) - set(self.crawl_run['pages_done'])
+        if missing_pages:
+            logging.error('{} category pages are not done, crawl run is left unfinished'.format(len(missing_pages)))
+            return
+        self.mdb.finish_crawl_run(self.crawl_run['_id'])
+
+    def save_category_page(self, page, products, pages_count):
+        """
+        Save category page products and mark page as done in crawl run
+        :param page: category page number
+        :type page: int
+        :param products: scraped page products
+        :type products: list
+        :param pages_count: category pages count
+        :type pages_count: int, None
+        """
+        # crawl state is set only for new products, so already parsed ones are not crawled again
+        self.mdb.add_listed_products(products)
+        self.mdb.add_crawl_run_page(self.crawl_run['_id'], page, pages_count)
+        self.crawl_run['pages_done'].append(page)
+        if pages_count:
+            self.crawl_run['pages_count'] = pages_count
+
+    async def save_category_page_async(self, page, products, pages_count):
+        """
+        save_category_page in default thread pool, so db writes don't block event loop
+        :type page: int
+        :type products: list
+        :type pages_count: int, None
+        """
+        await asyncio.get_event_loop().run_in_executor(None, self.save_category_page, page, products, pages_count)
+
+    def get_not_parsed_products(self):
+        """
+        Products which reviews must be parsed, all products in incremental mode
+        :rtype: list
+        """
+        if self.incremental:
+            return list(self.mdb.get_products_by_state(CRAWL_STATES, {'_id': 1, 'url': 1, 'review_pages_done': 1}))
+        return self.mdb.get_pending_products()
+
+    def mark_product_failed(self, product, fields=None, block=True):
+        """
+        :type product: dict
+        :param fields: already parsed product fields which are saved with failed state
+        :type fields: dict, None
+        :param block: if False, product is not queued when writer queue is full
+        :type block: bool
+        :return: True if product is queued
+        :rtype: bool
+        """
+        return self.writer.put(dict(fields or {}, _id=product['_id'], **self.mdb.crawl_state_fields('failed')),
+                               block=block)
+
+    async def write_async(self, put, *args):
+        """
+        Call writer put method on event loop if writer queue has room,
+        otherwise wait for room in default thread pool, so full queue never blocks event loop
+        :param put: method queueing into writer, with block keyword argument and queued flag result
+        :type put: callable
+        """
+        if not put(*args, block=False):
+            await asyncio.get_event_loop().run_in_executor(None, partial(put, *args))
 
+    @staticmethod
+    def get_page_fields(product):
+        """
+        :param product: product with parsed inner page
+        :type product: dict
+        :return: product fields without reviews and review pages cursor, which is updated by review pages directly
+        :rtype: dict
+        """
+        return {key: value for key, value in product.items() if key not in ('reviews', 'review_pages_done')}
+
+    def parse_single_product(self, product):
+        """
+        Parse product inner page and save it with page_parsed state
+        :type product: dict
+        :return: parsed product, None if product page is not downloaded
+        :rtype: dict, None
+        """
+        if product.get('crawl_state') == 'page_parsed':
+            # page is parsed before restart, only reviews are left
+            return product
+        try:
+            parsed_product = self.dresslily_parser.parse_single_product(product)
+        except Exception:
+            logging.exception('Except on parsing {} product page'.format(product['_id']))
+            parsed_product = None
+        return self.save_parsed_page(product, parsed_product)
+
+    def save_parsed_page(self, product, parsed_product):
+        """
+        Save product with page_parsed state or mark it failed
+        :param product: product from db
+        :type product: dict
+        :param parsed_product: product updated with inner page data, None if page is not parsed
+        :type parsed_product: dict, None
+        :return: parsed product, None if product is failed
+        :rtype: dict, None
+        """
+        if parsed_product is None:
+            # product is retried on next run
+            self.mark_product_failed(product)
+            return None
+        self.put_parsed_page(parsed_product)
+        return parsed_product
+
+    def put_parsed_page(self, parsed_product, block=True):
+        """
+        Queue product with page_parsed state
+        :param parsed_product: product updated with inner page data
+        :type parsed_product: dict
+        :param block: if False, product is not queued when writer queue is full
+        :type block: bool
+        :return: True if product is queued
+        :rtype: bool
+        """
+        parsed_product.update(self.mdb.crawl_state_fields('page_parsed'))
+        return self.writer.put(self.get_page_fields(parsed_product), block=block)
+
+    def parse_product_reviews(self, product):
+        """
+        Parse product reviews, in incremental mode only reviews newer than stored ones
+        :type product: dict
+        :return: product with reviews, None if reviews are failed
+        :rtype: dict, None
+        """
+        try:
+            known_reviews = self.mdb.get_known_reviews(product['_id']) if self.incremental else None
+            # every review page is queued into writer as soon as it is scraped, pages done before restart are skipped
+            parsed_product = self.dresslily_parser.parse_product_reviews(
+                product, known_reviews, partial(self.put_review_page, product['_id']))
+        except Exception:
+            logging.exception('Except on parsing {} product reviews'.format(product['_id']))
+            parsed_product = None
+        if parsed_product is None:
+            # only this product is failed, its parsed page fields and saved review pages are kept,
+            # so only failed review pages are scraped on retry
+            self.mark_product_failed(product, self.get_page_fields(product))
+            return None
+        # product is counted when it is written after its review pages
+        parsed_product['reviews_count'] = REVIEWS_COUNT
+        return parsed_product
+
+    def put_review_page(self, product_id, page, reviews, block=True):
+        """
+        Queue scraped review page into writer
+        :param product_id: product id
+        :type product_id: int
+        :param page: review page number
+        :type page: int
+        :param reviews: page reviews
+        :type reviews: list
+        :param block: if False, page is not queued when writer queue is full
+        :type block: bool
+        :return: True if page is queued
+        :rtype: bool
+        """
+        if self.archive is not None:
+            # page is archived, so its reviews can be superseded by replay even if they are saved after page fetch
+            reviews = [dict(review, page_archived=True) for review in reviews]
+        return self.writer.put_review_page(product_id, page, reviews, block=block)
+
+    def save_product(self, product, block=True):
+        """
+        Save product with reviews_parsed state, reviews are saved page by page before
+        :type product: dict
+        :param block: if False, product is not queued when writer queue is full
+        :type block: bool
+        :return: True if product is queued
+        :rtype: bool
+        """
+        product.pop('reviews', None)
+        # review pages cursor is reset, so next incremental run fetches pages again
+        product['review_pages_done'] = []
+        product.update(self.mdb.crawl_state_fields('reviews_parsed'))
+        return self.writer.put(product, block=block)
+
+    async def run_async(self):
+        """Manage scraping, parsing and db updating with asyncio engine"""
+        # unfinished run is resumed from its checkpoints
+        self.crawl_run = self.mdb.start_crawl_run()
+        async with self.downloader:
+            logging.info('Start to scrape products')
+            # every category page is saved as soon as it is scraped, pages done before restart are skipped
+            await self.dresslily_scraper.scrape_products_async(self.crawl_run['pages_done'],
+                                                               self.crawl_run['pages_count'],
+                                                               self.save_category_page_async)
+            logging.info('Products scraped')
+
+            logging.info('Getting not parsed products from db')
+            not_parsed_product = self.get_not_parsed_products()
+
+            logging.info('Start to parse {} products'.format(len(not_parsed_product)))
+            await self.parse_products_async(not_parsed_product)
+
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+        self.close_page_stores()
+        self.writer.flush()
+        self.finish_crawl_run()
         logging.info('Finish to parse dresslily')
-        # Memory clearing
-        pool.close()
-        pool.join()
-        gc.collect()
-        self.make_products_csv_file()
-        self.make_reviews_csv_file()
+
+    async def parse_products_async(self, products):
+        """
+        Run every product through page, reviews and db stages on its own, up to async_products at once,
+        so slow product never holds others and new product is started as soon as any product is finished
+        :param products: products from db
+        :type products: list
+        """
+        semaphore = asyncio.Semaphore(self.async_products)
+        tasks = set()
+        start_time = time.time()
+        for n, product in enumerate(products):
+            await semaphore.acquire()
+            task = asyncio.ensure_future(self.parse_product_async(product))
+            task.add_done_callback(lambda _: semaphore.release())
+            task.add_done_callback(tasks.discard)
+            tasks.add(task)
+            if (n + 1) % 1000 == 0:
+                logging.info('{} products started ({:.0f} sec)'.format(n + 1, time.time() - start_time))
+        if tasks:
+            await asyncio.wait(tasks)
+        logging.info('{} products parsed in {:.0f} sec'.format(len(products), time.time() - start_time))
+
+    async def parse_product_async(self, product):
+        """
+        Parse product page and reviews, product is saved after every stage by write-behind writer
+        :type product: dict
+        """
+        if product.get('crawl_state') != 'page_parsed':
+            try:
+                parsed_product = await self.dresslily_parser.parse_single_product_async(product)
+            except Exception:
+                logging.exception('Except on parsing {} product page'.format(product['_id']))
+                parsed_product = None
+            if parsed_product is None:
+                # product is retried on next run
+                await self.write_async(self.mark_product_failed, product)
+                return
+            await self.write_async(self.put_parsed_page, parsed_product)
+            product = parsed_product
+        try:
+            known_reviews = None
+            if self.incremental:
+                known_reviews = await asyncio.get_event_loop().run_in_executor(None, self.mdb.get_known_reviews,
+                                                                               product['_id'])
+            # every review page is queued into writer as soon as it is scraped, pages done before restart are skipped
+            parsed_product = await self.dresslily_parser.parse_product_reviews_async(
+                product, known_reviews, partial(self.write_async, self.put_review_page, product['_id']))
+        except Exception:
+            logging.exception('Except on parsing {} product reviews'.format(product['_id']))
+            parsed_product = None
+        if parsed_product is None:
+            await self.write_async(self.mark_product_failed, product, self.get_page_fields(product))
+            return
+        parsed_product['reviews_count'] = REVIEWS_COUNT
+        await self.write_async(self.save_product, parsed_product)
 
     def make_products_csv_file(self):
-        """Convert db records into products csv"""
-        parsed_products = self.mdb.product_collection.find({'rating': {'$exists': True}})
-        to_df_products = []
-        for product in parsed_products:
-            processed_product = dict()
-            processed_product['productId'] = product['_id']
-            processed_product['productUrl'] = product['url']
-            processed_product['name'] = product['name']
-            processed_product['discount'] = product['discount']
-            processed_product['discountedPrice'] = product['discount_price']
-            processed_product['originalPrice'] = product['original_price']
-            processed_product['rating'] = product['rating']
-            processed_product['productInfo'] = product['product_info']
-            to_df_products.append(processed_product)
-        df = pd.DataFrame(to_df_products)
-        df.to_csv(self.product_file_name, index=False)
+        """Stream parsed products from db into products csv"""
+        export_csv(self.product_file_name, PRODUCT_CSV_COLUMNS,
+                   self.mdb.get_export_products([field for _, field in PRODUCT_CSV_COLUMNS]))
 
     def make_reviews_csv_file(self):
-        """Convert db records into reviews csv"""
-        parsed_products = self.mdb.product_collection.find({'reviews': {'$gt': []}}, {'_id': 1, 'reviews': 1})
-        to_df_reviews = []
-        for product in parsed_products:
-            for review in product['reviews']:
-                processed_review = dict()
-                processed_review['productId'] = product['_id']
-                processed_review['rating'] = review['rating']
-                processed_review['timestamp'] = review['timestamp']
-                processed_review['text'] = review['text']
-                processed_review['size'] = review['size']
-                processed_review['color'] = review['color']
-                to_df_reviews.append(processed_review)
-        df = pd.DataFrame(to_df_reviews)
-        df.to_csv(self.reviews_file_name, index=False)
+        """Stream reviews from db into reviews csv"""
+        export_csv(self.reviews_file_name, REVIEW_CSV_COLUMNS,
+                   self.mdb.get_export_reviews([field for _, field in REVIEW_CSV_COLUMNS]))
+
+    def make_parquet_files(self):
+        """Append products and reviews changed since previous export into partitioned parquet datasets"""
+        # records changed during export are exported next time
+        export_time = time.time()
+        partition = 'export_date={}'.format(time.strftime('%Y-%m-%d', time.gmtime(export_time)))
+        products_since = self.mdb.get_export_watermark('products_parquet')
+        products = self.mdb.get_changed_products([field for _, field in PRODUCT_CSV_COLUMNS], products_since,
+                                                 export_time)
+        ParquetExporter(os.path.join(self.export_dir, 'products'), PRODUCT_PARQUET_SCHEMA).export(
+            self.rename_fields(products, PRODUCT_CSV_COLUMNS), partition)
+        self.mdb.set_export_watermark('products_parquet', export_time)
+
+        reviews_since = self.mdb.get_export_watermark('reviews_parquet')
+        reviews = self.mdb.get_changed_reviews([field for _, field in REVIEW_CSV_COLUMNS], reviews_since, export_time)
+        ParquetExporter(os.path.join(self.export_dir, 'reviews'), REVIEW_PARQUET_SCHEMA,
+                        REVIEW_DICTIONARY_COLUMNS).export(self.rename_fields(reviews, REVIEW_CSV_COLUMNS), partition)
+        self.mdb.set_export_watermark('reviews_parquet', export_time)
+
+    @staticmethod
+    def rename_fields(rows, columns):
+        """
+        :param rows: db documents iterator
+        :type rows: iterable
+        :param columns: list of (column, db field) tuples
+        :type columns: list
+        :return: rows with column names
+        :rtype: iterator
+        """
+        for row in rows:
+            yield {column: row.get(field) for column, field in columns}
 
 
 if __name__ == '__main__':
-    args = sys.argv[1:]
-    product_file_name_arg = args[0]
-    reviews_file_name_arg = args[1]
-    mh = ManagementHelper(product_file_name_arg, reviews_file_name_arg)
-    mh.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('product_file_name')
+    parser.add_argument('reviews_file_name')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='download engine, threads uses shared executor lanes, asyncio uses single event loop')
+    parser.add_argument('--domain', default='https://www.dresslily.com',
+                        help='site domain, can be pointed to local stand-in http server')
+    parser.add_argument('--no-proxy', action='store_true', help='make requests without proxies')
+    parser.add_argument('--backend', choices=['bs4', 'lxml', 'stream'], default='bs4',
+                        help='html extraction backend, stream parses product and review pages while downloading '
+                             'and stops download when all data is found')
+    parser.add_argument('--incremental', action='store_true',
+                        help='refresh all stored products, fetching review pages only until known reviews')
+    parser.add_argument('--migrate-reviews', action='store_true',
+                        help='move embedded product reviews into reviews collection and exit')
+    parser.add_argument('--migrate-crawl-state', action='store_true',
+                        help='set crawl state of products stored before crawl state was added and exit')
+    parser.add_argument('--export', choices=['csv', 'parquet'], default='csv',
+                        help='csv rewrites whole files, parquet appends records changed since previous export')
+    parser.add_argument('--export-dir', default='export', help='parquet datasets directory')
+    parser.add_argument('--parse-processes', type=int, default=None,
+                        help='html parsing processes, cpu count by default, 0 parses pages in downloading threads')
+    parser.add_argument('--request-per-min', type=float, default=None,
+                        help='max requests per minute through single proxy, by default only host limits are applied')
+    parser.add_argument('--hedge', action='store_true',
+                        help='duplicate requests slower than 95th latency percentile through other proxy')
+    parser.add_argument('--cache-dir', default=None,
+                        help='on-disk response cache directory, pages are requested again only after their ttl')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='max response cache size in MB, least recently used pages are evicted')
+    parser.add_argument('--archive-dir', default=None,
+                        help='raw pages archive directory, downloaded pages are archived into it if set')
+    parser.add_argument('--replay', action='store_true',
+                        help='re-extract products and reviews from archive in --archive-dir without network and exit')
+    args = parser.parse_args()
+    if args.migrate_reviews:
+        MongoDBStorage().migrate_embedded_reviews()
+        sys.exit()
+    if args.migrate_crawl_state:
+        MongoDBStorage().migrate_crawl_state()
+        sys.exit()
+    if args.replay and not args.archive_dir:
+        parser.error('--replay requires --archive-dir')
+    mh = ManagementHelper(args.product_file_name, args.reviews_file_name, engine=args.engine, domain=args.domain,
+                          use_proxy=not args.no_proxy, backend=args.backend, incremental=args.incremental,
+                          export_format=args.export, export_dir=args.export_dir,
+                          parse_processes=args.parse_processes, hedge=args.hedge, cache_dir=args.cache_dir,
+                          cache_size=args.cache_size, archive_dir=args.archive_dir, replay=args.replay,
+                          request_per_min=args.request_per_min)
+    if args.replay:
+        mh.replay()
+    else:
+        mh.run()
@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import datetime
+import logging
+import random
+from aiohttp import web
+
+SIZES = ['XS', 'S', 'M', 'L', 'XL', None]
+COLORS = ['Black', 'White', 'Light Gray', 'Wine Red', None]
+MATERIALS = ['Polyester', 'Cotton', 'Cotton Blend', 'Fleece']
+STYLES = ['Casual', 'Sporty', 'Streetwear']
+
+PAGE = '''<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>{title} - Dresslily</title>
+</head>
+<body>
+{body}
+<div class="site-footer">Copyright Dresslily</div>
+</body>
+</html>
+'''
+CATEGORY_PRODUCT = '''<div class="js-good js-dlGood js_logsss_browser js_logsss_event_ps category-good" data-sku="{id}">
+    <div class="category-good-img">
+        <a href="{url}"><img src="/img/{id}.jpg" alt=""></a>
+    </div>
+    <div class="category-good-info">
+        <a class="goods-name-link js_logsss_click_delegate_ps" href="{url}">{name}</a>
+        <p class="category-good-price">
+            <span class="js-dlShopPrice my-shop-price category-good-price-sale" data-orgp="{price:.2f}">${price:.2f}</span>
+            <span class="my-shop-price category-good-price-market dl-has-rrp-tag" data-orgp="{market_price:.2f}">${market_price:.2f}</span>
+        </p>
+    </div>
+</div>'''
+REVIEW = '''<div class="reviewlist clearfix">
+    <div class="review-stars">{stars}</div>
+    <span class="reviewtime">{time}</span>
+    <p class="reviewcon">{text}</p>
+    <div class="review-attr">{attributes}</div>
+</div>'''
+
+
+class StandInSite:
+    """
+    Local stand-in of dresslily hoodies category, pages have same markup as real site and are generated from product id,
+    so every run and every engine gets same data. Latency is added to every response to simulate remote site.
+    """
+    def __init__(self, pages_count=20, products_per_page=60, max_review_pages=5, latency=0.05, jitter=0.05,
+                 seed=0):
+        """
+        :param pages_count: category pages count
+        :type pages_count: int
+        :param products_per_page: products on every category page
+        :type products_per_page: int
+        :param max_review_pages: max review pages of product, 6 reviews on page
+        :type max_review_pages: int
+        :param latency: min response delay in seconds
+        :type latency: float
+        :param jitter: max random delay added to latency in seconds
+        :type jitter: float
+        :param seed: data generation seed
+        :type seed: int
+        """
+        self.pages_count = pages_count
+        self.products_per_page = products_per_page
+        self.max_review_pages = max_review_pages
+        self.latency = latency
+        self.jitter = jitter
+        self.seed = seed
+        self.requests = 0
+
+    def get_random(self, *key):
+        return random.Random('{}|{}'.format(self.seed, '|'.join(map(str, key))))
+
+    def get_product_id(self, page, position):
+        return 1000000 + page * 1000 + position
+
+    def get_reviews_count(self, product_id):
+        return self.get_random('reviews', product_id).randint(0, self.max_review_pages * 6)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/hoodies-c-181-page-{page:\\d+}.html', self.category_page)
+        app.router.add_get('/{name}-product{product_id:\\d+}.html', self.product_page)
+        app.router.add_get('/m-review-a-view_review-goods_id-{product_id:\\d+}-page-{page:\\d+}.htm', self.review_page)
+        return app
+
+    async def respond(self, title, body):
+        self.requests += 1
+        await asyncio.sleep(self.latency + random.random() * self.jitter)
+        return web.Response(text=PAGE.format(title=title, body=body), content_type='text/html')
+
+    @staticmethod
+    def get_pager(pages_count):
+        """
+        :return: pagination block, its second to last item is pages count
+        :rtype: str
+        """
+        items = ''.join('<li><a href="#">{}</a></li>'.format(page) for page in range(1, pages_count + 1))
+        return '<div class="site-pager"><ul><li class="prev"><span>&lt;</span></li>{}' \
+               '<li class="next"><a href="#">&gt;</a></li></ul></div>'.format(items)
+
+    async def category_page(self, request):
+        page = int(request.match_info['page'])
+        if not 1 <= page <= self.pages_count:
+            raise web.HTTPNotFound()
+        base_url = '{}://{}'.format(request.scheme, request.host)
+        products = []
+        for position in range(self.products_per_page):
+            product_id = self.get_product_id(page, position)
+            rand = self.get_random('product', product_id)
+            price = rand.randint(900, 4000) / 100
+            products.append(CATEGORY_PRODUCT.format(
+                id=product_id, url='{}/hoodie-{}-product{}.html'.format(base_url, product_id, product_id),
+                name='Hoodie {} &amp; Pocket'.format(product_id), price=price,
+                market_price=price * rand.choice([1, 1.2, 1.5])))
+        body = '<div class="category-list">\n{}\n</div>\n{}'.format('\n'.join(products),
+                                                                     self.get_pager(self.pages_count))
+        return await self.respond('Hoodies', body)
+
+    async def product_page(self, request):
+        product_id = int(request.match_info['product_id'])
+        rand = self.get_random('product', product_id)
+        rating = '<span class="review-avg-rate">{:.1f}</span>'.format(rand.randint(10, 50) / 10) \
+            if self.get_reviews_count(product_id) else ''
+        info = '<strong>Material:</strong> {}<br><strong>Style:</strong> {}<br>'.format(
+            ','.join(rand.sample(MATERIALS, 2)), rand.choice(STYLES))
+        body = '<div class="goods-info"><h1 class="goods-info-title">Hoodie {}</h1>' \
+               '<div class="goods-review-summary">{}</div></div>' \
+               '<div class="goods-desc"><div class="xxkkk"><div class="xxkkk20">{}</div></div></div>'.format(
+                   product_id, rating, info)
+        return await self.respond('Hoodie {}'.format(product_id), body)
+
+    async def review_page(self, request):
+        product_id = int(request.match_info['product_id'])
+        page = int(request.match_info['page'])
+        reviews_count = self.get_reviews_count(product_id)
+        pages_count = max((reviews_count + 5) // 6, 1)
+        if page > pages_count:
+            raise web.HTTPNotFound()
+        reviews = []
+        for position in range((page - 1) * 6, min(page * 6, reviews_count)):
+            rand = self.get_random('review', product_id, position)
+            rating = rand.randint(1, 5)
+            attributes = ''.join('<span>{}: {}</span>'.format(name, value)
+                                 for name, value in (('Size', rand.choice(SIZES)), ('Color', rand.choice(COLORS)))
+                                 if value)
+            # reviews are sorted from newest
+            review_time = datetime.datetime(2021, 1, 1) - datetime.timedelta(days=position,
+                                                                             seconds=rand.randint(0, 86399))
+            reviews.append(REVIEW.format(stars='<i class="icon-star-black"></i>' * rating +
+                                         '<i class="icon-star-grey"></i>' * (5 - rating),
+                                         time=review_time.strftime('%b,%d %Y %H:%M:%S'),
+                                         text='Review {} of {} &amp; text'.format(position, product_id),
+                                         attributes=attributes))
+        # products with less than 7 reviews have no pagination
+        pager = self.get_pager(pages_count) if pages_count > 1 else ''
+        body = '<div class="review-list">\n{}\n</div>\n{}'.format('\n'.join(reviews), pager)
+        return await self.respond('Reviews', body)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Local stand-in of dresslily site for engines comparison')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--pages', type=int, default=20, help='category pages count')
+    parser.add_argument('--products-per-page', type=int, default=60)
+    parser.add_argument('--max-review-pages', type=int, default=5, help='max review pages of product')
+    parser.add_argument('--latency', type=float, default=0.05, help='min response delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.05, help='max random delay added to latency in seconds')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    site = StandInSite(args.pages, args.products_per_page, args.max_review_pages, args.latency, args.jitter)
+    web.run_app(site.make_app(), host=args.host, port=args.port)
@@ -3,17 +3,33 @@ sys.path.append("..")
 from bs4 import BeautifulSoup
 import logging
 import traceback
+import asyncio
 from multiprocessing.pool import ThreadPool
-from functools import reduce
 import re
 import datetime
+import hashlib
 import gc
+from helpers.page_archive import PageArchive
+from helpers.parse_pool import PoolParsingMixin
+from scrapers.dresslily_lxml import DresslilyLxmlExtractor, ProductPageStreamParser, ReviewPageStreamParser
 
+# (page type, url regex) pairs for response cache ttl policies and page archive, review and product regexes
+# capture product id and review page number
+PAGE_TYPES = [('category', re.compile(r'-c-\d+-page-\d+\.html')),
+              ('review', re.compile(r'view_review-goods_id-(\d+)-page-(\d+)')),
+              ('product', re.compile(r'product(\d+)\.html'))]
 
-class DresslilyScraper:
-    def __init__(self, downloader, domain):
+
+class DresslilyScraper(PoolParsingMixin):
+    def __init__(self, downloader, domain, backend='bs4', parse_pool=None, page_executor=None):
         self.downloader = downloader
         self.domain = domain
+        # extraction backend, bs4, lxml or stream, category pages are parsed by lxml in stream mode
+        self.backend = backend
+        # pages are parsed in worker processes if set
+        self.parse_pool = parse_pool
+        # executor lane for category pages, own thread pool is created for every scraping if not set
+        self.page_executor = page_executor
         self.hoodie_page_url = self.domain + '/hoodies-c-181-page-{}.html'
 
     @staticmethod
@@ -100,7 +116,8 @@ class DresslilyScraper:
         discount = round((100 * (original_price - discount_price)) / original_price)
         return original_price, discount_price, discount
 
-    def scrape_single_product(self, product):
+    @staticmethod
+    def scrape_single_product(product):
         """
         Scrape all data from product on category page
         :param product: single product soup object
@@ -110,32 +127,20 @@ class DresslilyScraper:
         """
         product_info = {}
         try:
-            product_info['_id'] = self.get_product_id(product)
-            product_info['url'] = self.get_product_url(product)
-            product_info['name'] = self.get_product_name(product)
+            product_info['_id'] = DresslilyScraper.get_product_id(product)
+            product_info['url'] = DresslilyScraper.get_product_url(product)
+            product_info['name'] = DresslilyScraper.get_product_name(product)
             product_info['original_price'], \
             product_info['discount_price'], \
-            product_info['discount'] = self.get_prices(product)
+            product_info['discount'] = DresslilyScraper.get_prices(product)
             return product_info
         except Exception as e:
             logging.error(traceback.format_exc())
             logging.error('Receive exception on product scraping')
             return None
 
-    def get_link_products(self, link):
-        """
-        Scrape all products from category link
-        :param link: category page link
-        :type link: str
-        :return: scraped page products
-        :rtype: list
-        """
-        response = self.downloader.get(link)
-        soup = BeautifulSoup(response, 'lxml')
-        scraped_products = self.scrape_category_page(soup)
-        return scraped_products
-
-    def scrape_category_page(self, soup):
+    @staticmethod
+    def scrape_category_page(soup):
         """
         Scrape category page soup
         :param soup: category page soup
@@ -143,50 +148,174 @@ class DresslilyScraper:
         :return: scraped page products
         :rtype: list
         """
-        products = self.get_products_on_category_page(soup)
-        scraped_products = [product for product in map(self.scrape_single_product, products) if product]
+        products = DresslilyScraper.get_products_on_category_page(soup)
+        scraped_products = [product for product in map(DresslilyScraper.scrape_single_product, products) if product]
         return scraped_products
 
-    def scrape_products(self):
+    @staticmethod
+    def parse_category_page(response, backend='bs4'):
+        """
+        Scrape products and pages count from category page html
+        :param response: category page html
+        :type response: str
+        :param backend: extraction backend, bs4, lxml or stream
+        :type backend: str
+        :return: scraped page products and pages count
+        :rtype: tuple
+        """
+        if backend in ('lxml', 'stream'):
+            page_tree = DresslilyLxmlExtractor.parse_html(response)
+            return (DresslilyLxmlExtractor.scrape_category_page(page_tree),
+                    DresslilyLxmlExtractor.get_pages_count(page_tree))
+        soup = BeautifulSoup(response, 'lxml')
+        return DresslilyScraper.scrape_category_page(soup), DresslilyScraper.get_pages_count(soup)
+
+    def get_page_products(self, page):
+        """
+        Scrape all products from category page
+        :param page: category page number
+        :type page: int
+        :return: page number and scraped page products, products are None if page is not downloaded
+        :rtype: tuple
+        """
+        response = self.downloader.get(self.hoodie_page_url.format(page))
+        if not response:
+            logging.error('Can`t get {} page'.format(page))
+            return page, None
+        scraped_products, _ = self.parse(self.parse_category_page, response, self.backend)
+        return page, scraped_products
+
+    def scrape_products(self, pages_done=None, pages_count=None, on_page=None):
         """
         Scraping all pages from category
-        :return: scraped page products
+        :param pages_done: numbers of pages scraped before, they are skipped
+        :type pages_done: list, None
+        :param pages_count: category pages count known from previous run, first page is requested if not set
+        :type pages_count: int, None
+        :param on_page: called with page number, page products and pages count when page is scraped,
+            products are not collected in memory if set
+        :type on_page: callable, None
+        :return: scraped page products, empty if on_page is set
         :rtype: list
         """
         all_products = []
-        # parse first page separately because need to get pages count
-        first_page_response = self.downloader.get(self.hoodie_page_url.format(1))
-        if not first_page_response:
-            logging.error('Can`t get first page')
-            return all_products
-        first_page_soup = BeautifulSoup(first_page_response, 'lxml')
-        # get products from first page
-        first_page_products = self.scrape_category_page(first_page_soup)
-        all_products.extend(first_page_products)
-        logging.info('first page scraped')
-        pages_count = DresslilyScraper.get_pages_count(first_page_soup)
+        pages_done = set(pages_done or ())
+        if 1 not in pages_done or not pages_count:
+            # parse first page separately because need to get pages count
+            first_page_response = self.downloader.get(self.hoodie_page_url.format(1))
+            if not first_page_response:
+                logging.error('Can`t get first page')
+                return all_products
+            # get products and pages count from first page
+            first_page_products, pages_count = self.parse(self.parse_category_page, first_page_response,
+                                                          self.backend)
+            if on_page:
+                on_page(1, first_page_products, pages_count)
+            else:
+                all_products.extend(first_page_products)
+            logging.info('first page scraped')
         if not pages_count:
             logging.error('Found no pages on category scraping')
             return all_products
-        logging.info('found {} pages'.format(pages_count))
+        logging.info('found {} pages, {} pages scraped before'.format(pages_count, len(pages_done - {1})))
         # parse all pages
-        pages_links = map(lambda page: self.hoodie_page_url.format(page), range(2, pages_count + 1))
-        pool = ThreadPool(50)
-        pool_products_result = list(pool.map(self.get_link_products, pages_links))
-        # concat pool result in flat list
-        scraped_products = reduce(lambda first, second: first + second, pool_products_result)
+        pages = [page for page in range(2, pages_count + 1) if page not in pages_done]
+        pool = self.page_executor or ThreadPool(50)
+        # with callback every page is handled as soon as it is scraped
+        pages_products = pool.imap_unordered(self.get_page_products, pages) if on_page else \
+            pool.map(self.get_page_products, pages)
+        failed_pages = []
+        for page, page_products in pages_products:
+            if page_products is None:
+                failed_pages.append(page)
+                continue
+            if on_page:
+                on_page(page, page_products, pages_count)
+            else:
+                all_products.extend(page_products)
+        if failed_pages:
+            logging.error('{} category pages are not scraped: {}'.format(len(failed_pages), sorted(failed_pages)))
         # clear memory
-        pool.close()
-        pool.join()
+        if self.page_executor is None:
+            pool.close()
+            pool.join()
         gc.collect()
-        all_products.extend(scraped_products)
+        return all_products
+
+    async def get_page_products_async(self, page):
+        """
+        Async version of get_page_products
+        :param page: category page number
+        :type page: int
+        :return: page number and scraped page products, products are None if page is not downloaded
+        :rtype: tuple
+        """
+        response = await self.downloader.get(self.hoodie_page_url.format(page))
+        if not response:
+            logging.error('Can`t get {} page'.format(page))
+            return page, None
+        scraped_products, _ = await self.parse_async(self.parse_category_page, response, self.backend)
+        return page, scraped_products
+
+    async def scrape_products_async(self, pages_done=None, pages_count=None, on_page=None):
+        """
+        Scraping all pages from category with async downloader, all pages are requested concurrently
+        :param pages_done: numbers of pages scraped before, they are skipped
+        :type pages_done: list, None
+        :param pages_count: pages count known from previous run, first page is scraped anyway if it is not set
+        :type pages_count: int, None
+        :param on_page: coroutine function called with page number, page products and pages count when page is
+            scraped, products are not collected in memory if set
+        :type on_page: callable, None
+        :return: scraped page products, empty if on_page is set
+        :rtype: list
+        """
+        all_products = []
+        pages_done = set(pages_done or ())
+        if 1 not in pages_done or not pages_count:
+            # parse first page separately because need to get pages count
+            first_page_response = await self.downloader.get(self.hoodie_page_url.format(1))
+            if not first_page_response:
+                logging.error('Can`t get first page')
+                return all_products
+            first_page_products, pages_count = await self.parse_async(self.parse_category_page,
+                                                                         first_page_response, self.backend)
+            if on_page:
+                await on_page(1, first_page_products, pages_count)
+            else:
+                all_products.extend(first_page_products)
+            logging.info('first page scraped')
+        if not pages_count:
+            logging.error('Found no pages on category scraping')
+            return all_products
+        logging.info('found {} pages, {} pages scraped before'.format(pages_count, len(pages_done - {1})))
+        pages = [page for page in range(2, pages_count + 1) if page not in pages_done]
+        failed_pages = []
+        # every page is handled as soon as it is scraped
+        for page_future in asyncio.as_completed(list(map(self.get_page_products_async, pages))):
+            page, page_products = await page_future
+            if page_products is None:
+                failed_pages.append(page)
+            elif on_page:
+                await on_page(page, page_products, pages_count)
+            else:
+                all_products.extend(page_products)
+        if failed_pages:
+            logging.error('{} category pages are not scraped: {}'.format(len(failed_pages), sorted(failed_pages)))
         return all_products
 
 
-class DresslilyParser:
-    def __init__(self, downloader, domain):
+class DresslilyParser(PoolParsingMixin):
+    def __init__(self, downloader, domain, backend='bs4', review_executor=None, parse_pool=None):
         self.downloader = downloader
         self.domain = domain
+        # extraction backend for product and review pages, bs4, lxml or stream,
+        # stream parses pages while downloading and stops download when all data is found
+        self.backend = backend
+        # executor shared by all products, review pages are fetched concurrently if set
+        self.review_executor = review_executor
+        # pages are parsed in worker processes if set, stream backend parses pages in downloading threads
+        self.parse_pool = parse_pool
         self.review_pattern = self.domain + '/m-review-a-view_review-goods_id-{}-page-{}.htm'
 
     def parse_single_product(self, product):
@@ -194,16 +323,66 @@ class DresslilyParser:
         Updating product with inner page data
         :param product: product data from db
         :type product: dict
-        :return: updated product
-        :rtype: dict
+        :return: updated product, None if product page is not downloaded
+        :rtype: dict, None
+        """
+        if self.backend == 'stream':
+            page_parser = self.downloader.get(product['url'], consumer_factory=ProductPageStreamParser)
+            if not page_parser:
+                logging.error('Can`t get {} product page'.format(product['_id']))
+                return None
+            product.update(page_parser.result())
+        else:
+            response = self.downloader.get(product['url'])
+            if not response:
+                logging.error('Can`t get {} product page'.format(product['_id']))
+                return None
+            product.update(self.parse(self.parse_product_page, response, self.backend))
+        logging.debug('{} product parsed'.format(product['_id']))
+        return product
+
+    async def parse_single_product_async(self, product):
         """
-        response = self.downloader.get(product['url'])
-        soup = BeautifulSoup(response, 'lxml')
-        product['rating'] = self.get_product_rating(soup)
-        product['product_info'] = self.get_product_info(soup)
+        Updating product with inner page data using async downloader
+        :param product: product data from db
+        :type product: dict
+        :return: updated product, None if product page is not downloaded
+        :rtype: dict, None
+        """
+        if self.backend == 'stream':
+            page_parser = await self.downloader.get(product['url'], consumer_factory=ProductPageStreamParser)
+            if not page_parser:
+                logging.error('Can`t get {} product page'.format(product['_id']))
+                return None
+            product.update(page_parser.result())
+        else:
+            response = await self.downloader.get(product['url'])
+            if not response:
+                logging.error('Can`t get {} product page'.format(product['_id']))
+                return None
+            product.update(await self.parse_async(self.parse_product_page, response, self.backend))
         logging.debug('{} product parsed'.format(product['_id']))
         return product
 
+    @staticmethod
+    def parse_product_page(response, backend='bs4'):
+        """
+        Get inner page data from product page html
+        :param response: product page html
+        :type response: str
+        :param backend: extraction backend, bs4, lxml or stream
+        :type backend: str
+        :return: product rating and product info
+        :rtype: dict
+        """
+        if backend in ('lxml', 'stream'):
+            page_tree = DresslilyLxmlExtractor.parse_html(response)
+            return {'rating': DresslilyLxmlExtractor.get_product_rating(page_tree),
+                    'product_info': DresslilyLxmlExtractor.get_product_info(page_tree)}
+        soup = BeautifulSoup(response, 'lxml')
+        return {'rating': DresslilyParser.get_product_rating(soup),
+                'product_info': DresslilyParser.get_product_info(soup)}
+
     @staticmethod
     def get_product_info(product_soup):
         """
@@ -234,59 +413,332 @@ class DresslilyParser:
             rating = None
         return rating
 
-    def parse_product_reviews(self, product):
+    def parse_product_reviews(self, product, known_reviews=None, on_page=None):
         """
-        Parse product reviews
+        Parse product reviews, review pages listed in product review_pages_done are skipped
         :type product: product from db
-        :rtype: dict
-        """
-        product['reviews'] = self.get_product_reviews(product['_id'])
+        :param known_reviews: already stored reviews, if set only new reviews are fetched
+        :type known_reviews: list, None
+        :param on_page: called with page number and page reviews when review page is scraped
+        :type on_page: callable, None
+        :return: product with reviews, None if any review page is not downloaded
+        :rtype: dict, None
+        """
+        reviews = self.get_product_reviews(product['_id'], known_reviews, product.get('review_pages_done'), on_page)
+        if reviews is None:
+            return None
+        product['reviews'] = reviews
         return product
 
-    def get_product_reviews(self, product_id):
+    def get_product_reviews(self, product_id, known_reviews=None, pages_done=None, on_page=None):
         """
         Getting all product reviews
         :param product_id: product id
         :type product_id: int, str
-        :return: list with all reviews
-        :rtype: list
+        :param known_reviews: already stored reviews, if set only new reviews are fetched
+        :type known_reviews: list, None
+        :param pages_done: numbers of review pages saved before, they are skipped except first one
+        :type pages_done: list, None
+        :param on_page: called with page number and page reviews when review page is scraped
+        :type on_page: callable, None
+        :return: list with all reviews or only new ones if known_reviews is set, reviews of pages_done are not included,
+            None if any review page is not downloaded
+        :rtype: list, None
         """
         all_reviews = []
         # parse first page separately because need to get pages count
-        first_review_page_response = self.downloader.get(self.review_pattern.format(product_id, 1))
-        if not first_review_page_response:
-            logging.info('No first review page')
-            return []
-        first_review_page_soup = BeautifulSoup(first_review_page_response, 'lxml')
-        first_page_reviews_raw = self.get_single_page_reviews(first_review_page_soup)
-        # parse reviews on page
-        first_page_reviews = list(map(self.parse_single_review, first_page_reviews_raw))
+        first_review_page = self.get_review_page(self.review_pattern.format(product_id, 1))
+        if not first_review_page:
+            logging.info('No first review page of {} product'.format(product_id))
+            return None
+        first_page_reviews, pages_count = first_review_page
+        if on_page:
+            on_page(1, first_page_reviews)
+        if known_reviews is not None:
+            return self.get_new_reviews(product_id, first_page_reviews, pages_count, known_reviews, on_page)
         all_reviews.extend(first_page_reviews)
-        pages_count = DresslilyScraper.get_pages_count(first_review_page_soup, True)
         if not pages_count:
             # Only reviews < 6
             return all_reviews
-        # getting pages links
-        pages_links = list(map(lambda page: self.review_pattern.format(product_id, page), range(2, pages_count + 1)))
-        # parse all pages
-        pool_result = list(map(self.scrape_review_page, pages_links))
-        scraped_reviews = reduce(lambda first, second: first + second, pool_result)
-        all_reviews.extend(scraped_reviews)
+        pages_done = set(pages_done or ())
+        pages = [page for page in range(2, pages_count + 1) if page not in pages_done]
+        # parse all pages, executor map keeps pages order
+        if self.review_executor:
+            pool_result = self.review_executor.map(lambda page: self.scrape_product_review_page(product_id, page,
+                                                                                                on_page), pages)
+        else:
+            pool_result = [self.scrape_product_review_page(product_id, page, on_page) for page in pages]
+        return self.join_review_pages(product_id, all_reviews, list(pool_result))
+
+    @staticmethod
+    def join_review_pages(product_id, all_reviews, pages_reviews):
+        """
+        :param product_id: product id
+        :type product_id: int, str
+        :param all_reviews: reviews of first page
+        :type all_reviews: list
+        :param pages_reviews: reviews of next pages, None for pages which are not downloaded
+        :type pages_reviews: list
+        :return: reviews of all pages, None if any page is not downloaded, downloaded pages are already saved
+            and only failed ones are scraped on retry
+        :rtype: list, None
+        """
+        failed = sum(page_reviews is None for page_reviews in pages_reviews)
+        if failed:
+            logging.info('{} review pages of {} product are not downloaded'.format(failed, product_id))
+            return None
+        for page_reviews in pages_reviews:
+            all_reviews.extend(page_reviews)
         return all_reviews
 
-    def scrape_review_page(self, link):
+    def scrape_product_review_page(self, product_id, page, on_page=None):
         """
-        Making request to review page link, get all reviews and parse them
+        :param product_id: product id
+        :type product_id: int, str
+        :param page: review page number
+        :type page: int
+        :param on_page: called with page number and page reviews, not called if page is not downloaded
+        :type on_page: callable, None
+        :return: list of one page parsed reviews, None if page is not downloaded
+        :rtype: list, None
+        """
+        review_page = self.get_review_page(self.review_pattern.format(product_id, page))
+        if not review_page:
+            return None
+        page_reviews, _ = review_page
+        if on_page:
+            on_page(page, page_reviews)
+        return page_reviews
+
+    def get_new_reviews(self, product_id, first_page_reviews, pages_count, known_reviews, on_page=None):
+        """
+        Fetch review pages one by one until page contains only known reviews
+        :param product_id: product id
+        :type product_id: int, str
+        :param first_page_reviews: parsed reviews from first page
+        :type first_page_reviews: list
+        :param pages_count: review pages count, None if product has only one page
+        :type pages_count: int, None
+        :param known_reviews: already stored reviews
+        :type known_reviews: list
+        :param on_page: called with page number and page reviews when review page is scraped
+        :type on_page: callable, None
+        :return: reviews which are not stored yet, None if any review page is not downloaded
+        :rtype: list, None
+        """
+        known_hashes = {review.get('hash') or self.get_review_hash(review) for review in known_reviews}
+        newest_timestamp = max((review['timestamp'] for review in known_reviews), default=None)
+        new_reviews = []
+        page, page_reviews = 1, first_page_reviews
+        while True:
+            new_reviews.extend(review for review in page_reviews if review['hash'] not in known_hashes)
+            if self.is_known_page(page_reviews, known_hashes, newest_timestamp):
+                # reviews are sorted from newest, so next pages are known too
+                break
+            if not pages_count or page >= pages_count:
+                break
+            page += 1
+            page_reviews = self.scrape_product_review_page(product_id, page, on_page)
+            if page_reviews is None:
+                logging.info('Review page {} of {} product is not downloaded'.format(page, product_id))
+                return None
+        return new_reviews
+
+    @staticmethod
+    def is_known_page(page_reviews, known_hashes, newest_timestamp):
+        """
+        Check if all page reviews are already stored
+        :param page_reviews: parsed page reviews
+        :type page_reviews: list
+        :param known_hashes: stored reviews hashes
+        :type known_hashes: set
+        :param newest_timestamp: newest stored review timestamp
+        :type newest_timestamp: float, None
+        :rtype: bool
+        """
+        return all(review['hash'] in known_hashes or
+                   (newest_timestamp is not None and review['timestamp'] < newest_timestamp)
+                   for review in page_reviews)
+
+    async def parse_product_reviews_async(self, product, known_reviews=None, on_page=None):
+        """
+        Parse product reviews using async downloader, review pages listed in product review_pages_done are skipped
+        :type product: product from db
+        :param known_reviews: already stored reviews, if set only new reviews are fetched
+        :type known_reviews: list, None
+        :param on_page: coroutine function called with page number and page reviews when review page is scraped
+        :type on_page: callable, None
+        :return: product with reviews, None if any review page is not downloaded
+        :rtype: dict, None
+        """
+        reviews = await self.get_product_reviews_async(product['_id'], known_reviews, product.get('review_pages_done'),
+                                                       on_page)
+        if reviews is None:
+            return None
+        product['reviews'] = reviews
+        return product
+
+    async def get_product_reviews_async(self, product_id, known_reviews=None, pages_done=None, on_page=None):
+        """
+        Getting all product reviews, review pages after first one are requested concurrently
+        :param product_id: product id
+        :type product_id: int, str
+        :param known_reviews: already stored reviews, if set only new reviews are fetched page by page
+        :type known_reviews: list, None
+        :param pages_done: numbers of review pages saved before, they are skipped except first one
+        :type pages_done: list, None
+        :param on_page: coroutine function called with page number and page reviews when review page is scraped
+        :type on_page: callable, None
+        :return: list with all reviews or only new ones if known_reviews is set, reviews of pages_done are not included,
+            None if any review page is not downloaded
+        :rtype: list, None
+        """
+        all_reviews = []
+        # parse first page separately because need to get pages count
+        first_review_page = await self.get_review_page_async(self.review_pattern.format(product_id, 1))
+        if not first_review_page:
+            logging.info('No first review page of {} product'.format(product_id))
+            return None
+        first_page_reviews, pages_count = first_review_page
+        if on_page:
+            await on_page(1, first_page_reviews)
+        if known_reviews is not None:
+            return await self.get_new_reviews_async(product_id, first_page_reviews, pages_count, known_reviews, on_page)
+        all_reviews.extend(first_page_reviews)
+        if not pages_count:
+            # Only reviews < 6
+            return all_reviews
+        pages_done = set(pages_done or ())
+        pages = [page for page in range(2, pages_count + 1) if page not in pages_done]
+        # gather keeps pages order
+        pages_reviews = await asyncio.gather(*(self.scrape_product_review_page_async(product_id, page, on_page)
+                                               for page in pages))
+        return self.join_review_pages(product_id, all_reviews, pages_reviews)
+
+    async def get_new_reviews_async(self, product_id, first_page_reviews, pages_count, known_reviews, on_page=None):
+        """
+        Async version of get_new_reviews, pages are fetched one by one because fetching stops at first known page
+        :param product_id: product id
+        :type product_id: int, str
+        :param first_page_reviews: parsed reviews from first page
+        :type first_page_reviews: list
+        :param pages_count: review pages count, None if product has only one page
+        :type pages_count: int, None
+        :param known_reviews: already stored reviews
+        :type known_reviews: list
+        :param on_page: coroutine function called with page number and page reviews when review page is scraped
+        :type on_page: callable, None
+        :return: reviews which are not stored yet, None if any review page is not downloaded
+        :rtype: list, None
+        """
+        known_hashes = {review.get('hash') or self.get_review_hash(review) for review in known_reviews}
+        newest_timestamp = max((review['timestamp'] for review in known_reviews), default=None)
+        new_reviews = []
+        page, page_reviews = 1, first_page_reviews
+        while True:
+            new_reviews.extend(review for review in page_reviews if review['hash'] not in known_hashes)
+            if self.is_known_page(page_reviews, known_hashes, newest_timestamp):
+                # reviews are sorted from newest, so next pages are known too
+                break
+            if not pages_count or page >= pages_count:
+                break
+            page += 1
+            page_reviews = await self.scrape_product_review_page_async(product_id, page, on_page)
+            if page_reviews is None:
+                logging.info('Review page {} of {} product is not downloaded'.format(page, product_id))
+                return None
+        return new_reviews
+
+    async def scrape_product_review_page_async(self, product_id, page, on_page=None):
+        """
+        Async version of scrape_product_review_page
+        :param product_id: product id
+        :type product_id: int, str
+        :param page: review page number
+        :type page: int
+        :param on_page: coroutine function called with page number and page reviews, not called if page is not
+            downloaded
+        :type on_page: callable, None
+        :return: list of one page parsed reviews, None if page is not downloaded
+        :rtype: list, None
+        """
+        review_page = await self.get_review_page_async(self.review_pattern.format(product_id, page))
+        if not review_page:
+            return None
+        page_reviews, _ = review_page
+        if on_page:
+            await on_page(page, page_reviews)
+        return page_reviews
+
+    def get_review_page(self, link):
+        """
+        Download and parse review page with parser backend
         :param link: link to review page
         :type link: str
-        :return: list of one page parsed reviews
-        :rtype: list
+        :return: list of one page parsed reviews and pages count, None if we have no response
+        :rtype: tuple, None
         """
+        if self.backend == 'stream':
+            page_parser = self.downloader.get(link, consumer_factory=ReviewPageStreamParser)
+            return self.get_stream_review_page(page_parser) if page_parser else None
         response = self.downloader.get(link)
+        return self.parse(self.parse_review_page, response, self.backend) if response else None
+
+    async def get_review_page_async(self, link):
+        """
+        Async version of get_review_page
+        :param link: link to review page
+        :type link: str
+        :return: list of one page parsed reviews and pages count, None if we have no response
+        :rtype: tuple, None
+        """
+        if self.backend == 'stream':
+            page_parser = await self.downloader.get(link, consumer_factory=ReviewPageStreamParser)
+            return self.get_stream_review_page(page_parser) if page_parser else None
+        response = await self.downloader.get(link)
+        return await self.parse_async(self.parse_review_page, response, self.backend) if response else None
+
+    @staticmethod
+    def get_stream_review_page(page_parser):
+        """
+        :param page_parser: review page parser fed by downloader
+        :type page_parser: ReviewPageStreamParser
+        :return: list of one page parsed reviews and pages count
+        :rtype: tuple
+        """
+        reviews, pages_count = page_parser.result()
+        return DresslilyParser.add_review_hashes(reviews), pages_count
+
+    @staticmethod
+    def add_review_hashes(reviews):
+        """
+        :param reviews: reviews parsed by lxml extractor
+        :type reviews: list
+        :return: same reviews with hash field
+        :rtype: list
+        """
+        for review in reviews:
+            review['hash'] = DresslilyParser.get_review_hash(review)
+        return reviews
+
+    @staticmethod
+    def parse_review_page(response, backend='bs4'):
+        """
+        Parse reviews and pages count from review page html
+        :param response: review page html
+        :type response: str
+        :param backend: extraction backend, bs4, lxml or stream
+        :type backend: str
+        :return: list of one page parsed reviews and pages count
+        :rtype: tuple
+        """
+        if backend in ('lxml', 'stream'):
+            reviews, pages_count = DresslilyLxmlExtractor.parse_review_page(DresslilyLxmlExtractor.parse_html(response))
+            return DresslilyParser.add_review_hashes(reviews), pages_count
         soup = BeautifulSoup(response, 'lxml')
-        reviews = self.get_single_page_reviews(soup)
-        parsed_reviews = [review for review in map(self.parse_single_review, reviews) if review]
-        return parsed_reviews
+        reviews = DresslilyParser.get_single_page_reviews(soup)
+        parsed_reviews = [review for review in map(DresslilyParser.parse_single_review, reviews) if review]
+        return parsed_reviews, DresslilyScraper.get_pages_count(soup, True)
 
     @staticmethod
     def get_single_page_reviews(review_page_soup):
@@ -300,7 +752,8 @@ class DresslilyParser:
         single_page_reviews = review_page_soup.find_all('div', class_='reviewlist clearfix')
         return single_page_reviews
 
-    def parse_single_review(self, single_review_soup):
+    @staticmethod
+    def parse_single_review(single_review_soup):
         """
         Parse all data from single review
         :param single_review_soup: single review soup object
@@ -309,13 +762,26 @@ class DresslilyParser:
         :rtype: dict
         """
         review_info = dict()
-        review_info['rating'] = self.get_review_rating(single_review_soup)
-        review_info['timestamp'] = self.get_review_timestamp(single_review_soup)
-        review_info['text'] = self.get_review_text(single_review_soup)
-        review_info['size'] = self.get_review_size(single_review_soup)
-        review_info['color'] = self.get_review_color(single_review_soup)
+        review_info['rating'] = DresslilyParser.get_review_rating(single_review_soup)
+        review_info['timestamp'] = DresslilyParser.get_review_timestamp(single_review_soup)
+        review_info['text'] = DresslilyParser.get_review_text(single_review_soup)
+        review_info['size'] = DresslilyParser.get_review_size(single_review_soup)
+        review_info['color'] = DresslilyParser.get_review_color(single_review_soup)
+        review_info['hash'] = DresslilyParser.get_review_hash(review_info)
         return review_info
 
+    @staticmethod
+    def get_review_hash(review):
+        """
+        Review content hash for finding already stored reviews
+        :param review: parsed review
+        :type review: dict
+        :return: hex digest
+        :rtype: str
+        """
+        key = '|'.join(str(review.get(field)) for field in ('timestamp', 'text', 'size', 'color'))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
     @staticmethod
     def get_review_rating(single_review_soup):
         """
@@ -377,3 +843,37 @@ class DresslilyParser:
             logging.warning('Cant get review color')
             review_color = None
         return review_color
+
+
+# extraction function of archived page type, called with page html and backend
+ARCHIVE_EXTRACTORS = {'category': DresslilyScraper.parse_category_page,
+                      'product': DresslilyParser.parse_product_page,
+                      'review': DresslilyParser.parse_review_page}
+
+
+def extract_archived_batch(archive_path, segment, offset, length, urls, backend='lxml'):
+    """
+    Re-extract pages of one archive batch without network, runs in parse pool worker process
+    :param archive_path: page archive directory
+    :type archive_path: str
+    :param urls: pages of batch to extract, other pages of batch have newer versions in later batches
+    :type urls: list
+    :param backend: extraction backend, bs4, lxml or stream
+    :type backend: str
+    :return: (url, page type, fetch time, extracted data) tuples, data is None if page can't be parsed
+    :rtype: list
+    """
+    urls = set(urls)
+    extracted = []
+    # same page can be archived twice in batch, last version is used
+    for page in reversed(PageArchive.read_batch(archive_path, segment, offset, length)):
+        if page['url'] not in urls:
+            continue
+        urls.discard(page['url'])
+        try:
+            data = ARCHIVE_EXTRACTORS[page['page_type']](page['body'], backend)
+        except Exception:
+            logging.error('Can`t extract archived {} page'.format(page['url']), exc_info=True)
+            data = None
+        extracted.append((page['url'], page['page_type'], page['fetched_at'], data))
+    return extracted
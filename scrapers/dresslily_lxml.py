@@ -0,0 +1,342 @@
+from abc import ABC, abstractmethod
+from lxml import etree
+import datetime
+import logging
+import traceback
+
+
+def has_class(class_name):
+    """
+    XPath condition same as BeautifulSoup class_ filter
+    :param class_name: single class or full class attribute value with spaces
+    :type class_name: str
+    :rtype: str
+    """
+    if ' ' in class_name:
+        # BeautifulSoup compares whole class attribute if filter contains spaces
+        return f'normalize-space(@class)="{class_name}"'
+    return f'contains(concat(" ", normalize-space(@class), " "), " {class_name} ")'
+
+
+class DresslilyLxmlExtractor:
+    """
+    Fast-path extraction backend built on precompiled lxml XPath selectors.
+    Returns same values as BeautifulSoup based DresslilyScraper and DresslilyParser methods.
+    """
+    html_parser = etree.HTMLParser(encoding='utf-8')
+    category_products_xpath = etree.XPath(
+        '//div[{}]'.format(has_class('js-good js-dlGood js_logsss_browser js_logsss_event_ps category-good')))
+    link_href_xpath = etree.XPath('(.//a)[1]/@href')
+    product_name_xpath = etree.XPath(
+        'string((.//a[{}])[1])'.format(has_class('goods-name-link js_logsss_click_delegate_ps')))
+    original_price_xpath = etree.XPath(
+        '(.//span[{}])[1]/@data-orgp'.format(has_class('my-shop-price category-good-price-market dl-has-rrp-tag')))
+    discount_price_xpath = etree.XPath(
+        '(.//span[{}])[1]/@data-orgp'.format(has_class('js-dlShopPrice my-shop-price category-good-price-sale')))
+    pager_items_xpath = etree.XPath('(//div[{}])[1]//li'.format(has_class('site-pager')))
+    rating_xpath = etree.XPath('(//span[{}])[1]'.format(has_class('review-avg-rate')))
+    product_info_block_xpath = etree.XPath('(//div[{}])[1]'.format(has_class('xxkkk20')))
+    strong_xpath = etree.XPath('.//strong')
+    text_xpath = etree.XPath('string()')
+    review_blocks_xpath = etree.XPath('//div[{}]'.format(has_class('reviewlist clearfix')))
+    review_stars_xpath = etree.XPath('.//i[{}]'.format(has_class('icon-star-black')))
+    review_time_xpath = etree.XPath('(.//span[{}])[1]'.format(has_class('reviewtime')))
+    review_text_xpath = etree.XPath('(.//p[{}])[1]'.format(has_class('reviewcon')))
+    # same as BeautifulSoup text filter, span must have single text node
+    review_size_xpath = etree.XPath('(.//span[count(node())=1 and starts-with(text(), "Size:")])[1]')
+    review_color_xpath = etree.XPath('(.//span[count(node())=1 and starts-with(text(), "Color:")])[1]')
+    pager_li_xpath = etree.XPath('.//li')
+
+    @classmethod
+    def parse_html(cls, response):
+        """
+        :param response: page html
+        :type response: str, bytes
+        :return: page tree
+        :rtype: lxml.etree._Element
+        """
+        if isinstance(response, str):
+            response = response.encode('utf-8')
+        return etree.fromstring(response, cls.html_parser)
+
+    @classmethod
+    def get_products_on_category_page(cls, page_tree):
+        """
+        :type page_tree: lxml.etree._Element
+        :return: list of product elements on page
+        :rtype: list
+        """
+        return cls.category_products_xpath(page_tree)
+
+    @classmethod
+    def get_pages_count(cls, page_tree, can_be_error=False):
+        """
+        Get pages count in pagination block
+        :type page_tree: lxml.etree._Element
+        :param can_be_error: if review page, can be no pages_count bacause reviews < 6
+        :type can_be_error: bool
+        :return: pages count
+        :rtype: int, None
+        """
+        pages_count = None
+        try:
+            last_page_tag = cls.pager_items_xpath(page_tree)[-2]
+            pages_count = int(cls.text_xpath(last_page_tag))
+        except Exception:
+            if not can_be_error:
+                logging.error('Except on getting pages count')
+        return pages_count
+
+    @classmethod
+    def scrape_single_product(cls, product):
+        """
+        Scrape all data from product on category page
+        :param product: single product element
+        :type product: lxml.etree._Element
+        :return: product primary attributes
+        :rtype: dict
+        """
+        product_info = {}
+        try:
+            url = str(cls.link_href_xpath(product)[0])
+            product_info['_id'] = int(url.split('product')[-1].replace('.html', ''))
+            product_info['url'] = url
+            product_info['name'] = str(cls.product_name_xpath(product))
+            original_price = float(cls.original_price_xpath(product)[0])
+            discount_price = float(cls.discount_price_xpath(product)[0])
+            product_info['original_price'] = original_price
+            product_info['discount_price'] = discount_price
+            product_info['discount'] = round((100 * (original_price - discount_price)) / original_price)
+            return product_info
+        except Exception:
+            logging.error(traceback.format_exc())
+            logging.error('Receive exception on product scraping')
+            return None
+
+    @classmethod
+    def scrape_category_page(cls, page_tree):
+        """
+        :type page_tree: lxml.etree._Element
+        :return: scraped page products
+        :rtype: list
+        """
+        products = cls.get_products_on_category_page(page_tree)
+        return [product for product in map(cls.scrape_single_product, products) if product]
+
+    @classmethod
+    def get_product_rating(cls, page_tree):
+        """
+        :type page_tree: lxml.etree._Element
+        :rtype: float, None
+        """
+        rating_tags = cls.rating_xpath(page_tree)
+        if not rating_tags:
+            # if product has no rating
+            return None
+        return float(cls.text_xpath(rating_tags[0]))
+
+    @classmethod
+    def get_product_info(cls, page_tree):
+        """
+        Get product info in string format
+        :type page_tree: lxml.etree._Element
+        :return: product info in string format
+        :rtype: str
+        """
+        product_info_blocks = cls.product_info_block_xpath(page_tree)
+        if not product_info_blocks:
+            raise AttributeError('No product info block')
+        return cls.get_product_info_from_block(product_info_blocks[0])
+
+    @classmethod
+    def get_product_info_from_block(cls, product_info_block):
+        """
+        :param product_info_block: xxkkk20 block element
+        :type product_info_block: lxml.etree._Element
+        :return: product info in string format
+        :rtype: str
+        """
+        product_info = {}
+        for product_info_key in cls.strong_xpath(product_info_block):
+            # value is text right after <strong> key
+            product_info[cls.text_xpath(product_info_key).replace(':', '').strip()] = \
+                (product_info_key.tail or '').strip()
+        return ';'.join([f'{k}:{v}' for k, v in product_info.items()])
+
+    @classmethod
+    def get_pages_count_from_pager(cls, pager):
+        """
+        :param pager: site-pager block element
+        :type pager: lxml.etree._Element
+        :rtype: int, None
+        """
+        try:
+            return int(cls.text_xpath(cls.pager_li_xpath(pager)[-2]))
+        except Exception:
+            return None
+
+    @classmethod
+    def parse_review_page(cls, page_tree):
+        """
+        :type page_tree: lxml.etree._Element
+        :return: list of one page parsed reviews and pages count
+        :rtype: tuple
+        """
+        reviews = [cls.parse_single_review(review) for review in cls.review_blocks_xpath(page_tree)]
+        return reviews, cls.get_pages_count(page_tree, True)
+
+    @classmethod
+    def parse_single_review(cls, review_block):
+        """
+        Parse all data from single review, same fields as DresslilyParser.parse_single_review except hash
+        :param review_block: reviewlist block element
+        :type review_block: lxml.etree._Element
+        :return: review primary attributes
+        :rtype: dict
+        """
+        review_info = dict()
+        review_info['rating'] = len(cls.review_stars_xpath(review_block))
+        time_string = cls.text_xpath(cls.review_time_xpath(review_block)[0])
+        review_info['timestamp'] = datetime.datetime.strptime(time_string, '%b,%d %Y %H:%M:%S').timestamp()
+        review_info['text'] = cls.text_xpath(cls.review_text_xpath(review_block)[0])
+        review_info['size'] = cls.get_review_attribute(review_block, cls.review_size_xpath, 'Size:')
+        review_info['color'] = cls.get_review_attribute(review_block, cls.review_color_xpath, 'Color:')
+        return review_info
+
+    @classmethod
+    def get_review_attribute(cls, review_block, xpath, prefix):
+        """
+        :return: review size or color, None if review has no such attribute
+        :rtype: str, None
+        """
+        tags = xpath(review_block)
+        if not tags:
+            logging.warning('Cant get review {}'.format(prefix.lower().replace(':', '')))
+            return None
+        return cls.text_xpath(tags[0]).replace(prefix, '').strip()
+
+
+class StreamingPageParser(ABC):
+    """
+    Incremental page parser fed with raw response chunks.
+    Elements are handled as soon as they are closed, feed returns True when all required data is found,
+    so downloader can close connection without reading the rest of page.
+    Extraction errors are raised by result, not by feed, so they are not mistaken for download errors.
+    """
+    # handled tags, other elements don't produce events
+    tags = ('div', 'span')
+
+    def __init__(self, encoding=None):
+        """
+        :param encoding: response charset
+        :type encoding: str, None
+        """
+        self.parser = etree.HTMLPullParser(events=('end',), tag=self.tags, encoding=encoding or 'utf-8')
+        self.done = False
+        self.error = None
+
+    def feed(self, chunk):
+        """
+        :param chunk: raw response chunk
+        :type chunk: bytes
+        :return: True if all required data is found or page can't be parsed
+        :rtype: bool
+        """
+        self.parser.feed(chunk)
+        self.handle_events()
+        return self.done
+
+    def finish(self):
+        """Finish parsing if page was read to the end"""
+        if self.done:
+            return
+        try:
+            self.parser.close()
+        except etree.XMLSyntaxError:
+            # empty or broken page, data found so far is used
+            pass
+        self.handle_events()
+
+    def handle_events(self):
+        for _, element in self.parser.read_events():
+            if self.done:
+                break
+            try:
+                self.handle(element, (element.get('class') or '').split())
+            except Exception as e:
+                self.error = e
+                self.done = True
+
+    @abstractmethod
+    def handle(self, element, classes):
+        """
+        :param element: closed element
+        :type element: lxml.etree._Element
+        :param classes: element classes
+        :type classes: list
+        """
+
+    def result(self):
+        """
+        :return: parsed data
+        :raises Exception: extraction error
+        """
+        if self.error is not None:
+            raise self.error
+        return self.get_result()
+
+    @abstractmethod
+    def get_result(self):
+        """
+        :return: parsed data
+        """
+
+
+class ProductPageStreamParser(StreamingPageParser):
+    """Finds rating and product info block, page without rating is read to the end"""
+    def __init__(self, encoding=None):
+        super().__init__(encoding)
+        self.rating = None
+        self.product_info = None
+
+    def handle(self, element, classes):
+        if self.rating is None and element.tag == 'span' and 'review-avg-rate' in classes:
+            self.rating = float(DresslilyLxmlExtractor.text_xpath(element))
+        elif self.product_info is None and element.tag == 'div' and 'xxkkk20' in classes:
+            self.product_info = DresslilyLxmlExtractor.get_product_info_from_block(element)
+        self.done = self.rating is not None and self.product_info is not None
+
+    def get_result(self):
+        """
+        :return: product rating and product info
+        :rtype: dict
+        """
+        if self.product_info is None:
+            raise AttributeError('No product info block')
+        return {'rating': self.rating, 'product_info': self.product_info}
+
+
+class ReviewPageStreamParser(StreamingPageParser):
+    """Parses reviews until pagination block, page without pagination is read to the end"""
+    tags = ('div',)
+
+    def __init__(self, encoding=None):
+        super().__init__(encoding)
+        self.reviews = []
+        self.pages_count = None
+
+    def handle(self, element, classes):
+        if classes == ['reviewlist', 'clearfix']:
+            self.reviews.append(DresslilyLxmlExtractor.parse_single_review(element))
+        elif 'site-pager' in classes:
+            if self.pages_count is None:
+                self.pages_count = DresslilyLxmlExtractor.get_pages_count_from_pager(element)
+            # pagination below reviews list ends page data, pagination above it is skipped
+            self.done = bool(self.reviews)
+
+    def get_result(self):
+        """
+        :return: list of one page parsed reviews and pages count
+        :rtype: tuple
+        """
+        return self.reviews, self.pages_count
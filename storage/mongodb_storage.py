@@ -1,13 +1,29 @@
-from pymongo import MongoClient, UpdateOne
+from pymongo import MongoClient, DeleteMany, UpdateOne, ASCENDING, DESCENDING
 from helpers.helpers import parse_config
 import ast
+import logging
+import time
+
+# product crawl states in processing order, failed products are retried on next run
+CRAWL_STATES = ('listed', 'page_parsed', 'reviews_parsed', 'failed')
+PENDING_CRAWL_STATES = ('listed', 'page_parsed', 'failed')
+# exported product fields, product changed_at is updated when any of them is changed
+CHANGE_TRACKED_FIELDS = ('url', 'name', 'discount', 'discount_price', 'original_price', 'rating', 'product_info')
 
 
 class MongoDBStorage:
-    def __init__(self):
-        self.config = parse_config('db')
-        self.client = self.connect_to_db()
-        self.product_collection = self.client[self.config['PRODUCTS_COLLECTION']]
+    def __init__(self, client=None):
+        """
+        :param client: database used instead of one from config.ini, e.g. test database
+        :type client: pymongo.database.Database, None
+        """
+        self.config = parse_config('db') if client is None else {}
+        self.client = client if client is not None else self.connect_to_db()
+        self.product_collection = self.client[self.config.get('PRODUCTS_COLLECTION', 'products')]
+        self.review_collection = self.client[self.config.get('REVIEWS_COLLECTION', 'reviews')]
+        self.export_state_collection = self.client[self.config.get('EXPORT_STATE_COLLECTION', 'export_state')]
+        self.crawl_run_collection = self.client[self.config.get('CRAWL_RUNS_COLLECTION', 'crawl_runs')]
+        self.dead_letter_collection = self.client[self.config.get('DEAD_LETTERS_COLLECTION', 'dead_letters')]
 
     def connect_to_db(self):
         # if test_env variable set as True - connect to localhost
@@ -25,8 +41,455 @@ class MongoDBStorage:
         # creating UpdateOne instants for faster batch update
         docs = [UpdateOne({'_id': post['_id']}, {'$set': post}, upsert=True) for post in projects]
         if docs:
-            self.client[self.config['PRODUCTS_COLLECTION']].bulk_write(docs)
+            self.product_collection.bulk_write(docs)
+
+    def update_products(self, updates, inserts=None):
+        """
+        Set only given fields of products, unordered so one failed update doesn't stop others.
+        changed_at is set for products which exported fields are changed
+        :param updates: product _id -> fields to set
+        :type updates: dict
+        :param inserts: product _id -> fields to set only if product is new
+        :type inserts: dict, None
+        """
+        inserts = inserts or {}
+        docs = []
+        for _id, fields in self.add_changed_at(updates).items():
+            update = {}
+            if fields:
+                update['$set'] = fields
+            if inserts.get(_id):
+                update['$setOnInsert'] = inserts[_id]
+            if update:
+                docs.append(UpdateOne({'_id': _id}, update, upsert=True))
+        if docs:
+            self.product_collection.bulk_write(docs, ordered=False)
+
+    def add_changed_at(self, updates):
+        """
+        Compare updated exported fields with stored ones in one query
+        :param updates: product _id -> fields to set
+        :type updates: dict
+        :return: same updates, fields of changed or new products have changed_at
+        :rtype: dict
+        """
+        tracked = [_id for _id, fields in updates.items() if not fields.keys().isdisjoint(CHANGE_TRACKED_FIELDS)]
+        if not tracked:
+            return updates
+        stored = {product['_id']: product for product in self.product_collection.find(
+            {'_id': {'$in': tracked}}, dict.fromkeys(CHANGE_TRACKED_FIELDS, 1))}
+        now = time.time()
+        updates = dict(updates)
+        for _id in tracked:
+            product = stored.get(_id, {})
+            if any(key not in product or product[key] != value
+                   for key, value in updates[_id].items() if key in CHANGE_TRACKED_FIELDS):
+                updates[_id] = dict(updates[_id], changed_at=now)
+        return updates
+
+    def add_listed_products(self, products):
+        """
+        Upsert products from category pages, new products get listed crawl state
+        :param products: scraped category products
+        :type products: list
+        """
+        updates = {product['_id']: {key: value for key, value in product.items() if key != '_id'}
+                   for product in products}
+        listed = self.crawl_state_fields('listed')
+        self.update_products(updates, {_id: listed for _id in updates})
+
+    @staticmethod
+    def crawl_state_fields(state):
+        """
+        Product fields for crawl state change
+        :param state: one of CRAWL_STATES
+        :type state: str
+        :return: state, state change time and state specific time fields
+        :rtype: dict
+        """
+        if state not in CRAWL_STATES:
+            raise ValueError('Unknown crawl state {}'.format(state))
+        now = time.time()
+        return {'crawl_state': state, 'crawl_state_at': now, f'{state}_at': now}
+
+    def get_products_by_state(self, states, projection=None):
+        """
+        Indexed query by crawl state
+        :param states: crawl states
+        :type states: list, tuple
+        :param projection: returned fields
+        :type projection: dict, None
+        :rtype: pymongo.cursor.Cursor
+        """
+        return self.product_collection.find({'crawl_state': {'$in': list(states)}}, projection)
+
+    def get_pending_products(self):
+        """
+        Products which inner page or reviews are not parsed yet, failed ones are retried
+        :return: list of products with _id, url, crawl_state and review_pages_done
+        :rtype: list
+        """
+        return list(self.get_products_by_state(PENDING_CRAWL_STATES, {'_id': 1, 'url': 1, 'crawl_state': 1,
+                                                                      'review_pages_done': 1}))
+
+    def ensure_indexes(self):
+        """Create indexes for products crawl state and reviews collection"""
+        self.product_collection.create_index([('crawl_state', ASCENDING)])
+        # changed products lookup for incremental export
+        self.product_collection.create_index([('crawl_state', ASCENDING), ('changed_at', ASCENDING)])
+        self.review_collection.create_index([('product_id', ASCENDING), ('timestamp', DESCENDING)])
+        self.review_collection.create_index([('timestamp', DESCENDING)])
+        self.review_collection.create_index([('saved_at', ASCENDING)])
+        # reviews are matched by content hash on crawl, so replayed reviews aren't inserted again
+        self.review_collection.create_index([('product_id', ASCENDING), ('hash', ASCENDING)])
+
+    def migrate_crawl_state(self):
+        """One-off migration, set crawl state for products stored before crawl state was added"""
+        no_state = {'crawl_state': {'$exists': False}}
+        now = time.time()
+        self.product_collection.update_many(dict(no_state, reviews_count={'$exists': True}),
+                                            {'$set': {'crawl_state': 'reviews_parsed', 'crawl_state_at': now}})
+        self.product_collection.update_many(dict(no_state, reviews={'$exists': True}),
+                                            {'$set': {'crawl_state': 'reviews_parsed', 'crawl_state_at': now}})
+        self.product_collection.update_many(dict(no_state, rating={'$exists': True}),
+                                            {'$set': {'crawl_state': 'page_parsed', 'crawl_state_at': now}})
+        self.product_collection.update_many(no_state, {'$set': {'crawl_state': 'listed', 'crawl_state_at': now}})
+
+    @staticmethod
+    def get_review_id(product_id, review):
+        """
+        Review key is product id plus review content hash, so same review is stored once
+        :type product_id: int
+        :type review: dict
+        :rtype: str
+        """
+        return '{}:{}'.format(product_id, review['hash'])
+
+    @staticmethod
+    def get_replayed_review_id(product_id, page, position):
+        """
+        Key of review re-extracted from archived page, it doesn't depend on extracted fields,
+        so fixed extraction updates same review
+        :type product_id: int
+        :param page: review page number
+        :type page: int
+        :param position: review position on page
+        :type position: int
+        :rtype: str
+        """
+        return '{}:p{}:{}'.format(product_id, page, position)
+
+    @staticmethod
+    def get_review_upsert(product_id, review, saved_at):
+        """
+        :return: insert of review which is not stored yet, stored review is found by product and content hash,
+            so it can have replayed review key
+        :rtype: UpdateOne
+        """
+        return UpdateOne({'product_id': product_id, 'hash': review['hash']},
+                         {'$setOnInsert': dict(review, _id=MongoDBStorage.get_review_id(product_id, review),
+                                               saved_at=saved_at)}, upsert=True)
+
+    def add_reviews(self, product_id, reviews):
+        """
+        Insert reviews which are not stored yet
+        :param product_id: product id
+        :type product_id: int
+        :param reviews: parsed reviews with hash field
+        :type reviews: list
+        :return: count of new reviews
+        :rtype: int
+        """
+        saved_at = time.time()
+        docs = [self.get_review_upsert(product_id, review, saved_at) for review in reviews]
+        if not docs:
+            return 0
+        result = self.review_collection.bulk_write(docs, ordered=False)
+        return result.upserted_count
+
+    def add_review_page(self, product_id, page, reviews):
+        """
+        Save reviews of single review page and mark page as done for product
+        :param product_id: product id
+        :type product_id: int
+        :param page: review page number
+        :type page: int
+        :param reviews: page reviews with hash field
+        :type reviews: list
+        """
+        self.add_review_pages([(product_id, page, reviews)])
+
+    def add_review_pages(self, pages):
+        """
+        Save reviews of many review pages with one bulk write and mark pages as done after their reviews are saved
+        :param pages: (product id, page number or None if page is not tracked, page reviews with hash field) tuples
+        :type pages: list
+        """
+        saved_at = time.time()
+        docs = [self.get_review_upsert(product_id, review, saved_at) for product_id, _, reviews in pages
+                for review in reviews]
+        if docs:
+            self.review_collection.bulk_write(docs, ordered=False)
+        page_docs = [UpdateOne({'_id': product_id}, {'$addToSet': {'review_pages_done': page}})
+                     for product_id, page, _ in pages if page is not None]
+        if page_docs:
+            self.product_collection.bulk_write(page_docs, ordered=False)
+
+    def replace_review_pages(self, pages, replayed_at):
+        """
+        Upsert reviews re-extracted from archived review pages, so fixed extraction overwrites stored fields.
+        saved_at is changed only for new and changed reviews, so unchanged ones are not exported again
+        :param pages: (product id, page number, page reviews with hash field) tuples
+        :type pages: list
+        :param replayed_at: replay start time, product reviews which are not replayed by it are superseded
+        :type replayed_at: float
+        """
+        reviews = {self.get_replayed_review_id(product_id, page, position):
+                   dict(review, product_id=product_id, page=page, position=position)
+                   for product_id, page, page_reviews in pages for position, review in enumerate(page_reviews)}
+        if not reviews:
+            return
+        stored = {review.pop('_id'): review for review in self.review_collection.find(
+            {'_id': {'$in': list(reviews)}}, {'saved_at': 0, 'replayed_at': 0})}
+        saved_at = time.time()
+        docs = []
+        for _id, review in reviews.items():
+            fields = dict(review, replayed_at=replayed_at)
+            if stored.get(_id) != review:
+                fields['saved_at'] = saved_at
+            docs.append(UpdateOne({'_id': _id}, {'$set': fields}, upsert=True))
+        self.review_collection.bulk_write(docs, ordered=False)
+
+    def delete_superseded_reviews(self, products, replayed_at):
+        """
+        Delete not replayed reviews of products which all review pages are replayed, if they are saved before
+        archived pages were fetched or extracted from archived pages. Reviews saved by later crawl are kept
+        :param products: product id -> fetch time of its newest archived review page
+        :type products: dict
+        :param replayed_at: replay start time passed to replace_review_pages
+        :type replayed_at: float
+        :return: deleted reviews count
+        :rtype: int
+        """
+        if not products:
+            return 0
+        docs = [DeleteMany({'product_id': product_id, 'replayed_at': {'$ne': replayed_at},
+                            '$or': [{'saved_at': {'$lte': fetched_at}}, {'page_archived': True}]})
+                for product_id, fetched_at in products.items()]
+        return self.review_collection.bulk_write(docs, ordered=False).deleted_count
+
+    def update_reviews_counts(self, product_ids):
+        """
+        Set reviews_count of products from reviews collection
+        :param product_ids: product ids
+        :type product_ids: iterable
+        """
+        self.update_products({product_id: {'reviews_count': count}
+                              for product_id, count in self.get_reviews_counts(product_ids).items()})
+
+    def get_reviews_counts(self, product_ids):
+        """
+        Count stored reviews of many products with one aggregation
+        :param product_ids: product ids
+        :type product_ids: iterable
+        :return: product id -> stored reviews count, products without reviews have 0
+        :rtype: dict
+        """
+        counts = dict.fromkeys(product_ids, 0)
+        if counts:
+            counts.update((row['_id'], row['count']) for row in self.review_collection.aggregate([
+                {'$match': {'product_id': {'$in': list(counts)}}},
+                {'$group': {'_id': '$product_id', 'count': {'$sum': 1}}}]))
+        return counts
+
+    def count_reviews(self, product_id):
+        """
+        :param product_id: product id
+        :type product_id: int
+        :return: stored product reviews count
+        :rtype: int
+        """
+        return self.review_collection.count_documents({'product_id': product_id})
+
+    def get_known_reviews(self, product_id):
+        """
+        Get hashes and timestamps of stored product reviews
+        :param product_id: product id
+        :type product_id: int
+        :return: list of reviews with hash and timestamp fields
+        :rtype: list
+        """
+        return list(self.review_collection.find({'product_id': product_id}, {'_id': 0, 'hash': 1, 'timestamp': 1}))
+
+    def migrate_embedded_reviews(self, batch_size=100):
+        """
+        One-off migration of reviews arrays from product documents into reviews collection
+        :param batch_size: products processed per batch
+        :type batch_size: int
+        :return: migrated products count
+        :rtype: int
+        """
+        # local import because scrapers import is not needed for storage usage
+        from scrapers.dresslily import DresslilyParser
+        self.ensure_indexes()
+        migrated = 0
+        while True:
+            products = list(self.product_collection.find({'reviews': {'$exists': True}}, {'_id': 1, 'reviews': 1},
+                                                         limit=batch_size))
+            if not products:
+                return migrated
+            product_updates = []
+            for product in products:
+                for review in product['reviews']:
+                    review.setdefault('hash', DresslilyParser.get_review_hash(review))
+                self.add_reviews(product['_id'], product['reviews'])
+                product_updates.append(UpdateOne({'_id': product['_id']},
+                                                 {'$unset': {'reviews': ''},
+                                                  '$set': {'reviews_count': len(product['reviews'])}}))
+            self.product_collection.bulk_write(product_updates, ordered=False)
+            migrated += len(products)
+            logging.info('{} products reviews migrated'.format(migrated))
+
+    def get_export_products(self, fields, batch_size=1000):
+        """
+        Stream parsed products for export
+        :param fields: exported product fields
+        :type fields: list
+        :param batch_size: documents fetched from server per round trip
+        :type batch_size: int
+        :rtype: pymongo.cursor.Cursor
+        """
+        projection = {field: 1 for field in fields}
+        return self.get_products_by_state(('page_parsed', 'reviews_parsed'), projection).batch_size(batch_size)
+
+    def get_export_reviews(self, fields, batch_size=1000):
+        """
+        Stream reviews for export, grouped by product with newest reviews first.
+        Reviews still embedded in products (not migrated yet) are unwound on server side.
+        :param fields: exported review fields, product_id included
+        :type fields: list
+        :param batch_size: documents fetched from server per round trip
+        :type batch_size: int
+        :return: reviews iterator
+        :rtype: iterator
+        """
+        projection = dict({field: 1 for field in fields}, _id=0)
+        # sorting uses product_id, timestamp index
+        reviews = self.review_collection.find({}, projection).sort([('product_id', ASCENDING),
+                                                                     ('timestamp', DESCENDING)])
+        yield from reviews.batch_size(batch_size)
+        embedded_projection = {field: f'$reviews.{field}' for field in fields if field != 'product_id'}
+        embedded_reviews = self.product_collection.aggregate([
+            {'$match': {'reviews': {'$exists': True}}},
+            {'$project': {'reviews': 1}},
+            {'$unwind': '$reviews'},
+            {'$project': dict(embedded_projection, _id=0, product_id='$_id')}
+        ], allowDiskUse=True, batchSize=batch_size)
+        yield from embedded_reviews
+
+    @staticmethod
+    def get_watermark_filter(field, since, until):
+        """
+        :param since: exclusive lower bound, None for all documents including ones without field
+        :type since: float, None
+        :param until: inclusive upper bound
+        :type until: float
+        :rtype: dict
+        """
+        if since is None:
+            return {field: {'$not': {'$gt': until}}}
+        return {field: {'$gt': since, '$lte': until}}
+
+    def get_changed_products(self, fields, since, until, batch_size=1000):
+        """
+        Stream parsed products which exported fields were changed in (since, until] interval
+        :param fields: exported product fields
+        :type fields: list
+        :type since: float, None
+        :type until: float
+        :param batch_size: documents fetched from server per round trip
+        :type batch_size: int
+        :rtype: pymongo.cursor.Cursor
+        """
+        query = dict({'crawl_state': {'$in': ['page_parsed', 'reviews_parsed']}},
+                     **self.get_watermark_filter('changed_at', since, until))
+        return self.product_collection.find(query, {field: 1 for field in fields}).batch_size(batch_size)
+
+    def get_changed_reviews(self, fields, since, until, batch_size=1000):
+        """
+        Stream reviews saved in (since, until] interval
+        :param fields: exported review fields
+        :type fields: list
+        :type since: float, None
+        :type until: float
+        :param batch_size: documents fetched from server per round trip
+        :type batch_size: int
+        :rtype: pymongo.cursor.Cursor
+        """
+        projection = dict({field: 1 for field in fields}, _id=0)
+        query = self.get_watermark_filter('saved_at', since, until)
+        return self.review_collection.find(query, projection).batch_size(batch_size)
+
+    def get_export_watermark(self, name):
+        """
+        :param name: export name
+        :type name: str
+        :return: time of last finished export
+        :rtype: float, None
+        """
+        state = self.export_state_collection.find_one({'_id': name})
+        return state['watermark'] if state else None
+
+    def set_export_watermark(self, name, watermark):
+        """
+        :param name: export name
+        :type name: str
+        :param watermark: time of finished export
+        :type watermark: float
+        """
+        self.export_state_collection.update_one({'_id': name}, {'$set': {'watermark': watermark}}, upsert=True)
 
+    def start_crawl_run(self):
+        """
+        Resume unfinished crawl run or start new one
+        :return: run document with pages_done and pages_count of category
+        :rtype: dict
+        """
+        run = self.crawl_run_collection.find_one({'status': 'running'}, sort=[('started_at', DESCENDING)])
+        if run:
+            logging.info('Resume crawl run started at {}, {} category pages done'.format(
+                time.ctime(run['started_at']), len(run['pages_done'])))
+            return run
+        run = {'status': 'running', 'started_at': time.time(), 'pages_count': None, 'pages_done': []}
+        run['_id'] = self.crawl_run_collection.insert_one(run).inserted_id
+        return run
 
+    def add_crawl_run_page(self, run_id, page, pages_count=None):
+        """
+        Mark category page as done, page products must be saved before
+        :type run_id: bson.ObjectId
+        :param page: category page number
+        :type page: int
+        :param pages_count: category pages count
+        :type pages_count: int, None
+        """
+        update = {'$addToSet': {'pages_done': page}}
+        if pages_count:
+            update['$set'] = {'pages_count': pages_count}
+        self.crawl_run_collection.update_one({'_id': run_id}, update)
 
+    def finish_crawl_run(self, run_id):
+        """
+        :type run_id: bson.ObjectId
+        """
+        self.crawl_run_collection.update_one({'_id': run_id}, {'$set': {'status': 'finished',
+                                                                        'finished_at': time.time()}})
 
+    def add_dead_letter(self, record):
+        """
+        Save request which downloader gave up, failures of same url are counted in one document
+        :param record: url, method, failure kind, last error, attempts, elapsed and failed_at time of request
+        :type record: dict
+        """
+        self.dead_letter_collection.update_one({'_id': record['url']}, {'$set': record, '$inc': {'failures': 1}},
+                                               upsert=True)
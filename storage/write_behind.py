@@ -0,0 +1,297 @@
+import atexit
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from threading import Condition, Thread
+
+# product field placeholder, replaced by stored reviews count when product is written after its review pages
+REVIEWS_COUNT = object()
+
+
+class WriteBehindWriter:
+    """
+    Buffered product and review pages writer running on its own thread.
+    Updates are coalesced per _id, only fields changed since previous write are sent,
+    batches are flushed unordered when batch_size is reached or every flush_interval seconds.
+    Queued review pages are written before products batch, so product saved after its reviews never sees
+    review pages cursor updated by them later.
+    Failed batch is retried up to max_attempts times, then its documents are logged and dropped.
+    """
+    def __init__(self, storage, batch_size=500, flush_interval=2.0, max_queue_size=10000, max_attempts=3,
+                 max_tracked=100000):
+        """
+        :param storage: storage with update_products, add_review_pages and get_reviews_counts methods
+        :type storage: MongoDBStorage
+        :param batch_size: max documents in one bulk write
+        :type batch_size: int
+        :param flush_interval: max seconds between flushes
+        :type flush_interval: float
+        :param max_queue_size: put blocks or returns False when so many documents are waiting for flush
+        :type max_queue_size: int
+        :param max_attempts: write attempts of document before it is dropped
+        :type max_attempts: int
+        :param max_tracked: max documents which written fields digests are kept for, least recently written
+            documents are forgotten and their next update is written whole
+        :type max_tracked: int
+        """
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.max_attempts = max_attempts
+        self.max_tracked = max_tracked
+        self.condition = Condition()
+        # _id -> (fields, fields set only on insert) waiting for flush
+        self.pending = OrderedDict()
+        # _id -> {field: value digest} of already written fields, in LRU order
+        self.written = OrderedDict()
+        # _id -> failed write attempts of queued document
+        self.attempts = {}
+        # (product id, page number, reviews, failed write attempts) waiting for flush
+        self.review_pages = []
+        self.in_flight = 0
+        self.closed = False
+        self.written_docs = 0
+        self.written_fields = 0
+        self.skipped_docs = 0
+        self.dropped_docs = 0
+        self.written_review_pages = 0
+        self.write_time = 0
+        self.start_time = time.time()
+        self.last_stats_time = time.time()
+        self.thread = Thread(target=self.run, name='write-behind', daemon=True)
+        self.thread.start()
+        # flush everything if process is stopped without close
+        atexit.register(self.close)
+
+    def put(self, doc, on_insert=None, block=True):
+        """
+        Queue product update, blocks if queue is full
+        :param doc: product fields with _id
+        :type doc: dict
+        :param on_insert: fields which are set only if product is new
+        :type on_insert: dict, None
+        :param block: if False, update is not queued when queue is full
+        :type block: bool
+        :return: True if update is queued
+        :rtype: bool
+        """
+        with self.condition:
+            while len(self.pending) >= self.max_queue_size and not self.closed:
+                if not block:
+                    return False
+                self.condition.wait()
+            if self.closed:
+                raise RuntimeError('Writer is closed')
+            fields, insert_fields = self.pending.setdefault(doc['_id'], ({}, {}))
+            # later values win
+            fields.update((key, value) for key, value in doc.items() if key != '_id')
+            insert_fields.update(on_insert or {})
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify_all()
+        return True
+
+    def put_review_page(self, product_id, page, reviews, block=True):
+        """
+        Queue reviews of review page, blocks if queue is full
+        :param product_id: product id
+        :type product_id: int
+        :param page: review page number added to product review_pages_done, None if page is not tracked
+        :type page: int, None
+        :param reviews: page reviews with hash field
+        :type reviews: list
+        :param block: if False, page is not queued when queue is full
+        :type block: bool
+        :return: True if page is queued
+        :rtype: bool
+        """
+        with self.condition:
+            while len(self.review_pages) >= self.max_queue_size and not self.closed:
+                if not block:
+                    return False
+                self.condition.wait()
+            if self.closed:
+                raise RuntimeError('Writer is closed')
+            self.review_pages.append((product_id, page, reviews, 0))
+            if len(self.review_pages) >= self.batch_size:
+                self.condition.notify_all()
+        return True
+
+    def put_many(self, docs, on_insert=None):
+        """
+        :param docs: product updates
+        :type docs: iterable
+        :param on_insert: fields which are set only if product is new
+        :type on_insert: dict, None
+        """
+        for doc in docs:
+            self.put(doc, on_insert)
+
+    def flush(self):
+        """Block until all queued updates are written"""
+        with self.condition:
+            self.condition.notify_all()
+            while (self.pending or self.review_pages or self.in_flight) and self.thread.is_alive():
+                self.condition.wait(self.flush_interval)
+
+    def close(self):
+        """Flush queued updates and stop writer thread"""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.log_stats()
+
+    def stats(self):
+        """
+        :return: writer throughput and queue depth
+        :rtype: dict
+        """
+        elapsed = time.time() - self.start_time
+        return {'queue_depth': len(self.pending),
+                'written_docs': self.written_docs,
+                'written_fields': self.written_fields,
+                'skipped_docs': self.skipped_docs,
+                'written_review_pages': self.written_review_pages,
+                'dropped_docs': self.dropped_docs,
+                'docs_per_sec': self.written_docs / elapsed if elapsed else 0,
+                'write_time': self.write_time}
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.info('db writer: {written_docs} docs written ({docs_per_sec:.1f}/sec), {written_fields} fields, '
+                     '{written_review_pages} review pages, '
+                     '{skipped_docs} unchanged docs skipped, {dropped_docs} failed docs dropped, '
+                     '{queue_depth} docs queued, {write_time:.1f} sec in db'.format(**stats))
+
+    def run(self):
+        """Writer loop"""
+        while True:
+            with self.condition:
+                deadline = time.time() + self.flush_interval
+                while len(self.pending) < self.batch_size and len(self.review_pages) < self.batch_size and \
+                        not self.closed and time.time() < deadline:
+                    self.condition.wait(max(deadline - time.time(), 0))
+                if not self.pending and not self.review_pages:
+                    if self.closed:
+                        return
+                    continue
+                # all review pages are taken, so pages queued before product update are written before it
+                review_pages, self.review_pages = self.review_pages, []
+                batch = [self.pending.popitem(last=False) for _ in range(min(self.batch_size, len(self.pending)))]
+                self.in_flight = len(batch) + len(review_pages)
+                # producers blocked on full queue can continue
+                self.condition.notify_all()
+            try:
+                self.write_review_pages(review_pages)
+                review_pages = []
+                self.write_batch(batch)
+            except Exception:
+                logging.error('Except on writing products batch', exc_info=True)
+                if self.requeue(batch, review_pages):
+                    time.sleep(self.flush_interval)
+            finally:
+                with self.condition:
+                    self.in_flight = 0
+                    self.condition.notify_all()
+            if time.time() - self.last_stats_time > 30:
+                self.last_stats_time = time.time()
+                self.log_stats()
+
+    def requeue(self, batch, review_pages=()):
+        """
+        Return failed batch to queue, newer queued values win.
+        Documents which failed max_attempts times are dropped, so close never hangs on broken db
+        :param batch: list of (_id, (fields, fields set on insert)) tuples
+        :type batch: list
+        :param review_pages: not written review pages, they are returned in front of queue
+        :type review_pages: list
+        :return: True if any document or review page is requeued
+        :rtype: bool
+        """
+        dropped = []
+        requeued_pages = [(product_id, page, reviews, attempts + 1)
+                          for product_id, page, reviews, attempts in review_pages if attempts + 1 < self.max_attempts]
+        dropped_pages = len(review_pages) - len(requeued_pages)
+        with self.condition:
+            self.review_pages[:0] = requeued_pages
+            for _id, (fields, insert_fields) in batch:
+                self.attempts[_id] = self.attempts.get(_id, 0) + 1
+                if self.attempts[_id] >= self.max_attempts:
+                    del self.attempts[_id]
+                    dropped.append(_id)
+                    continue
+                newer_fields, newer_insert_fields = self.pending.pop(_id, ({}, {}))
+                fields.update(newer_fields)
+                insert_fields.update(newer_insert_fields)
+                self.pending[_id] = (fields, insert_fields)
+            self.dropped_docs += len(dropped)
+        if dropped:
+            # products stay in previous crawl state in db, so they are crawled again on next run
+            logging.error('{} products are not written after {} attempts and dropped: {}'.format(
+                len(dropped), self.max_attempts, dropped))
+        if dropped_pages:
+            # pages are not marked as done, so they are fetched again on next run
+            logging.error('{} review pages are not written after {} attempts and dropped'.format(
+                dropped_pages, self.max_attempts))
+        return len(dropped) < len(batch) or bool(requeued_pages)
+
+    def write_review_pages(self, review_pages):
+        """
+        :param review_pages: list of (product id, page number, reviews, attempts) tuples
+        :type review_pages: list
+        """
+        if not review_pages:
+            return
+        start_time = time.time()
+        self.storage.add_review_pages([(product_id, page, reviews) for product_id, page, reviews, _ in review_pages])
+        self.write_time += time.time() - start_time
+        self.written_review_pages += len(review_pages)
+
+    @staticmethod
+    def digest(value):
+        return hashlib.md5(repr(value).encode('utf-8')).digest()
+
+    def write_batch(self, batch):
+        """
+        Write only changed fields of batch documents
+        :param batch: list of (_id, (fields, fields set on insert)) tuples
+        :type batch: list
+        """
+        updates = {}
+        inserts = {}
+        digests = {}
+        counted = {_id: fields for _id, (fields, _) in batch if fields.get('reviews_count') is REVIEWS_COUNT}
+        if counted:
+            # review pages of these products are written before, so they can be counted
+            for _id, count in self.storage.get_reviews_counts(counted).items():
+                counted[_id]['reviews_count'] = count
+        for _id, (fields, insert_fields) in batch:
+            written_fields = self.written.get(_id)
+            field_digests = {key: self.digest(value) for key, value in fields.items()}
+            changed_fields = {key: value for key, value in fields.items()
+                              if written_fields is None or written_fields.get(key) != field_digests[key]}
+            # document upserted by this writer already exists, so insert fields are not needed
+            if insert_fields and written_fields is None:
+                inserts[_id] = {key: value for key, value in insert_fields.items() if key not in changed_fields}
+            if changed_fields or _id in inserts:
+                updates[_id] = changed_fields
+                digests[_id] = field_digests
+            else:
+                self.skipped_docs += 1
+        if not updates:
+            return
+        start_time = time.time()
+        self.storage.update_products(updates, inserts)
+        self.write_time += time.time() - start_time
+        for _id, field_digests in digests.items():
+            self.written.setdefault(_id, {}).update(field_digests)
+            self.written.move_to_end(_id)
+            self.attempts.pop(_id, None)
+        while len(self.written) > self.max_tracked:
+            self.written.popitem(last=False)
+        self.written_docs += len(updates)
+        self.written_fields += sum(map(len, updates.values()))
@@ -0,0 +1,52 @@
+import os
+import sys
+import uuid
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(TESTS_DIR, 'fixtures')
+# modules are imported as top level packages like in management.py
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+
+@pytest.fixture
+def load_fixture():
+    """
+    :return: function returning fixture page html by file name
+    :rtype: callable
+    """
+    def load(name):
+        with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as fixture_file:
+            return fixture_file.read()
+    return load
+
+
+@pytest.fixture(scope='session')
+def mongo_client():
+    """
+    Client of mongod from MONGODB_TEST_URI env variable or localhost, tests are skipped if mongod is not running,
+    mongomock can't be used because it has no query planner
+    :rtype: pymongo.MongoClient
+    """
+    client = MongoClient(os.environ.get('MONGODB_TEST_URI', 'mongodb://localhost'), serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command('ping')
+    except PyMongoError:
+        client.close()
+        pytest.skip('mongod is not available, set MONGODB_TEST_URI to run db tests')
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def mongo_db(mongo_client):
+    """
+    :return: temporary database, dropped after test
+    :rtype: pymongo.database.Database
+    """
+    name = 'dresslily_test_{}'.format(uuid.uuid4().hex[:8])
+    yield mongo_client[name]
+    mongo_client.drop_database(name)
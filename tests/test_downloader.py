@@ -0,0 +1,153 @@
+"""Downloader request handling without network, site is local socket server"""
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+import requests
+
+from helpers.downloader_helper import Downloader
+
+MANAGEMENT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'management')
+
+
+class StalledServer:
+    """Answers every connection with headers and part of body and then stalls until it is stopped"""
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.getsockname()[1])
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while not self.stopped.is_set():
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            connection.recv(4096)
+            connection.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 1000000\r\n\r\npartial body')
+            self.stopped.wait()
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.server.close()
+
+
+class StatusServer(ThreadingMixIn, HTTPServer):
+    """Answers every GET request with same status and counts requests"""
+    daemon_threads = True
+
+    def __init__(self, status):
+        self.status = status
+        self.requests_count = 0
+        super().__init__(('127.0.0.1', 0), StatusHandler)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server_address[1])
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests_count += 1
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def create_downloader(monkeypatch):
+    """
+    :return: function creating downloader without proxies, which given up requests are collected in its dead_letters
+    :rtype: callable
+    """
+    # config is read relative to management directory like in launch
+    monkeypatch.chdir(MANAGEMENT_DIR)
+
+    def create(**kwargs):
+        dead_letters = []
+        downloader = Downloader(check_url='http://127.0.0.1', use_proxy=False, on_dead_letter=dead_letters.append,
+                                **kwargs)
+        downloader.dead_letters = dead_letters
+        return downloader
+    return create
+
+
+def test_deadline_stops_site_error_retries(create_downloader):
+    server = StatusServer(503)
+    downloader = create_downloader(deadline=0.5, backoff=0.1, max_backoff=0.2)
+    start_time = time.time()
+    try:
+        assert downloader.get(server.url) is None
+    finally:
+        server.stop()
+    assert time.time() - start_time < 1.5
+    # retries are spaced by backoff, so deadline is reached before attempts are exhausted
+    [dead_letter] = downloader.dead_letters
+    assert 1 < dead_letter['attempts'] < downloader.attempts
+    assert dead_letter['attempts'] == server.requests_count
+    assert dead_letter['failure'] == 'site'
+
+
+def test_deadline_limits_stalled_request(create_downloader):
+    server = StalledServer()
+    downloader = create_downloader(deadline=0.5)
+    start_time = time.time()
+    try:
+        assert downloader.get(server.url) is None
+    finally:
+        server.stop()
+    # request timeout is cut to remaining deadline
+    assert time.time() - start_time < 2
+    assert len(downloader.dead_letters) == 1
+
+
+def test_not_found_page_is_not_retried(create_downloader):
+    server = StatusServer(404)
+    downloader = create_downloader()
+    try:
+        assert downloader.get(server.url) is None
+    finally:
+        server.stop()
+    assert server.requests_count == 1
+    assert downloader.dead_letters[0]['failure'] == 'permanent'
+
+
+def test_abort_response_interrupts_blocked_reading():
+    server = StalledServer()
+    response = requests.get(server.url, stream=True, timeout=30)
+    result = {}
+
+    def read():
+        start_time = time.time()
+        try:
+            for _ in response.iter_content(1024):
+                pass
+        except Exception as e:
+            result['error'] = e
+        result['elapsed'] = time.time() - start_time
+
+    reader = threading.Thread(target=read)
+    try:
+        assert Downloader.get_response_socket(response) is not None
+        reader.start()
+        time.sleep(0.2)
+        Downloader.abort_response(response)
+        reader.join(5)
+        assert not reader.is_alive()
+        assert result['elapsed'] < 5
+    finally:
+        server.stop()
@@ -0,0 +1,105 @@
+"""Lane executor quotas, reservations and priorities, tasks wait on events instead of network"""
+import time
+from threading import Event, Lock
+
+import pytest
+
+from helpers.executor import LaneExecutor
+
+
+class Tasks:
+    """Blocking tasks which record their start order and max concurrency per lane"""
+    def __init__(self):
+        self.lock = Lock()
+        self.gate = Event()
+        self.running = {}
+        self.max_running = {}
+        self.started = []
+
+    def run(self, lane, name=None):
+        with self.lock:
+            self.running[lane] = self.running.get(lane, 0) + 1
+            self.max_running[lane] = max(self.max_running.get(lane, 0), self.running[lane])
+            self.started.append(name or lane)
+        self.gate.wait(5)
+        with self.lock:
+            self.running[lane] -= 1
+        return name or lane
+
+    def wait_started(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.started) < count:
+            assert time.time() < deadline
+            time.sleep(0.001)
+
+
+@pytest.fixture
+def tasks():
+    tasks = Tasks()
+    yield tasks
+    tasks.gate.set()
+
+
+def test_lane_runs_up_to_its_quota(tasks):
+    executor = LaneExecutor(max_workers=10).add_lane('crawl', quota=2)
+    futures = [executor.lane('crawl').submit(tasks.run, 'crawl') for _ in range(5)]
+    tasks.wait_started(2)
+    time.sleep(0.05)
+    assert len(tasks.started) == 2
+    tasks.gate.set()
+    assert [future.result(5) for future in futures] == ['crawl'] * 5
+    assert tasks.max_running['crawl'] == 2
+    assert executor.stats()['crawl']['completed'] == 5
+    executor.shutdown()
+
+
+def test_reserved_slots_are_not_taken_by_other_lanes(tasks):
+    # crawl tasks wait for review tasks, so reviews must get slot even when crawl lane has queued tasks
+    executor = LaneExecutor(max_workers=3) \
+        .add_lane('crawl', quota=3) \
+        .add_lane('reviews', quota=3, reserved=1)
+    crawl_futures = [executor.lane('crawl').submit(tasks.run, 'crawl') for _ in range(4)]
+    tasks.wait_started(2)
+    time.sleep(0.05)
+    assert tasks.running == {'crawl': 2}
+    review_future = executor.lane('reviews').submit(tasks.run, 'reviews')
+    tasks.wait_started(3)
+    assert tasks.running == {'crawl': 2, 'reviews': 1}
+    tasks.gate.set()
+    assert review_future.result(5) == 'reviews'
+    for future in crawl_futures:
+        future.result(5)
+    executor.shutdown()
+
+
+def test_earlier_lane_has_priority(tasks):
+    executor = LaneExecutor(max_workers=1).add_lane('high', quota=1).add_lane('low', quota=1)
+    executor.lane('high').submit(tasks.run, 'high', 'blocker')
+    tasks.wait_started(1)
+    futures = [executor.lane('low').submit(tasks.run, 'low'), executor.lane('high').submit(tasks.run, 'high')]
+    tasks.gate.set()
+    for future in futures:
+        future.result(5)
+    assert tasks.started == ['blocker', 'high', 'low']
+    executor.shutdown()
+
+
+def test_try_submit_doesnt_block_on_full_lane(tasks):
+    executor = LaneExecutor(max_workers=2).add_lane('hedge', quota=1, max_pending=2)
+    lane = executor.lane('hedge')
+    futures = [lane.try_submit(tasks.run, 'hedge') for _ in range(3)]
+    assert futures[2] is None
+    tasks.gate.set()
+    for future in futures[:2]:
+        future.result(5)
+    # finished tasks free lane places
+    assert lane.try_submit(tasks.run, 'hedge').result(5) == 'hedge'
+    executor.shutdown()
+
+
+def test_invalid_reservations_are_rejected():
+    executor = LaneExecutor(max_workers=4).add_lane('crawl', quota=4, reserved=3)
+    with pytest.raises(ValueError):
+        executor.add_lane('reviews', quota=2, reserved=2)
+    with pytest.raises(ValueError):
+        executor.add_lane('crawl', quota=1)
@@ -0,0 +1,111 @@
+"""bs4, lxml and stream extraction backends must return identical data from same pages"""
+import pytest
+from bs4 import BeautifulSoup
+
+from scrapers.dresslily import DresslilyParser, DresslilyScraper
+from scrapers.dresslily_lxml import DresslilyLxmlExtractor, ProductPageStreamParser, ReviewPageStreamParser
+
+PRODUCT_PAGES = ['product_page.html', 'product_page_no_rating.html']
+REVIEW_PAGES = ['review_page.html', 'review_page_single.html']
+# stream parsers must not depend on how response is split into chunks
+CHUNK_SIZES = [1, 7, 64, 16 * 1024]
+
+
+def feed_stream_parser(parser_class, html, chunk_size):
+    """
+    Feed page into stream parser like downloader does
+    :return: fed parser
+    """
+    body = html.encode('utf-8')
+    parser = parser_class('utf-8')
+    for start in range(0, len(body), chunk_size):
+        if parser.feed(body[start:start + chunk_size]):
+            return parser
+    parser.finish()
+    return parser
+
+
+def test_scrape_single_product_parity(load_fixture):
+    html = load_fixture('category_page.html')
+    soup_products = DresslilyScraper.get_products_on_category_page(BeautifulSoup(html, 'lxml'))
+    lxml_products = DresslilyLxmlExtractor.get_products_on_category_page(DresslilyLxmlExtractor.parse_html(html))
+    assert len(soup_products) == len(lxml_products) == 4
+    for soup_product, lxml_product in zip(soup_products, lxml_products):
+        assert DresslilyScraper.scrape_single_product(soup_product) == \
+            DresslilyLxmlExtractor.scrape_single_product(lxml_product)
+
+
+def test_category_page_parity(load_fixture):
+    html = load_fixture('category_page.html')
+    bs4_products, bs4_pages_count = DresslilyScraper.parse_category_page(html, 'bs4')
+    assert (bs4_products, bs4_pages_count) == DresslilyScraper.parse_category_page(html, 'lxml')
+    assert (bs4_products, bs4_pages_count) == DresslilyScraper.parse_category_page(html, 'stream')
+    assert bs4_pages_count == 27
+    assert [product['_id'] for product in bs4_products] == [4438811, 5120934, 3310457]
+    assert bs4_products[0] == {
+        '_id': 4438811,
+        'url': 'https://www.dresslily.com/drawstring-kangaroo-pocket-pullover-hoodie-product4438811.html',
+        'name': 'Drawstring Kangaroo Pocket Pullover Hoodie',
+        'original_price': 35.82,
+        'discount_price': 21.49,
+        'discount': 40,
+    }
+    assert bs4_products[1]['name'] == 'Letter Graphic Fleece Zip Up Hoodie & Pocket'
+    assert bs4_products[1]['discount'] == 0
+
+
+@pytest.mark.parametrize('page', PRODUCT_PAGES)
+def test_get_product_rating_parity(load_fixture, page):
+    html = load_fixture(page)
+    assert DresslilyParser.get_product_rating(BeautifulSoup(html, 'lxml')) == \
+        DresslilyLxmlExtractor.get_product_rating(DresslilyLxmlExtractor.parse_html(html))
+
+
+@pytest.mark.parametrize('page', PRODUCT_PAGES)
+def test_get_product_info_parity(load_fixture, page):
+    html = load_fixture(page)
+    assert DresslilyParser.get_product_info(BeautifulSoup(html, 'lxml')) == \
+        DresslilyLxmlExtractor.get_product_info(DresslilyLxmlExtractor.parse_html(html))
+
+
+@pytest.mark.parametrize('page', PRODUCT_PAGES)
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_product_page_parity(load_fixture, page, chunk_size):
+    html = load_fixture(page)
+    bs4_product = DresslilyParser.parse_product_page(html, 'bs4')
+    assert bs4_product == DresslilyParser.parse_product_page(html, 'lxml')
+    assert bs4_product == feed_stream_parser(ProductPageStreamParser, html, chunk_size).result()
+
+
+def test_product_page_values(load_fixture):
+    assert DresslilyParser.parse_product_page(load_fixture('product_page.html'), 'bs4') == {
+        'rating': 4.7,
+        'product_info': 'Material:Polyester,Cotton;Clothing Length:Regular;Sleeve Length:Full;Style:Casual;'
+                        'Pattern Type:Solid',
+    }
+    assert DresslilyParser.parse_product_page(load_fixture('product_page_no_rating.html'), 'bs4') == {
+        'rating': None,
+        'product_info': 'Material:Cotton Blend;Season:Fall,Winter',
+    }
+
+
+@pytest.mark.parametrize('page', REVIEW_PAGES)
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_review_page_parity(load_fixture, page, chunk_size):
+    html = load_fixture(page)
+    bs4_reviews, bs4_pages_count = DresslilyParser.parse_review_page(html, 'bs4')
+    assert (bs4_reviews, bs4_pages_count) == DresslilyParser.parse_review_page(html, 'lxml')
+    stream_parser = feed_stream_parser(ReviewPageStreamParser, html, chunk_size)
+    assert (bs4_reviews, bs4_pages_count) == DresslilyParser.get_stream_review_page(stream_parser)
+
+
+def test_review_page_values(load_fixture):
+    reviews, pages_count = DresslilyParser.parse_review_page(load_fixture('review_page.html'), 'bs4')
+    assert pages_count == 4
+    assert [(review['rating'], review['size'], review['color']) for review in reviews] == \
+        [(5, 'M', 'Black'), (3, 'XL', 'Light Gray'), (4, 'S', None)]
+    assert reviews[1]['text'] == 'Sleeves are a bit long & the color is lighter than on photo.'
+    assert len({review['hash'] for review in reviews}) == 3
+    reviews, pages_count = DresslilyParser.parse_review_page(load_fixture('review_page_single.html'), 'bs4')
+    assert pages_count is None
+    assert [(review['size'], review['color']) for review in reviews] == [(None, 'Wine Red')]
@@ -0,0 +1,92 @@
+"""Hedge race and budget, hedges run in executor lane instead of making requests"""
+import time
+
+import pytest
+
+from helpers.executor import LaneExecutor
+from helpers.hedging import HEDGE, PRIMARY, HedgeBudget, HedgeCancelled, HedgeRace, Hedger
+
+
+class FullLane:
+    """Lane which never has free slot"""
+    def try_submit(self, func, *args):
+        return None
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.001)
+
+
+def test_winner_aborts_loser():
+    race = HedgeRace()
+    aborted = []
+    race.register(PRIMARY, lambda: aborted.append(PRIMARY))
+    race.register(HEDGE, lambda: aborted.append(HEDGE))
+    assert race.win(HEDGE)
+    assert aborted == [PRIMARY]
+    assert not race.win(PRIMARY)
+    with pytest.raises(HedgeCancelled):
+        race.check(PRIMARY)
+    race.check(HEDGE)
+    # response opened after race is won is aborted at once
+    with pytest.raises(HedgeCancelled):
+        race.register(PRIMARY, lambda: aborted.append('late'))
+    assert aborted == [PRIMARY, 'late']
+
+
+def test_hedge_is_not_started_after_race_is_closed():
+    race = HedgeRace()
+    assert race.close() is None
+    assert not race.start_hedge(lambda: pytest.fail('hedge must not be submitted'))
+
+
+def test_budget_limits_hedges_share():
+    budget = HedgeBudget(ratio=0.5, burst=1)
+    assert budget.try_spend()
+    assert not budget.try_spend()
+    budget.earn()
+    assert not budget.try_spend()
+    budget.earn()
+    assert budget.try_spend()
+    budget.refund()
+    budget.refund()
+    # refund never exceeds burst
+    assert budget.tokens == 1
+
+
+def test_late_request_is_hedged_in_lane():
+    executor = LaneExecutor(max_workers=2).add_lane('hedge', quota=1)
+    hedger = Hedger(executor.lane('hedge'), budget_burst=1)
+    race = HedgeRace()
+    hedger.watch(race, 0.01, lambda attempt: attempt, HEDGE)
+    wait_for(lambda: race.hedge_future is not None)
+    assert race.close().result(5) == HEDGE
+    assert hedger.counters['hedged'] == 1
+    assert hedger.budget.tokens == 0
+    executor.shutdown()
+
+
+def test_hedge_without_slot_refunds_budget():
+    hedger = Hedger(FullLane(), budget_burst=1)
+    race = HedgeRace()
+    hedger.watch(race, 0.01, lambda: pytest.fail('hedge must not run'))
+    wait_for(lambda: hedger.counters['no_slot'] == 1)
+    assert hedger.counters['hedged'] == 0
+    assert hedger.budget.tokens == 1
+    assert race.close() is None
+
+
+def test_finished_request_is_not_hedged():
+    hedger = Hedger(FullLane(), budget_burst=1)
+    race = HedgeRace()
+    hedger.watch(race, 0.01, lambda: pytest.fail('hedge must not run'))
+    race.close()
+    # next watched race shows that monitor has passed closed one
+    next_race = HedgeRace()
+    hedger.watch(next_race, 0.02, lambda: None)
+    wait_for(lambda: hedger.counters['no_slot'] == 1)
+    assert hedger.counters['hedged'] == 0
+    assert hedger.budget.tokens == 1
@@ -0,0 +1,58 @@
+"""Incremental mode fetches review pages only until first known page, on both engines"""
+import asyncio
+
+from scrapers.dresslily import DresslilyParser
+
+# 3 review pages, reviews are sorted from newest
+PAGES = {page: [{'hash': 'review-{}-{}'.format(page, position), 'timestamp': 100 - page * 10 - position}
+                for position in range(6)] for page in (1, 2, 3)}
+
+
+class FakeReviewParser(DresslilyParser):
+    """Parser which review pages are served from PAGES without network"""
+    def __init__(self):
+        super().__init__(downloader=None, domain='https://www.dresslily.com', backend='lxml')
+        self.requested = []
+
+    def get_page(self, link):
+        page = int(link.rsplit('-page-', 1)[1].split('.')[0])
+        self.requested.append(page)
+        return PAGES[page], len(PAGES)
+
+    def get_review_page(self, link):
+        return self.get_page(link)
+
+    async def get_review_page_async(self, link):
+        return self.get_page(link)
+
+
+def test_incremental_reviews_stop_at_known_page():
+    # first page has 2 new reviews, rest of it and next pages are stored, so fetching stops at second page
+    known_reviews = PAGES[1][2:] + PAGES[2] + PAGES[3]
+    parser = FakeReviewParser()
+    reviews = parser.get_product_reviews(1, known_reviews)
+    assert [review['hash'] for review in reviews] == ['review-1-0', 'review-1-1']
+    assert parser.requested == [1, 2]
+
+
+def test_incremental_reviews_async_stop_at_known_page():
+    known_reviews = PAGES[2] + PAGES[3]
+    parser = FakeReviewParser()
+    saved_pages = []
+
+    async def save_page(page, page_reviews):
+        saved_pages.append(page)
+
+    reviews = asyncio.get_event_loop().run_until_complete(parser.get_product_reviews_async(
+        1, known_reviews, on_page=save_page))
+    assert [review['hash'] for review in reviews] == [review['hash'] for review in PAGES[1]]
+    # third page is not requested because second page is already stored
+    assert parser.requested == [1, 2]
+    assert saved_pages == [1, 2]
+
+
+def test_reviews_async_without_known_reviews_fetch_all_pages():
+    parser = FakeReviewParser()
+    reviews = asyncio.get_event_loop().run_until_complete(parser.get_product_reviews_async(1))
+    assert len(reviews) == 18
+    assert sorted(parser.requested) == [1, 2, 3]
@@ -0,0 +1,83 @@
+"""Crawl state and export queries must be served by indexes, not by collection scans"""
+import time
+
+import pytest
+
+from storage.mongodb_storage import MongoDBStorage
+
+PRODUCT_FIELDS = ['_id', 'url', 'name', 'rating']
+REVIEW_FIELDS = ['product_id', 'rating', 'timestamp', 'text']
+
+
+def get_plan_stages(plan):
+    """
+    :param plan: explain winning plan or its input stage
+    :type plan: dict
+    :return: (stage, index name) of all plan stages
+    :rtype: list
+    """
+    stages = [(plan.get('stage'), plan.get('indexName'))]
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            stages.extend(get_plan_stages(plan[key]))
+    for input_stage in plan.get('inputStages', []):
+        stages.extend(get_plan_stages(input_stage))
+    return stages
+
+
+def get_used_indexes(cursor):
+    """
+    :param cursor: not iterated query cursor
+    :type cursor: pymongo.cursor.Cursor
+    :return: names of scanned indexes
+    :rtype: set
+    """
+    stages = get_plan_stages(cursor.explain()['queryPlanner']['winningPlan'])
+    assert 'COLLSCAN' not in {stage for stage, _ in stages}
+    return {index for stage, index in stages if stage == 'IXSCAN'}
+
+
+@pytest.fixture
+def storage(mongo_db):
+    storage = MongoDBStorage(mongo_db)
+    storage.ensure_indexes()
+    now = time.time()
+    states = ['listed', 'page_parsed', 'reviews_parsed', 'failed']
+    storage.product_collection.insert_many([
+        dict({'_id': n, 'url': 'product{}.html'.format(n), 'name': str(n)},
+             **dict(storage.crawl_state_fields(states[n % 4]), crawl_state_at=now - n, changed_at=now - n))
+        for n in range(200)])
+    storage.review_collection.insert_many([{'product_id': n % 50, 'timestamp': now - n, 'saved_at': now - n}
+                                           for n in range(200)])
+    return storage
+
+
+def test_pending_products_use_crawl_state_index(storage):
+    cursor = storage.get_products_by_state(('listed', 'page_parsed', 'failed'), {'_id': 1, 'url': 1})
+    assert get_used_indexes(cursor) & {'crawl_state_1', 'crawl_state_1_changed_at_1'}
+
+
+def test_export_products_use_crawl_state_index(storage):
+    assert get_used_indexes(storage.get_export_products(PRODUCT_FIELDS)) & {'crawl_state_1',
+                                                                          'crawl_state_1_changed_at_1'}
+
+
+@pytest.mark.parametrize('since', [None, time.time() - 100])
+def test_changed_products_use_changed_at_index(storage, since):
+    cursor = storage.get_changed_products(PRODUCT_FIELDS, since, time.time())
+    assert get_used_indexes(cursor) == {'crawl_state_1_changed_at_1'}
+
+
+@pytest.mark.parametrize('since', [None, time.time() - 100])
+def test_changed_reviews_use_saved_at_index(storage, since):
+    assert get_used_indexes(storage.get_changed_reviews(REVIEW_FIELDS, since, time.time())) == {'saved_at_1'}
+
+
+def test_migrate_crawl_state_is_not_run_by_ensure_indexes(mongo_db):
+    storage = MongoDBStorage(mongo_db)
+    storage.product_collection.insert_many([{'_id': 1}, {'_id': 2, 'rating': 4.5}, {'_id': 3, 'reviews_count': 2}])
+    storage.ensure_indexes()
+    assert storage.product_collection.count_documents({'crawl_state': {'$exists': True}}) == 0
+    storage.migrate_crawl_state()
+    assert {product['_id']: product['crawl_state'] for product in storage.product_collection.find()} == \
+        {1: 'listed', 2: 'page_parsed', 3: 'reviews_parsed'}
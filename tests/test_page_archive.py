@@ -0,0 +1,65 @@
+"""Raw pages archive in temporary directory"""
+import re
+
+from helpers.page_archive import PageArchive
+
+PAGE_TYPES = [('category', re.compile(r'-page-\d+\.html')), ('product', re.compile(r'-p-\d+\.html'))]
+
+
+def create_archive(path, **kwargs):
+    return PageArchive(str(path), PAGE_TYPES, **kwargs)
+
+
+def read_pages(archive, page_type):
+    """
+    :return: url -> body of latest archived pages of type
+    :rtype: dict
+    """
+    pages = {}
+    for segment, offset, length, urls in archive.get_batches(page_type):
+        records = {record['url']: record for record in PageArchive.read_batch(archive.path, segment, offset, length)}
+        for url in urls:
+            assert records[url]['page_type'] == page_type
+            pages[url] = records[url]['body']
+    return pages
+
+
+def test_archived_pages_are_read_back_by_type(tmp_path):
+    archive = create_archive(tmp_path, batch_size=2)
+    archive.add('https://www.dresslily.com/hoodies-c-181-page-1.html', 'толстовки'.encode('cp1251'), 'cp1251')
+    archive.add('https://www.dresslily.com/hoodie-p-1.html', b'hoodie 1', 'utf-8')
+    archive.add('https://www.dresslily.com/hoodie-p-2.html', b'hoodie 2', 'utf-8')
+    archive.close()
+    archive = create_archive(tmp_path)
+    assert read_pages(archive, 'category') == {'https://www.dresslily.com/hoodies-c-181-page-1.html': 'толстовки'}
+    assert read_pages(archive, 'product') == {'https://www.dresslily.com/hoodie-p-1.html': 'hoodie 1',
+                                              'https://www.dresslily.com/hoodie-p-2.html': 'hoodie 2'}
+    # batch holds pages of any types, first product page is in one batch with category page
+    assert archive.get_batches('category')[0][:2] == archive.get_batches('product')[0][:2]
+    assert len(archive.get_batches('product')) == 2
+    archive.close()
+
+
+def test_unchanged_page_is_not_archived_again(tmp_path):
+    url = 'https://www.dresslily.com/hoodie-p-1.html'
+    archive = create_archive(tmp_path, batch_size=1)
+    archive.add(url, b'hoodie', 'utf-8')
+    archive.close()
+    # hashes of archived pages are loaded from index after restart
+    archive = create_archive(tmp_path, batch_size=1)
+    archive.add(url, b'hoodie', 'utf-8')
+    assert archive.archived == 0
+    archive.add(url, b'changed hoodie', 'utf-8')
+    assert archive.archived == 1
+    # only latest version of page is replayed
+    assert read_pages(archive, 'product') == {url: 'changed hoodie'}
+    archive.close()
+
+
+def test_segment_is_rolled_when_it_is_full(tmp_path):
+    archive = create_archive(tmp_path, batch_size=1, segment_size=1)
+    for n in range(3):
+        archive.add('https://www.dresslily.com/hoodie-p-{}.html'.format(n), b'hoodie', 'utf-8')
+    assert [batch[0] for batch in archive.get_batches('product')] == [1, 2, 3]
+    assert len(read_pages(archive, 'product')) == 3
+    archive.close()
@@ -0,0 +1,22 @@
+"""Parse pool runs tasks in worker processes, builtin functions are used because they are picklable"""
+from helpers.parse_pool import ParsePool
+
+
+def test_imap_unordered_keeps_bounded_window():
+    pool = ParsePool(processes=1)
+    submitted = []
+
+    def tasks():
+        for n in range(20):
+            submitted.append(n)
+            yield 2, n
+
+    try:
+        results = []
+        for result in pool.imap_unordered(pow, tasks(), max_pending=3):
+            # tasks are taken lazily, so not yielded tasks never exceed window
+            assert len(submitted) - len(results) <= 3
+            results.append(result)
+    finally:
+        pool.shutdown()
+    assert sorted(results) == [2 ** n for n in range(20)]
@@ -0,0 +1,42 @@
+"""Product changed_at is watermark of incremental export, it must change only with exported fields"""
+import time
+
+from storage.mongodb_storage import MongoDBStorage
+
+PRODUCT = {'_id': 1, 'url': 'product1.html', 'name': 'Hoodie', 'discount': 10, 'discount_price': 18.0,
+           'original_price': 20.0}
+
+
+def get_changed_at(storage):
+    return storage.product_collection.find_one({'_id': 1})['changed_at']
+
+
+def test_changed_at_follows_exported_fields(mongo_db):
+    storage = MongoDBStorage(mongo_db)
+    storage.add_listed_products([dict(PRODUCT)])
+    listed_at = get_changed_at(storage)
+    time.sleep(0.01)
+    # same listing and not exported fields don't change product
+    storage.add_listed_products([dict(PRODUCT)])
+    storage.update_products({1: dict(storage.crawl_state_fields('page_parsed'), review_pages_done=[])})
+    assert get_changed_at(storage) == listed_at
+    # re-listing with new price
+    storage.add_listed_products([dict(PRODUCT, discount_price=15.0)])
+    repriced_at = get_changed_at(storage)
+    assert repriced_at > listed_at
+    time.sleep(0.01)
+    storage.update_products({1: {'rating': None, 'product_info': 'Material:Cotton'}})
+    assert get_changed_at(storage) > repriced_at
+
+
+def test_changed_products_are_exported_once(mongo_db):
+    storage = MongoDBStorage(mongo_db)
+    storage.add_listed_products([dict(PRODUCT), dict(PRODUCT, _id=2)])
+    storage.update_products({_id: dict(storage.crawl_state_fields('reviews_parsed'), rating=4.5)
+                             for _id in (1, 2)})
+    first_export = time.time()
+    assert sorted(product['_id'] for product in storage.get_changed_products(['_id'], None, first_export)) == [1, 2]
+    time.sleep(0.01)
+    storage.add_listed_products([dict(PRODUCT, _id=2, name='Hoodie 2')])
+    changed = storage.get_changed_products(['_id'], first_export, time.time())
+    assert [product['_id'] for product in changed] == [2]
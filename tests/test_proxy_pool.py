@@ -0,0 +1,103 @@
+"""Proxy pool scheduling and circuit breakers without network, cooldowns are short so tests sleep through them"""
+import time
+from threading import Thread
+
+import pytest
+
+from helpers.proxy_pool import CLOSED, HALF_OPEN, OPEN, ProxyPool, ProxyPoolTimeout
+
+
+def wait_for(condition, timeout=5):
+    """Wait until condition is true, e.g. until thread is queued into pool waiters"""
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.001)
+
+
+def test_waiters_get_released_proxy_in_fifo_order():
+    pool = ProxyPool(max_on_work=1)
+    pool.add('10.0.0.1:8080', 1.0)
+    proxy = pool.acquire()
+    order = []
+
+    def acquire(name):
+        pool.release(pool.acquire(timeout=5), 1.0)
+        order.append(name)
+
+    threads = []
+    for n, name in enumerate(('first', 'second', 'third')):
+        thread = Thread(target=acquire, args=(name,))
+        thread.start()
+        threads.append(thread)
+        wait_for(lambda: len(pool._waiters) == n + 1)
+    # new acquirer doesn't overtake waiting ones even if proxy is free
+    pool.release(proxy, 1.0)
+    for thread in threads:
+        thread.join(5)
+    assert order == ['first', 'second', 'third']
+
+
+def test_acquire_timeout():
+    pool = ProxyPool(max_on_work=1)
+    pool.add('10.0.0.1:8080', 1.0)
+    pool.acquire()
+    start_time = time.time()
+    with pytest.raises(ProxyPoolTimeout):
+        pool.acquire(timeout=0.05)
+    assert time.time() - start_time < 1
+    # timed out waiter leaves queue, so it doesn't hold next acquirers
+    assert not pool._waiters
+    assert pool.acquire(block=False) is None
+
+
+def test_circuit_breaker_opens_with_growing_cooldown():
+    pool = ProxyPool(error_cooldown=0.05, failure_threshold=2, max_opens=2)
+    proxy = '10.0.0.1:8080'
+    pool.add(proxy, 1.0)
+    state = pool.get(proxy)
+
+    # single failure doesn't open circuit
+    pool.acquire()
+    assert not pool.mark_failed(proxy)
+    pool.release(proxy)
+    assert state.circuit == CLOSED
+
+    pool.acquire()
+    assert not pool.mark_failed(proxy)
+    pool.release(proxy)
+    assert state.circuit == OPEN
+    assert state.open_until - state.previous_error_time == pytest.approx(0.05)
+    assert pool.acquire(block=False) is None
+
+    # cooled proxy gets single probe request
+    time.sleep(0.06)
+    assert pool.acquire(block=False) == proxy
+    assert state.circuit == HALF_OPEN
+    assert pool.acquire(block=False) is None
+
+    # failed probe opens circuit twice longer
+    assert not pool.mark_failed(proxy)
+    pool.release(proxy)
+    assert state.circuit == OPEN
+    assert state.open_until - state.previous_error_time == pytest.approx(0.1)
+
+    # successful probe closes circuit and resets cooldown growth
+    time.sleep(0.11)
+    assert pool.acquire(block=False) == proxy
+    pool.release(proxy, 0.5)
+    assert state.circuit == CLOSED
+    assert state.open_count == 0
+    assert pool.get_circuit_counts() == {CLOSED: 1, OPEN: 0, HALF_OPEN: 0}
+
+
+def test_proxy_opened_too_many_times_must_be_deleted():
+    pool = ProxyPool(error_cooldown=0.01, failure_threshold=1, max_opens=2)
+    proxy = '10.0.0.1:8080'
+    pool.add(proxy, 1.0)
+    for _ in range(2):
+        assert pool.acquire(timeout=1) == proxy
+        assert not pool.mark_failed(proxy)
+        pool.release(proxy)
+    assert pool.acquire(timeout=1) == proxy
+    assert pool.mark_failed(proxy)
@@ -0,0 +1,77 @@
+"""Adaptive host limits react to request outcomes, rates are high so acquire never sleeps"""
+import time
+
+from helpers.proxy_helper import BanError, PermanentError, SiteError
+from helpers.rate_limiter import BAN, OK, PROXY_ERROR, SITE_ERROR, AimdLimit, HostLimiter, RateLimiter
+
+
+def test_aimd_limit_decreases_once_per_episode_and_recovers_additively():
+    limit = AimdLimit(10, 1, 100, increase=5.0, decrease_interval=60)
+    limit.decrease(0.5)
+    # failures of one episode come in bursts, only first one decreases limit
+    limit.decrease(0.5)
+    assert limit.value == 5
+    # limit grows by about increase step per value successes
+    for _ in range(5):
+        limit.increase()
+    assert 8 < limit.value < 10
+    for _ in range(1000):
+        limit.increase()
+    assert limit.value == 100
+
+
+def test_host_limits_back_off_on_ban_and_recover():
+    limiter = HostLimiter('example.com', concurrency=8, rate=1000.0)
+    limiter.acquire()
+    limiter.release(BAN, 0.1)
+    assert limiter.concurrency.value == 4
+    assert limiter.rate.value == 500
+    assert limiter.bucket.rate == 500
+    # proxy errors say nothing about host
+    limiter.acquire()
+    limiter.release(PROXY_ERROR, 0.1)
+    assert limiter.concurrency.value == 4
+
+    # concurrency grows while requests use all slots and site answers fast
+    for _ in range(100):
+        slots = int(limiter.concurrency.value)
+        for _ in range(slots):
+            limiter.acquire()
+        assert limiter.in_flight == slots
+        for _ in range(slots):
+            limiter.release(OK, 0.1)
+        if limiter.concurrency.value >= 8:
+            break
+    assert limiter.concurrency.value >= 8
+    assert limiter.in_flight == 0
+
+
+def test_host_concurrency_limit_holds_requests():
+    limiter = HostLimiter('example.com', concurrency=1, rate=1000.0)
+    limiter.acquire()
+    assert not limiter._try_acquire(None)
+    limiter.release(SITE_ERROR, 0.1)
+    assert limiter._try_acquire(None)
+
+
+def test_request_outcomes():
+    assert RateLimiter.classify(None) == OK
+    assert RateLimiter.classify(BanError()) == BAN
+    assert RateLimiter.classify(SiteError(503)) == SITE_ERROR
+    # not found page is normal site answer
+    assert RateLimiter.classify(PermanentError(404)) == OK
+
+
+def test_proxy_rate_is_not_limited_by_default():
+    rate_limiter = RateLimiter()
+    start_time = time.time()
+    for _ in range(50):
+        rate_limiter.wait_proxy('10.0.0.1:8080')
+    assert time.time() - start_time < 0.5
+    assert not rate_limiter.proxy_buckets
+    # opt-in rate allows burst and then spaces requests
+    rate_limiter = RateLimiter(request_per_min=600, proxy_burst=1)
+    start_time = time.time()
+    for _ in range(3):
+        rate_limiter.wait_proxy('10.0.0.1:8080')
+    assert time.time() - start_time >= 0.15
@@ -0,0 +1,62 @@
+"""Replay of archived review pages fixes stored reviews instead of adding new ones next to them"""
+import time
+
+from storage.mongodb_storage import MongoDBStorage
+
+
+def make_review(position, text='Review'):
+    return {'hash': '{}-{}'.format(text, position), 'text': '{} {}'.format(text, position), 'timestamp': position}
+
+
+def get_reviews(storage):
+    return {review['_id']: review for review in storage.review_collection.find({'product_id': 1})}
+
+
+def test_replay_supersedes_crawled_reviews(mongo_db):
+    storage = MongoDBStorage(mongo_db)
+    storage.ensure_indexes()
+    storage.add_review_pages([(1, 1, [make_review(0, 'Broken'), make_review(1, 'Broken')]),
+                              (1, 2, [make_review(2, 'Broken')])])
+    # pages are archived after reviews are saved
+    fetched_at = replayed_at = time.time()
+    storage.replace_review_pages([(1, 1, [make_review(0), make_review(1)]), (1, 2, [make_review(2)])], replayed_at)
+    assert storage.delete_superseded_reviews({1: fetched_at}, replayed_at) == 3
+    reviews = get_reviews(storage)
+    assert sorted(reviews) == ['1:p1:0', '1:p1:1', '1:p2:0']
+    assert sorted(review['text'] for review in reviews.values()) == ['Review 0', 'Review 1', 'Review 2']
+
+
+def test_replay_keeps_reviews_saved_after_archive(mongo_db):
+    storage = MongoDBStorage(mongo_db)
+    storage.add_review_pages([(1, 1, [make_review(0, 'Broken')])])
+    fetched_at = time.time()
+    time.sleep(0.01)
+    # crawl without archive after pages were archived, and crawl which archived its pages
+    storage.add_review_pages([(1, 1, [make_review(3, 'Later')])])
+    storage.add_review_pages([(1, 1, [dict(make_review(4, 'Archived'), page_archived=True)])])
+    replayed_at = time.time()
+    storage.replace_review_pages([(1, 1, [make_review(0)])], replayed_at)
+    assert storage.delete_superseded_reviews({1: fetched_at}, replayed_at) == 2
+    assert sorted(get_reviews(storage)) == ['1:Later-3', '1:p1:0']
+
+
+def test_unchanged_replayed_reviews_keep_saved_at(mongo_db):
+    storage = MongoDBStorage(mongo_db)
+    pages = [(1, 1, [make_review(0), make_review(1)])]
+    storage.replace_review_pages(pages, time.time())
+    saved_at = {_id: review['saved_at'] for _id, review in get_reviews(storage).items()}
+    time.sleep(0.01)
+    replayed_at = time.time()
+    storage.replace_review_pages([(1, 1, [make_review(0), make_review(1, 'Fixed')])], replayed_at)
+    assert storage.delete_superseded_reviews({1: replayed_at}, replayed_at) == 0
+    reviews = get_reviews(storage)
+    assert reviews['1:p1:0']['saved_at'] == saved_at['1:p1:0']
+    assert reviews['1:p1:1']['saved_at'] > saved_at['1:p1:1']
+
+
+def test_crawl_after_replay_adds_only_new_reviews(mongo_db):
+    storage = MongoDBStorage(mongo_db)
+    storage.ensure_indexes()
+    storage.replace_review_pages([(1, 1, [make_review(0), make_review(1)])], time.time())
+    storage.add_review_pages([(1, 1, [make_review(5), make_review(0), make_review(1)])])
+    assert sorted(get_reviews(storage)) == ['1:Review-5', '1:p1:0', '1:p1:1']
@@ -0,0 +1,84 @@
+"""On-disk response cache in temporary directory"""
+import os
+import re
+import time
+
+from helpers.response_cache import ResponseCache
+
+PAGE_TYPES = [('category', re.compile(r'-page-\d+\.html')), ('product', re.compile(r'-p-\d+\.html'))]
+CATEGORY_URL = 'https://www.dresslily.com/hoodies-c-181-page-1.html'
+PRODUCT_URL = 'https://www.dresslily.com/hoodie-p-1.html'
+
+
+def create_cache(path, **kwargs):
+    return ResponseCache(str(path), PAGE_TYPES, **kwargs)
+
+
+def body_files(cache):
+    return [name for _, _, names in os.walk(cache.bodies_path) for name in names]
+
+
+def test_stored_page_is_found_after_reopen(tmp_path):
+    cache = create_cache(tmp_path)
+    assert cache.lookup(CATEGORY_URL) is None
+    cache.store(CATEGORY_URL, 'толстовка'.encode('utf-8'), 'utf-8', {'ETag': '"v1"'})
+    cache.close()
+    cache = create_cache(tmp_path)
+    cached = cache.lookup(CATEGORY_URL)
+    assert cached.is_fresh()
+    assert cached.replay() == 'толстовка'
+    assert cached.get_validators() == {'If-None-Match': '"v1"'}
+    assert cache.counters['hits'] == 1
+    cache.close()
+
+
+def test_stale_page_is_revalidated(tmp_path):
+    cache = create_cache(tmp_path, ttls={'product': 0})
+    cache.store(PRODUCT_URL, b'<html>hoodie</html>', 'utf-8', {'Last-Modified': 'Mon, 01 Jun 2020 00:00:00 GMT'})
+    cached = cache.lookup(PRODUCT_URL)
+    assert not cached.is_fresh()
+    assert cached.get_validators() == {'If-Modified-Since': 'Mon, 01 Jun 2020 00:00:00 GMT'}
+    assert cache.counters['stale'] == 1
+    # site answered 304, so page is used for next ttl
+    cache.ttls['product'] = 60
+    cache.revalidate(cached)
+    assert cached.is_fresh()
+    assert cache.lookup(PRODUCT_URL).is_fresh()
+    assert cache.counters['revalidated'] == 1
+    cache.close()
+
+
+def test_equal_bodies_share_file_and_changed_page_drops_old_body(tmp_path):
+    cache = create_cache(tmp_path)
+    cache.store(CATEGORY_URL, b'same page', 'utf-8', {})
+    cache.store(PRODUCT_URL, b'same page', 'utf-8', {})
+    assert len(body_files(cache)) == 1
+    size = cache.size
+    cache.store(PRODUCT_URL, b'changed page', 'utf-8', {})
+    assert len(body_files(cache)) == 2
+    cache.store(CATEGORY_URL, b'changed page', 'utf-8', {})
+    assert len(body_files(cache)) == 1
+    assert cache.size < size * 2
+    assert cache.lookup(CATEGORY_URL).replay() == 'changed page'
+    cache.close()
+
+
+def test_least_recently_used_page_is_evicted(tmp_path):
+    # random bodies are not compressed, so every body takes about 1000 bytes
+    cache = create_cache(tmp_path, max_size=2500)
+    urls = ['https://www.dresslily.com/hoodie-p-{}.html'.format(n) for n in range(3)]
+    cache.store(urls[0], os.urandom(1000), 'latin-1', {})
+    time.sleep(0.01)
+    cache.store(urls[1], os.urandom(1000), 'latin-1', {})
+    time.sleep(0.01)
+    # hit makes first page recently used
+    assert cache.lookup(urls[0]) is not None
+    time.sleep(0.01)
+    cache.store(urls[2], os.urandom(1000), 'latin-1', {})
+    assert cache.lookup(urls[1]) is None
+    assert cache.lookup(urls[0]) is not None
+    assert cache.lookup(urls[2]) is not None
+    assert cache.size <= 2500 * 0.9
+    assert len(body_files(cache)) == 2
+    assert cache.counters['evicted'] == 1
+    cache.close()
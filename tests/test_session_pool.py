@@ -0,0 +1,64 @@
+"""Keep-alive sessions reuse and retirement, sessions are created without connecting anywhere"""
+import time
+
+from helpers.session_pool import SessionPool
+
+PROXY = '10.0.0.1:8080'
+OTHER_PROXY = '10.0.0.2:8080'
+
+
+def use(pool, proxy):
+    """
+    Check out session for one request
+    :rtype: requests.Session
+    """
+    with pool.checkout(proxy) as session:
+        return session
+
+
+def test_session_of_proxy_is_reused():
+    pool = SessionPool()
+    session = use(pool, PROXY)
+    assert use(pool, PROXY) is session
+    assert use(pool, OTHER_PROXY) is not session
+    assert pool.stats() == {'open': 2, 'retired': 0, 'created': 2, 'reused': 1, 'closed': 0}
+
+
+def test_old_session_is_recycled():
+    pool = SessionPool(max_age=0.05)
+    session = use(pool, PROXY)
+    time.sleep(0.06)
+    assert use(pool, PROXY) is not session
+    assert pool.closed == 1
+    assert len(pool) == 1
+
+
+def test_idle_session_is_closed():
+    pool = SessionPool(idle_timeout=0.05)
+    use(pool, PROXY)
+    time.sleep(0.06)
+    use(pool, OTHER_PROXY)
+    assert list(pool.sessions) == [OTHER_PROXY]
+    assert pool.closed == 1
+
+
+def test_least_recently_used_session_is_closed_on_overflow():
+    pool = SessionPool(max_sessions=2)
+    for proxy in ('10.0.0.1:8080', '10.0.0.2:8080', '10.0.0.1:8080', '10.0.0.3:8080'):
+        use(pool, proxy)
+    assert list(pool.sessions) == ['10.0.0.1:8080', '10.0.0.3:8080']
+    assert pool.closed == 1
+
+
+def test_retired_session_is_closed_after_last_release():
+    pool = SessionPool(max_age=0.05)
+    session = pool.get(PROXY)
+    time.sleep(0.06)
+    # request still reads response through old session, so it is only retired
+    new_session = use(pool, PROXY)
+    assert new_session is not session
+    assert pool.stats()['retired'] == 1
+    assert pool.closed == 0
+    pool.release(session)
+    assert pool.stats()['retired'] == 0
+    assert pool.closed == 1
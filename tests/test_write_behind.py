@@ -0,0 +1,109 @@
+"""Write-behind writer batching against in-memory storage, no mongod is needed"""
+import pytest
+
+from storage.write_behind import REVIEWS_COUNT, WriteBehindWriter
+
+
+class FakeStorage:
+    """Records writes, first failures writes of every kind raise"""
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = []
+
+    def fail(self):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('db is not available')
+
+    def update_products(self, updates, inserts):
+        self.fail()
+        self.calls.append(('products', updates, inserts))
+
+    def add_review_pages(self, pages):
+        self.fail()
+        self.calls.append(('review pages', pages))
+
+    def get_reviews_counts(self, product_ids):
+        return {product_id: 6 for product_id in product_ids}
+
+
+@pytest.fixture
+def storage():
+    return FakeStorage()
+
+
+def create_writer(storage, **kwargs):
+    # long flush interval, so all puts of test are written in one batch on close
+    return WriteBehindWriter(storage, **dict(dict(batch_size=100, flush_interval=60), **kwargs))
+
+
+def test_updates_are_coalesced_per_id(storage):
+    writer = create_writer(storage)
+    writer.put({'_id': 1, 'name': 'old', 'price': 10})
+    writer.put({'_id': 1, 'name': 'new'})
+    writer.put({'_id': 2, 'price': 20}, on_insert={'crawl_state': 'listed'})
+    writer.close()
+    assert storage.calls == [('products', {1: {'name': 'new', 'price': 10}, 2: {'price': 20}},
+                              {2: {'crawl_state': 'listed'}})]
+
+
+def test_unchanged_fields_are_not_written_again(storage):
+    writer = create_writer(storage, flush_interval=0.05)
+    writer.put({'_id': 1, 'name': 'hoodie', 'price': 10})
+    writer.flush()
+    writer.put({'_id': 1, 'name': 'hoodie', 'price': 12})
+    writer.flush()
+    writer.put({'_id': 1, 'name': 'hoodie', 'price': 12})
+    writer.close()
+    assert [call[1] for call in storage.calls] == [{1: {'name': 'hoodie', 'price': 10}}, {1: {'price': 12}}]
+    assert writer.skipped_docs == 1
+
+
+def test_review_pages_are_written_before_product_counted(storage):
+    writer = create_writer(storage)
+    writer.put_review_page(1, 2, [{'hash': 'a'}])
+    writer.put({'_id': 1, 'reviews_count': REVIEWS_COUNT})
+    writer.close()
+    assert storage.calls == [('review pages', [(1, 2, [{'hash': 'a'}])]),
+                             ('products', {1: {'reviews_count': 6}}, {})]
+
+
+def test_failed_flush_is_requeued():
+    storage = FakeStorage(failures=1)
+    writer = create_writer(storage)
+    writer.put_review_page(1, 1, [{'hash': 'a'}])
+    writer.put({'_id': 1, 'name': 'hoodie'})
+    # failed batch is retried after flush interval
+    writer.flush_interval = 0.01
+    writer.close()
+    assert storage.calls == [('review pages', [(1, 1, [{'hash': 'a'}])]), ('products', {1: {'name': 'hoodie'}}, {})]
+    assert writer.dropped_docs == 0
+
+
+def test_requeued_document_keeps_newer_values(storage):
+    writer = create_writer(storage)
+    writer.put({'_id': 1, 'name': 'new'})
+    assert writer.requeue([(1, ({'name': 'old', 'price': 10}, {}))])
+    assert writer.pending[1] == ({'name': 'new', 'price': 10}, {})
+    writer.close()
+    assert storage.calls == [('products', {1: {'name': 'new', 'price': 10}}, {})]
+
+
+def test_document_is_dropped_after_max_attempts():
+    storage = FakeStorage(failures=100)
+    writer = create_writer(storage, flush_interval=0.01, max_attempts=2)
+    writer.put({'_id': 1, 'name': 'hoodie'})
+    writer.flush()
+    assert writer.dropped_docs == 1
+    assert not writer.pending
+    writer.close()
+
+
+def test_non_blocking_put_reports_full_queue(storage):
+    writer = create_writer(storage, max_queue_size=1)
+    assert writer.put({'_id': 1, 'name': 'hoodie'}, block=False)
+    assert not writer.put({'_id': 2, 'name': 'hoodie'}, block=False)
+    assert writer.put_review_page(1, 1, [], block=False)
+    assert not writer.put_review_page(1, 2, [], block=False)
+    writer.close()
+    assert writer.written_docs == 1